@@ -0,0 +1,232 @@
+# Benchmarks for loading, saving, splitting/merging and editing large style libraries, without the webui.
+#
+#   python benchmarks/bench.py --output before.json
+#   python benchmarks/bench.py --output after.json --compare before.json
+#
+# Synthetic libraries are generated for each combination of --styles and --files, in a temporary directory.
+# The tab switch and search and replace handlers are timed through scripts/main.py if gradio is installed,
+# otherwise the FileManager methods behind them are timed instead.
+import os, sys, json, time, types, random, shutil, tempfile, argparse, platform, subprocess, statistics, collections
+
+extension_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, extension_directory)
+
+def install_shims(styles_file:str):
+  """
+  Stand-ins for the parts of the webui the extension imports
+  """
+  class Options:
+    style_editor_storage = "CSV files"
+  class PromptStyles:
+    def __init__(self):
+      self.styles = {}
+    def reload(self):
+      pass
+  class Script:
+    pass
+  def noop(*args, **kwargs):
+    pass
+
+  modules = types.ModuleType("modules")
+  shared = types.ModuleType("modules.shared")
+  shared.cmd_opts = types.SimpleNamespace(styles_file=styles_file)
+  shared.opts = Options()
+  shared.prompt_styles = PromptStyles()
+  scripts = types.ModuleType("modules.scripts")
+  scripts.basedir = lambda: extension_directory
+  scripts.Script = Script
+  scripts.AlwaysVisible = object()
+  script_callbacks = types.ModuleType("modules.script_callbacks")
+  for callback in ["on_ui_tabs", "on_ui_settings", "on_app_started", "on_script_unloaded"]:
+    setattr(script_callbacks, callback, noop)
+  styles = types.ModuleType("modules.styles")
+  styles.PromptStyle = collections.namedtuple("PromptStyle", ["name", "prompt", "negative_prompt", "path"])
+  modules.shared, modules.scripts, modules.script_callbacks, modules.styles = shared, scripts, script_callbacks, styles
+  sys.modules.update({"modules":modules, "modules.shared":shared, "modules.scripts":scripts,
+                      "modules.script_callbacks":script_callbacks, "modules.styles":styles})
+
+words = ("masterpiece best quality highly detailed portrait landscape cinematic lighting soft focus sharp 8k photo "
+         "oil painting watercolor sketch anime illustration dramatic moody vibrant pastel golden hour studio bokeh "
+         "wide angle close-up octane render unreal engine trending artstation volumetric fog rim light film grain "
+         "(intricate:1.2) [detailed] {background} hdr symmetrical concept art matte painting").split()
+negative_words = "lowres bad anatomy bad hands text error missing fingers cropped worst quality jpeg artifacts blurry watermark".split()
+
+def generate(rng:random.Random, styles:int, files:int):
+  """
+  Rows of (name, prompt, negative_prompt) and {name : note}. With files>0, most styles are prefix::name, spread over that many prefixes.
+  """
+  rows, notes = [], {}
+  for i in range(styles):
+    name = f"style {i} {rng.choice(words)}"
+    if files>0 and rng.random()<0.8:
+      name = f"file{rng.randrange(files)}::{name}"
+    prompt = ", ".join(rng.choices(words, k=rng.randint(5, 60)))
+    if rng.random()<0.05:
+      prompt = prompt + "\n" + ", ".join(rng.choices(words, k=rng.randint(2, 10)))
+    negative_prompt = ", ".join(rng.choices(negative_words, k=rng.randint(0, 15)))
+    rows.append((name, "{prompt}, " + prompt if rng.random()<0.3 else prompt, negative_prompt))
+    if rng.random()<0.1:
+      notes[name] = " ".join(rng.choices(words, k=rng.randint(1, 12)))
+  return rows, notes
+
+class Bench:
+  def __init__(self, args):
+    self.args = args
+    self.results = []
+
+  def timed(self, case:dict, operation:str, method, setup=None):
+    """
+    Time method() args.repeat times (calling setup() untimed before each), and record the result
+    """
+    seconds = []
+    for i in range(self.args.repeat):
+      if setup:
+        setup(i)
+      start = time.perf_counter()
+      method(i)
+      seconds.append(time.perf_counter()-start)
+    result = { **case, "operation":operation, "seconds":seconds, "median":statistics.median(seconds), "min":min(seconds) }
+    self.results.append(result)
+    print(f"{case['styles']:>7} styles {case['files']:>4} files  {operation:<32} {result['median']*1000:>10.1f} ms", flush=True)
+
+  def run_case(self, styles:int, files:int):
+    from scripts.filemanager import FileManager, StyleFile
+    from scripts.storage import to_csv
+    from scripts.background import scheduler
+    from scripts.view import StyleView
+    import pandas as pd
+    rng = random.Random(self.args.seed)
+    rows, notes = generate(rng, styles, files)
+    directory = tempfile.mkdtemp(prefix="style_editor_bench_")
+    try:
+      styles_file = os.path.join(directory, "styles.csv")
+      with open(styles_file, 'wb') as f:
+        f.write(to_csv(pd.DataFrame(rows, columns=['name', 'prompt', 'negative_prompt'])))
+      basedir = os.path.join(directory, "extension")
+      os.makedirs(basedir)
+      with open(os.path.join(basedir, "notes.json"), 'w', encoding="utf-8") as f:
+        json.dump(notes, f)
+      FileManager.init(styles_file=styles_file, basedir=basedir, storage=self.args.storage)
+      if self.args.workers is not None:
+        FileManager.max_workers = self.args.workers
+      handlers = self.handlers()
+      for job in ["save", "index", "export", "backup", "cache"]:
+        if job in scheduler.jobs:
+          scheduler.jobs[job].debounce = scheduler.jobs[job].max_delay = 1e9 # only flush when asked to
+      case = {"styles":styles, "files":files, "storage":self.args.storage}
+      names = [name for name, _, _ in rows]
+
+      def cold(_):
+        FileManager.loaded_styles = {}
+      self.timed(case, "load (StyleFile._load)", lambda _: StyleFile(''), cold)
+      FileManager.style_file('')
+      if FileManager.cache:
+        FileManager.update_cache()
+        self.timed(case, "load (sidecar cache)", lambda _: StyleFile(''), cold)
+        FileManager.style_file('')
+      def save(_):
+        style_file = FileManager.style_file('')
+        style_file.write(style_file.snapshot())
+      self.timed(case, "save (StyleFile.write)", save)
+
+      def edit_one(i):
+        FileManager.edit_styles('', [(FileManager.style_file('').data.index[i], 'prompt', f"edited {i}")])
+      FileManager.flush()
+      edit_one(0); FileManager.flush() # the first journalled change also makes a checkpoint
+      self.timed(case, "flush after one edit", lambda _: FileManager.flush(), edit_one)
+
+      def fresh(_):
+        FileManager.loaded_styles = {}
+        FileManager.file_meta = {}
+      self.timed(case, "update_additional_style_files", lambda _: FileManager.update_additional_style_files(), fresh)
+      FileManager.flush()
+      self.timed(case, "update_additional (in sync)", lambda _: FileManager.update_additional_style_files(), cold)
+      self.timed(case, "merge_additional_style_files", lambda _: FileManager.merge_additional_style_files())
+      FileManager.flush()
+
+      picks = rng.sample(names, min(len(names), 3*self.args.repeat))
+      self.timed(case, "remove_style", lambda i: FileManager.remove_style(picks[i]))
+      self.timed(case, "duplicate_style", lambda i: FileManager.duplicate_style(picks[self.args.repeat+i]))
+      self.timed(case, "move_to_additional", lambda i: FileManager.move_to_additional(picks[2*self.args.repeat+i], "moved"))
+      self.timed(case, "flush after bulk operations", lambda _: FileManager.flush())
+
+      search = lambda i: FileManager.search_and_replace("cinematic", f"cinematic{i}" if i%2 else "cinematic", False, ['prompt'], [''])
+      if handlers:
+        search = lambda i: handlers.handle_search_and_replace_click("cinematic", f"cinematic{i}" if i%2 else "cinematic", False, ['prompt'], ["Master"], "bench")
+      self.timed(case, "search_and_replace" + (" (handler)" if handlers else ""), search)
+      FileManager.flush()
+
+      self.timed(case, "do_backup", lambda i: FileManager.do_backup(), lambda i: edit_one(i))
+
+      if handlers:
+        self.timed(case, "tab selected (handler)", lambda _: handlers.handle_this_tab_selected("bench"), cold)
+        self.timed(case, "another tab selected (handler)", lambda _: handlers.handle_another_tab_selected(True))
+      else:
+        self.timed(case, "tab selected", lambda _: (FileManager.update_additional_style_files(), StyleView.get("bench").current_page()), cold)
+        self.timed(case, "another tab selected", lambda _: (FileManager.merge_additional_style_files(), FileManager.flush()))
+    finally:
+      FileManager.loaded_styles = {}
+      shutil.rmtree(directory, ignore_errors=True)
+
+  def handlers(self):
+    """
+    The webui event handlers, if gradio is installed
+    """
+    if self.args.no_handlers:
+      return None
+    try:
+      from scripts.main import StyleEditor
+      return StyleEditor
+    except ImportError as e:
+      print(f"Not timing the webui handlers ({e})")
+      return None
+
+def metadata(args) -> dict:
+  try:
+    commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=extension_directory, capture_output=True, text=True).stdout.strip()
+  except OSError:
+    commit = None
+  import pandas as pd
+  return { "commit":commit, "time":time.strftime("%Y-%m-%d %H:%M:%S"), "python":platform.python_version(),
+           "pandas":pd.__version__, "platform":platform.platform(), "arguments":vars(args) }
+
+def compare(results, baseline_path:str):
+  """
+  Print the ratio of each median to the same operation in a previous run
+  """
+  with open(baseline_path) as f:
+    baseline = { (r['styles'], r['files'], r['operation']):r['median'] for r in json.load(f)['results'] }
+  print(f"\nCompared with {baseline_path} (ratio > 1 is slower):")
+  for r in results:
+    before = baseline.get((r['styles'], r['files'], r['operation']))
+    if before:
+      flag = "  <-- slower" if r['median']>before*1.2 else ""
+      print(f"{r['styles']:>7} styles {r['files']:>4} files  {r['operation']:<32} {r['median']/before:>6.2f}{flag}")
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the Style Editor on synthetic style libraries")
+  parser.add_argument("--styles", default="1000,10000,200000", help="comma separated numbers of styles")
+  parser.add_argument("--files", default="0,50,500", help="comma separated numbers of additional style files")
+  parser.add_argument("--repeat", type=int, default=3)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--storage", default="CSV files", choices=["CSV files", "SQLite database"])
+  parser.add_argument("--workers", type=int, help="threads for reading and writing additional style files (FileManager.max_workers)")
+  parser.add_argument("--no-handlers", action="store_true", help="don't time the webui handlers even if gradio is installed")
+  parser.add_argument("--output", default="bench_output.json")
+  parser.add_argument("--compare", help="a previous output file to compare with")
+  args = parser.parse_args()
+
+  install_shims(os.path.join(extension_directory, "styles.csv"))
+  bench = Bench(args)
+  for styles in [int(x) for x in args.styles.split(",")]:
+    for files in [int(x) for x in args.files.split(",")]:
+      bench.run_case(styles, files)
+  with open(args.output, 'w') as f:
+    from scripts.metrics import metrics
+    json.dump({"meta":metadata(args), "results":bench.results, "metrics":metrics.snapshot()}, f, indent=1)
+  print(f"Results written to {args.output}")
+  if args.compare:
+    compare(bench.results, args.compare)
+
+if __name__=="__main__":
+  main()
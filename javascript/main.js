@@ -1,16 +1,37 @@
 function api_post(path, payload, callback) {
     var xhr = new XMLHttpRequest();
     xhr.open("POST", path, true);
-    xhr.onload = function() { callback(JSON.parse(xhr.responseText)); };
+    xhr.onload = function() {
+        // 503 means too many style operations are waiting; try again when the server says to
+        if (xhr.status === 503) {
+            setTimeout(function() { api_post(path, payload, callback); }, 1000 * (parseFloat(xhr.getResponseHeader("Retry-After")) || 1));
+            return;
+        }
+        callback(JSON.parse(xhr.responseText));
+    };
     xhr.setRequestHeader("Content-type", "application/json");
     xhr.send(JSON.stringify(payload));
 }
 
+function view_id() {
+    // Each browser session has its own view of the styles (which file, filter, page), identified by this
+    const box = document.querySelector('#style_editor_view_id textarea, #style_editor_view_id input');
+    return box ? box.value : '';
+}
+
 function when_loaded() {
     api_post("/style-editor/check-api/", {}, function(x) { console.log( "Style Editor Check API", x['value'] )});
     globalThis.selectedRows = [];
+    globalThis.pendingEdits = [];
     grid = document.getElementById('style_editor_grid');
+    grid.addEventListener('focusin', function(event){
+        // remember what a cell held when editing started, so an Enter that changes nothing isn't recorded as an edit
+        if (event.target.tagName === 'INPUT') { event.target.dataset.original = event.target.value; }
+    });
     grid.addEventListener('keydown', function(event){
+        // if return is pressed in a cell INPUT, remember the edit so it can be sent as a delta
+        if (event.key === 'Enter' && event.target.tagName === 'INPUT') { record_edit(event.target); }
+
         // if a key is pressed in a TD which has an INPUT child, or an INPUT, this is typing in a cell, allow it
         if (event.target.tagName === 'TD' && event.target.querySelector("input")) { return; }
         if (event.target.tagName === 'INPUT') { return; }
@@ -34,36 +55,21 @@ function when_loaded() {
         if (event.key === "m" && globalThis.selectedRows.length > 0) {
             new_prefix = prompt("Move to style file:", "");
             if (new_prefix != null) { 
-                globalThis.selectedRows.forEach( function(row) { 
-                    api_post("/style-editor/move-style", 
-                            {"style":{"value":row_style_name(row)}, "new_prefix":{"value":new_prefix}}, 
-                            function(x){} );    
-                });
-                document.getElementById("style_editor_handle_api").click();
+                bulk_operation("move", new_prefix);
                 unselect_rows();
             }
         }
 
         // if D is pressed, duplicate the selected styles
         if (event.key === "d" && globalThis.selectedRows.length > 0) {
-            globalThis.selectedRows.forEach( function(row) { 
-                api_post("/style-editor/duplicate-style", 
-                        {"value":row_style_name(row)},
-                        function(x){} );    
-            });
-            document.getElementById("style_editor_handle_api").click();
+            bulk_operation("duplicate", "");
             unselect_rows();
         }
 
         // if backspace or delete are pressed, delete selected rows
         if (event.key === "Backspace" || event.key === "Delete") { 
             if (globalThis.selectedRows.length > 0) {
-                globalThis.selectedRows.forEach( function(row) { 
-                    api_post("/style-editor/delete-style", 
-                            {"value":row_style_name(row)}, 
-                            function(x){} );    
-                });
-                document.getElementById("style_editor_handle_api").click();
+                bulk_operation("delete", "");
             } else {
                 update(event.target,"");
             }
@@ -90,6 +96,45 @@ function when_loaded() {
     }, { capture: true });
 }
 
+const grid_columns = ["sort", "name", "prompt", "negative_prompt", "notes"];
+
+function record_edit(input) {
+    if (input.dataset.original !== undefined && input.value === input.dataset.original) { return; }
+    const cell = input.closest("td");
+    const row = cell ? cell.closest("tr") : null;
+    if (!row || row.parentNode.tagName !== 'TBODY') { return; }
+    const column = grid_columns[Array.from(row.children).indexOf(cell)];
+    if (column === undefined) { return; }
+    globalThis.pendingEdits.push({"row":Array.from(row.parentNode.children).indexOf(row), "column":column, "value":input.value});
+}
+
+function style_editor_grid_input(data, autosort, view) {
+    // If we know which cells changed, send just those, and send an empty table to the grid's input handler
+    // Anything else (like a new row) falls back to sending the whole table
+    // Only edits that agree with the table being sent are used, so one left over from an earlier page can't land on another row
+    const edits = (globalThis.pendingEdits || []).filter( (e) => {
+        const row = data["data"][e.row];
+        return row !== undefined && String(row[grid_columns.indexOf(e.column)]) === e.value;
+    });
+    globalThis.pendingEdits = [];
+    if (edits.length === 0) { return [data, autosort, view]; }
+    api_post("/style-editor/edit-cells/", {"edits":edits, "autosort":autosort, "view_id":view}, function(x) {
+        if (x['conflicts'] && x['conflicts'].length > 0) { console.log("Style Editor: rows changed by someone else, edits not saved", x['conflicts']); }
+        if (x['refresh']) { document.getElementById("style_editor_handle_api").click(); }
+    });
+    return [{"data":[], "headers":data["headers"]}, autosort, view];
+}
+
+function bulk_operation(operation, new_prefix) {
+    // Send one request for all the selected rows, then refresh the grid when it has been done
+    const operations = globalThis.selectedRows.map( (row) => ({"operation":operation, "style":row_style_name(row), "new_prefix":new_prefix}) );
+    api_post("/style-editor/bulk/", {"operations":operations, "view_id":view_id()}, function(x) {
+        const failed = x['results'].filter( (r) => !r['ok'] );
+        if (failed.length > 0) { console.log("Style Editor: " + operation + " failed for", failed); }
+        document.getElementById("style_editor_handle_api").click();
+    });
+}
+
 function row_style_name(row) {
     return row.querySelectorAll("td")[1].querySelector("span").textContent;
 }
@@ -140,15 +185,26 @@ function encryption_change(value) {
     return value
 }
 
-function filter_style_list(filter_text, type) {
+function clear_pending_edits() {
+    // The grid is about to show other rows, so recorded edits no longer refer to them
+    globalThis.pendingEdits = [];
+}
+
+function change_page(page, view) {
+    clear_pending_edits();
+    return [page, view];
+}
+
+function filter_style_list(filter_text, type, order, page_size, view) {
+    // The filtering is done on the server; this just shows whether the filter is active and valid
+    clear_pending_edits();
     if (type=="regex") { 
         filter = document.getElementById('style_editor_filter').firstElementChild.lastElementChild;
         try {
-            re = new RegExp(filter_text);
+            new RegExp(filter_text);
             filter.style.color="white";
         } 
         catch (error) { 
-            re = new RegExp();
             filter.style.color="red";
         } 
     }
@@ -158,27 +214,15 @@ function filter_style_list(filter_text, type) {
     } else {
         accordian_style.color = "#f88";
     }
-    rows = document.getElementById('style_editor_grid').querySelectorAll("tr");
-    header = true;
-    for (row of rows) {
-        vis = false;
-        for (cell of row.querySelectorAll("span")) {
-            if ( (type=="Exact match" && cell.textContent.includes(filter_text)) ||
-                 (type=="Case insensitive" && cell.textContent.toLowerCase().includes(filter_text.toLowerCase())) ||
-                 (type=="regex" && cell.textContent.match(re)) )
-                { vis = true; };
-        }
-        if (vis || header) { row.style.display = '' } else { row.style.display='none' }
-        header = false;
-    }
-    return [filter_text, type]
+    return [filter_text, type, order, page_size, view]
 }
 
-function style_file_selection_change(x,y) {
+function style_file_selection_change(x,y,view) {
+    clear_pending_edits();
     if (x==='--Create New--') {
-        return [new_style_file_dialog(''),'']
+        return [new_style_file_dialog(''),'',view]
     }
-    return [x,'']
+    return [x,'',view]
 }
 
 function new_style_file_dialog(x) {
@@ -2,9 +2,14 @@ import os
 
 class Additionals:
   @classmethod
-  def init(cls, default_style_file_path, additional_style_files_directory) -> None:
+  def init(cls, default_style_file_path, additional_style_files_directory, lister=None) -> None:
+    """
+    lister, if given, returns the prefixes of the additional style files (when they aren't csv files in the directory)
+    """
     cls.default_style_file_path = default_style_file_path
     cls.additional_style_files_directory = additional_style_files_directory
+    cls.lister = lister
+    cls.formatted = {}
 
   @staticmethod
   def has_prefix(fullname:str):
@@ -69,9 +74,16 @@ class Additionals:
   
   @classmethod
   def additional_style_files(cls, include_new, display_names):
-    format = cls.display_name if display_names else cls.full_path
-    additional_style_files = [format(f) for f in os.listdir(cls.additional_style_files_directory) if f.endswith(".csv")]
-    return additional_style_files+["--Create New--"] if include_new else additional_style_files
+    """
+    The display names or paths of the additional style files. They are only worked out again when the listing changes.
+    """
+    files = tuple(cls.lister() if cls.lister else [f for f in os.listdir(cls.additional_style_files_directory) if f.endswith(".csv")])
+    listed, additional_style_files = cls.formatted.get(display_names, (None, None))
+    if listed!=files:
+      format = cls.display_name if display_names else cls.full_path
+      additional_style_files = [format(f) for f in files]
+      cls.formatted[display_names] = (files, additional_style_files)
+    return additional_style_files+["--Create New--"] if include_new else list(additional_style_files)
   
   @classmethod
   def prefixes(cls):
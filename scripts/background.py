@@ -1,40 +1,106 @@
-import time, threading
+import time, threading, atexit
+from typing import Dict
 
-class Background:
+class Job:
+  def __init__(self, name, method, debounce, max_delay) -> None:
+    self.name = name
+    self.method = method
+    self.debounce = debounce
+    self.max_delay = max_delay
+    self.first_pending = None
+    self.last_pending = None
+    self.lock = threading.Lock()
+
+  def due(self):
+    """
+    When the job should run: debounce seconds after it was last marked pending,
+    but no more than max_delay seconds after it was first marked pending. None if it isn't pending.
+    """
+    if self.first_pending is None:
+      return None
+    return min(self.last_pending + self.debounce, self.first_pending + self.max_delay)
+
+class Scheduler:
   """
-  A simple background task manager that considers doing a background task every n seconds. 
-  The task is only done if the manager has been marked as pending.
+  Runs named jobs on a single background thread. A job runs once it has been pending for a while
+  (see Job.due), so a burst of set_pending calls results in one run. Marking a job as pending only
+  takes the condition lock for a moment; jobs are run without holding it.
+  Pending jobs are run when the interpreter shuts down.
   """
-  def __init__(self, method, sleeptime) -> None:
+  def __init__(self) -> None:
+    self.jobs:Dict[str,Job] = {}
+    self.condition = threading.Condition()
+    self._started = False
+
+  def add_job(self, name, method, debounce, max_delay=None):
     """
-    Create a manager that will consider calling `method` every `sleeptime` seconds
+    Register `method` to be run as job `name`, `debounce` seconds after the last call to set_pending(name),
+    or `max_delay` seconds after the first (if that is sooner)
     """
-    self.method = method
-    self.sleeptime = sleeptime
-    self._pending = False
-    self._started = False
-    self.lock = threading.Lock()
+    with self.condition:
+      self.jobs[name] = Job(name, method, debounce, max_delay if max_delay is not None else debounce)
 
   def start(self):
     """
-    Start the manager's thread
+    Start the scheduler's thread (set_pending does this if needed)
     """
-    with self.lock:
+    with self.condition:
       if not self._started:
         threading.Thread(group=None, target=self._action, daemon=True).start()
         self._started = True
 
-  def set_pending(self, pending=True):
+  def set_pending(self, name, pending=True):
+    """
+    Mark a job as pending (or not)
     """
-    Set the task as pending. Next time the manager checks it will call `method` and then unset pending.
+    self.start()
+    with self.condition:
+      job = self.jobs[name]
+      now = time.monotonic()
+      if not pending:
+        job.first_pending = job.last_pending = None
+      else:
+        job.first_pending = job.first_pending or now
+        job.last_pending = now
+      self.condition.notify()
+
+  def _take(self, job:Job) -> bool:
     """
-    with self.lock:
-        self._pending = pending
+    Mark the job as not pending; returns True if it was
+    """
+    pending = job.first_pending is not None
+    job.first_pending = job.last_pending = None
+    return pending
+
+  def _run(self, job:Job):
+    with job.lock:
+      try:
+        job.method()
+      except Exception as e:
+        print(f"Style Editor background job {job.name} failed ({e})")
 
   def _action(self):
     while True:
-      with self.lock:
-        if self._pending:
-            self.method()
-            self._pending = False
-      time.sleep(self.sleeptime) 
+      with self.condition:
+        now = time.monotonic()
+        due = [job for job in self.jobs.values() if job.due() is not None and job.due()<=now]
+        if len(due)==0:
+          times = [job.due() for job in self.jobs.values() if job.due() is not None]
+          self.condition.wait(timeout=min(times)-now if times else None)
+          continue
+        for job in due:
+          self._take(job)
+      for job in due:
+        self._run(job)
+
+  def flush(self, names=None):
+    """
+    Run the pending jobs (or just the named ones) now, in the order they were added
+    """
+    with self.condition:
+      jobs = [job for job in self.jobs.values() if (names is None or job.name in names) and self._take(job)]
+    for job in jobs:
+      self._run(job)
+
+scheduler = Scheduler()
+atexit.register(scheduler.flush)
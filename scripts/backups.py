@@ -0,0 +1,224 @@
+import os, io, gzip, json, hashlib, hmac, datetime, shutil, threading
+from typing import Dict, List
+from scripts.metrics import metrics
+try:
+  import pyAesCrypt
+except:
+  print("No pyAesCrypt - won't be able to do encryption")
+  pyAesCrypt = None
+
+buffer_size = 64*1024
+
+def encrypt_to(data:bytes, fOut, key:str):
+  """
+  Encrypt data straight into a file (or any writable binary stream)
+  """
+  pyAesCrypt.encryptStream(io.BytesIO(data), fOut, key, buffer_size)
+
+def decrypt_from(fIn, key:str, length:int=None) -> bytes:
+  """
+  Decrypt a file (or any readable binary stream, of length bytes from the current position) into memory
+  """
+  if length is None:
+    length = os.fstat(fIn.fileno()).st_size - fIn.tell()
+  fOut = io.BytesIO()
+  try:
+    pyAesCrypt.decryptStream(fIn, fOut, key, buffer_size)
+  except TypeError: # pyAesCrypt before 6.0 needs the input length
+    pyAesCrypt.decryptStream(fIn, fOut, key, buffer_size, length)
+  return fOut.getvalue()
+
+class BackupStore:
+  """
+  Snapshots of the style files, stored by content.
+
+  Each file is gzipped (and, optionally, encrypted) into objects/<sha256 of contents>, so an unchanged file
+  is never stored twice. Encrypted objects are named by an HMAC of the contents with the key instead, so an
+  object encrypted with one key is never reused with another. A snapshot is a manifest of {prefix : object} for the master file ('') and all the
+  additional style files, and the list of snapshots is kept in index.json, so listing them doesn't need to
+  look at the directory. Backups made by older versions (plain .csv or .aes copies of the master file)
+  are added to the index the first time it is created. Snapshots can be made from more than one thread,
+  so changes to the index and the objects are made holding the lock.
+  """
+  default_retention = {"recent":12, "hourly":24, "daily":7, "weekly":4}
+
+  def __init__(self, directory:str):
+    self.directory = directory
+    self.objects_directory = os.path.join(directory, "objects")
+    self.downloads_directory = os.path.join(directory, "downloads")
+    self.index_path = os.path.join(directory, "index.json")
+    self.lock = threading.RLock()
+    for d in [self.objects_directory, self.downloads_directory]:
+      if not os.path.exists(d):
+        os.makedirs(d)
+    self.snapshots:List[Dict] = self._load_index()
+
+  def _load_index(self) -> List[Dict]:
+    try:
+      with open(self.index_path) as f:
+        return json.load(f)['snapshots']
+    except FileNotFoundError:
+      legacy = [ { "name":file, "time":os.path.getmtime(os.path.join(self.directory, file)), "legacy":file }
+                  for file in os.listdir(self.directory) if file.endswith('.csv') or file.endswith('.aes') ]
+      self.snapshots = sorted(legacy, key=lambda s:s['time'])
+      self._save_index()
+      return self.snapshots
+    except Exception as e:
+      print(f"Style Editor couldn't read the backup index ({e})")
+      return []
+
+  def _save_index(self):
+    temp = self.index_path + ".tmp"
+    with open(temp, 'w') as f:
+      json.dump({"snapshots":self.snapshots}, f)
+    os.replace(temp, self.index_path)
+
+  def _object_path(self, object:str) -> str:
+    return os.path.join(self.objects_directory, object)
+
+  def _store(self, data:bytes, encrypt_key:str) -> str:
+    """
+    Store some bytes if they aren't already stored, and return the object name
+    """
+    if encrypt_key:
+      object = hmac.new(encrypt_key.encode(), data, hashlib.sha256).hexdigest() + ".gz.aes"
+    else:
+      object = hashlib.sha256(data).hexdigest() + ".gz"
+    path = self._object_path(object)
+    if not os.path.exists(path):
+      blob = gzip.compress(data)
+      with open(path+".tmp", 'wb') as f:
+        if encrypt_key:
+          encrypt_to(blob, f, encrypt_key)
+        else:
+          f.write(blob)
+        written = f.tell()
+      os.replace(path+".tmp", path)
+      metrics.count("bytes_written", written, file="backups")
+    return object
+
+  def _fetch(self, object:str, encrypt_key:str) -> bytes:
+    path = self._object_path(object)
+    metrics.count("bytes_read", os.path.getsize(path), file="backups")
+    with open(path, 'rb') as f:
+      blob = decrypt_from(f, encrypt_key) if object.endswith(".aes") else f.read()
+    return gzip.decompress(blob)
+
+  def snapshot(self, files:Dict[str,bytes], encrypt_key:str=None, retention:Dict[str,int]=None, checkpoint=False):
+    """
+    Store a snapshot of {prefix : file contents}, unless it is the same as the most recent one.
+    Then apply the retention policy. Returns the (unique) name of the new snapshot, or None.
+    Checkpoints (used by the journal) are always stored, aren't listed, and are kept until removed.
+    """
+    if encrypt_key and pyAesCrypt is None:
+      raise Exception("pyAesCrypt isn't installed")
+    with self.lock:
+      manifest = { prefix:self._store(data, encrypt_key) for prefix, data in files.items() }
+      regular = [snapshot for snapshot in self.snapshots if not snapshot.get('checkpoint')]
+      if not checkpoint and len(regular)>0 and regular[-1].get('files')==manifest:
+        return None
+      now = datetime.datetime.now()
+      name = base = now.strftime("checkpoint_%y%m%d_%H%M%S_%f" if checkpoint else "%y%m%d_%H%M%S")
+      taken, count = set(snapshot['name'] for snapshot in self.snapshots), 1
+      while name in taken: # more than one snapshot in a second
+        count += 1
+        name = f"{base}_{count}"
+      self.snapshots.append({"name":name, "time":now.timestamp(), "files":manifest, **({"checkpoint":True} if checkpoint else {})})
+      self.apply_retention(retention or self.default_retention)
+      self._save_index()
+      return name
+
+  def apply_retention(self, retention:Dict[str,int]):
+    """
+    Keep the n most recent snapshots, and the most recent snapshot in each of the last n hours, days and weeks
+    (retention is {"recent":n, "hourly":n, "daily":n, "weekly":n}). Delete the rest, and any objects only they used.
+    Checkpoints are always kept.
+    """
+    with self.lock:
+      regular = [i for i, snapshot in enumerate(self.snapshots) if not snapshot.get('checkpoint')]
+      recent = max(1, retention.get("recent", 0))
+      keep = set(range(len(self.snapshots))) - set(regular) | set(regular[-recent:])
+      for bucket, format in [("hourly","%Y%m%d%H"), ("daily","%Y%m%d"), ("weekly","%G%V")]:
+        seen = set()
+        for i in reversed(regular):
+          key = datetime.datetime.fromtimestamp(self.snapshots[i]['time']).strftime(format)
+          if not key in seen:
+            if len(seen)>=retention.get(bucket, 0):
+              break
+            seen.add(key)
+            keep.add(i)
+      self._drop([snapshot for i, snapshot in enumerate(self.snapshots) if not i in keep])
+
+  def remove(self, name:str):
+    """
+    Delete a snapshot (or checkpoint), and any objects only it used
+    """
+    with self.lock:
+      self._drop([snapshot for snapshot in self.snapshots if snapshot['name']==name])
+      self._save_index()
+
+  def _drop(self, dropped:List[Dict]):
+    self.snapshots = [snapshot for snapshot in self.snapshots if not snapshot in dropped]
+    used = set(object for snapshot in self.snapshots for object in snapshot.get('files', {}).values())
+    for snapshot in dropped:
+      paths = [os.path.join(self.directory, snapshot['legacy'])] if 'legacy' in snapshot else \
+              [self._object_path(object) for object in snapshot['files'].values() if not object in used]
+      for path in paths:
+        if os.path.exists(path):
+          os.remove(path)
+
+  def names(self) -> List[str]:
+    """
+    Snapshot names, most recent first
+    """
+    return [snapshot['name'] for snapshot in reversed(self.snapshots) if not snapshot.get('checkpoint')]
+
+  def _find(self, name:str) -> Dict:
+    for snapshot in self.snapshots:
+      if snapshot['name']==name:
+        return snapshot
+    return None
+
+  def read(self, name:str, encrypt_key:str) -> Dict[str,bytes]:
+    """
+    The contents of the files in a snapshot, as {prefix : bytes}. Legacy backups only contain the master file.
+    Raises an Exception if the snapshot doesn't exist or can't be decrypted.
+    """
+    with self.lock:
+      snapshot = self._find(name)
+      if snapshot is None:
+        raise Exception("Invalid selection")
+      if 'legacy' in snapshot:
+        with open(os.path.join(self.directory, snapshot['legacy']), 'rb') as f:
+          return { '': decrypt_from(f, encrypt_key) if snapshot['legacy'].endswith('.aes') else f.read() }
+      return { prefix:self._fetch(object, encrypt_key) for prefix, object in snapshot['files'].items() }
+
+  def export(self, name:str, encrypt_key:str) -> str:
+    """
+    Write the master file of a snapshot to the downloads directory (encrypted if it was stored encrypted)
+    and return the path, or None if that isn't possible
+    """
+    snapshot = self._find(name)
+    if snapshot is None:
+      return None
+    if 'legacy' in snapshot:
+      return os.path.join(self.directory, snapshot['legacy'])
+    if not '' in snapshot['files']:
+      return None
+    shutil.rmtree(self.downloads_directory, ignore_errors=True)
+    os.makedirs(self.downloads_directory)
+    try:
+      data = self.read(name, encrypt_key)['']
+    except Exception as e:
+      print(f"Style Editor couldn't read backup {name} ({e})")
+      return None
+    encrypted = snapshot['files'][''].endswith(".aes")
+    path = os.path.join(self.downloads_directory, name + (".csv.aes" if encrypted else ".csv"))
+    with open(path, 'wb') as f:
+      if encrypted:
+        encrypt_to(data, f, encrypt_key)
+      else:
+        f.write(data)
+    return path
+
+metrics.instrument(BackupStore, ["snapshot", "read", "export"])
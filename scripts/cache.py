@@ -0,0 +1,98 @@
+from __future__ import annotations
+import os, json, hashlib, importlib.util
+from typing import Tuple
+from scripts.shared import columns, user_columns, lazy_import
+from scripts.metrics import metrics
+pd = lazy_import("pandas")
+
+def feather():
+  """
+  pyarrow's feather module, or None if pyarrow isn't installed (it is only imported when first needed, as it is slow to import)
+  """
+  if importlib.util.find_spec("pyarrow") is None:
+    return None
+  import pyarrow.feather
+  return pyarrow.feather
+
+def display_form(column:pd.Series) -> pd.Series:
+  """
+  A saved column as it is shown in the grid
+  """
+  return column.str.replace('\n', '<br>', regex=False)
+
+class StyleCache:
+  """
+  Style files as they were last read or written, in a binary form that is much faster to load than the csv.
+
+  For each style file, <key>.json holds the version of the csv it was made from (and its StyleFile.content_hash), and <key>.feather (with pyarrow,
+  memory mapped when read) or <key>.pkl the saved columns plus the columns shown in the grid (with line breaks as <br>).
+  An entry is used only if the csv's mtime and size still match its version (as CsvStorage.check does), otherwise
+  the csv is parsed and the entry is written again later. Notes are kept elsewhere, so they aren't cached.
+  """
+  display_columns = [column for column in user_columns if column in columns]
+
+  def __init__(self, directory:str):
+    self.directory = directory
+    os.makedirs(directory, exist_ok=True)
+
+  def _path(self, prefix:str) -> str:
+    return os.path.join(self.directory, hashlib.sha1(prefix.encode("utf-8")).hexdigest()[:16])
+
+  def _meta(self, prefix:str):
+    try:
+      with open(self._path(prefix)+".json") as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def load(self, prefix:str, state) -> Tuple[pd.DataFrame,pd.DataFrame,object,str]:
+    """
+    The saved columns, the grid columns (with <br>), the version and the content hash of a style file,
+    or None if there is no entry for this state of the csv (its (mtime, size))
+    """
+    meta = self._meta(prefix)
+    if state is None or meta is None or meta['prefix']!=prefix or tuple(meta['version'][:2])!=tuple(state):
+      metrics.count("sidecar_cache", result="miss")
+      return None
+    path = self._path(prefix) + meta['file']
+    try:
+      if meta['file']==".feather":
+        data = feather().read_feather(path, memory_map=True)
+      else:
+        data = pd.read_pickle(path)
+    except Exception as e:
+      print(f"Style Editor couldn't read the cached copy of {prefix or 'the master style file'} ({e})")
+      metrics.count("sidecar_cache", result="miss")
+      return None
+    metrics.count("sidecar_cache", result="hit")
+    metrics.count("bytes_read", os.path.getsize(path), file="cache")
+    saved = data[columns]
+    display = saved.assign(**{ column:data["display_"+column] for column in self.display_columns })
+    return saved, display, tuple(meta['version']), meta['hash']
+
+  def save(self, prefix:str, version, saved:pd.DataFrame, content_hash:str):
+    """
+    Store the saved columns of a style file as of version, unless they are already stored
+    """
+    if version is None:
+      return
+    meta = self._meta(prefix)
+    if meta is not None and meta['prefix']==prefix and tuple(meta['version'])==tuple(version):
+      return
+    data = saved[columns].reset_index(drop=True)
+    data = data.assign(**{ "display_"+column:display_form(data[column]) for column in self.display_columns })
+    path = self._path(prefix)
+    module = feather()
+    extension = ".feather" if module is not None else ".pkl"
+    try:
+      if module is not None:
+        module.write_feather(data, path+extension+".tmp", compression="uncompressed")
+      else:
+        data.to_pickle(path+extension+".tmp", compression=None)
+      os.replace(path+extension+".tmp", path+extension)
+      metrics.count("bytes_written", os.path.getsize(path+extension), file="cache")
+      with open(path+".json.tmp", 'w') as f:
+        json.dump({"prefix":prefix, "version":list(version), "hash":content_hash, "file":extension}, f)
+      os.replace(path+".json.tmp", path+".json")
+    except Exception as e:
+      print(f"Style Editor couldn't cache {prefix or 'the master style file'} ({e})")
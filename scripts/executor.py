@@ -0,0 +1,96 @@
+import time, asyncio, threading, functools
+from concurrent import futures
+
+class Busy(Exception):
+  """
+  Raised instead of queueing a style operation when too many are already waiting
+  """
+
+class StyleExecutor:
+  """
+  Runs style operations away from the webui's request threads.
+
+  Writes run one at a time, in the order they were submitted, on a single writer thread. Reads run concurrently
+  on a small pool of reader threads, each once the writes submitted before it have finished, so a read always
+  sees the changes that were asked for first.
+
+  At most max_pending operations can be waiting or running. Beyond that, run either waits for a space
+  (raising Busy after busy_timeout seconds) or raises Busy at once, so callers can be told to try again later.
+  """
+  readers = 4
+  max_pending = 32
+  busy_timeout = 30
+
+  def __init__(self) -> None:
+    self.lock = threading.Lock()
+    self.pending = 0
+    self.last_write:futures.Future = None
+    self.writer = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="style_editor_writer")
+    self.reader_pool = futures.ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="style_editor_reader")
+
+  def submit(self, method, *args, write=True, **kwargs) -> futures.Future:
+    """
+    Queue method(*args, **kwargs) as a write (or a read), and return its Future. Raises Busy if the queue is full.
+    """
+    with self.lock:
+      if self.pending>=self.max_pending:
+        raise Busy(f"{self.pending} style operations are already waiting")
+      self.pending += 1
+      if write:
+        future = self.writer.submit(self._call, method, args, kwargs)
+        self.last_write = future
+      else:
+        future = self.reader_pool.submit(self._call, method, args, kwargs, self.last_write)
+    return future
+
+  def _call(self, method, args, kwargs, after:futures.Future=None):
+    try:
+      if after is not None:
+        futures.wait([after])
+      return method(*args, **kwargs)
+    finally:
+      with self.lock:
+        self.pending -= 1
+
+  async def run(self, method, *args, write=True, wait=True, **kwargs):
+    """
+    Run method(*args, **kwargs) as a write (or a read) and return its result, without blocking the event loop.
+    If the queue is full, wait for a space if wait is True, otherwise raise Busy.
+    """
+    deadline = time.monotonic() + (self.busy_timeout if wait else 0)
+    while True:
+      try:
+        future = self.submit(method, *args, write=write, **kwargs)
+        break
+      except Busy:
+        if time.monotonic()>=deadline:
+          raise
+        await asyncio.sleep(0.05)
+    return await asyncio.wrap_future(future)
+
+  def writes(self, method):
+    """
+    An async version of method, run as a write (for gradio event handlers)
+    """
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+      return await self.run(method, *args, **kwargs)
+    return wrapper
+
+  def reads(self, method):
+    """
+    An async version of method, run as a read (for gradio event handlers)
+    """
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+      return await self.run(method, *args, write=False, **kwargs)
+    return wrapper
+
+  def shutdown(self):
+    """
+    Wait for the queued operations to finish
+    """
+    self.writer.shutdown(wait=True)
+    self.reader_pool.shutdown(wait=True)
+
+executor = StyleExecutor()
@@ -1,42 +1,117 @@
 # A bunch of utility methods to load and save style files
-import pandas as pd
-import numpy as np
-import os, json
-from typing import Dict
-from modules.shared import cmd_opts, opts, prompt_styles
-import modules.scripts as scripts
-import shutil
-import datetime
-from pathlib import Path
-try:
-  import pyAesCrypt
-except:
-  print("No pyAesCrypt - won't be able to do encryption")
+from __future__ import annotations
+import os, re, json, hashlib, itertools
+import threading
+from concurrent import futures
+from typing import Dict, List, Tuple
 from scripts.additionals import Additionals
-from scripts.shared import columns, user_columns, display_columns, d_types, name_column
+from scripts.textindex import TextIndex, matches
+from scripts.backups import BackupStore, pyAesCrypt, decrypt_from
+from scripts.notes import NotesStore, make_notes_store
+from scripts.cache import StyleCache, display_form
+from scripts.storage import make_storage, parse_csv, to_csv
+from scripts.journal import Journal
+from scripts.background import scheduler
+from scripts import locks
+from scripts import journal
+from scripts.shared import columns, user_columns, display_columns, name_column, lazy_import
+from scripts import webui
+from scripts.metrics import metrics
+pd = lazy_import("pandas")
+
+revisions = itertools.count(1)
 
 class StyleFile:
+  """
+  A style file held in memory. Every change gets a new revision number (from a counter shared by all files),
+  and the revision at which each row was last changed is kept, so an edit based on an older view of a row
+  can be detected. Replacing the data as a whole changes every row.
+
+  Copies of the data share its columns (see view): a column is only copied when it is about to be changed
+  in place while a copy might still be using it, so taking a snapshot costs next to nothing.
+  """
   def __init__(self, prefix:str):
     self.prefix = prefix
-    self.filename = Additionals.full_path(prefix)
+    self.version = None
+    self.saved_hash = None
+    self.load_error:Exception = None
+    self.text_wanted = False
     self.data:pd.DataFrame = self._load()
+    self.dirty = False
+    self.saved_hash = self.saved_hash or StyleFile.content_hash(self.data)
+
+  @property
+  def data(self) -> pd.DataFrame:
+    return self._data
+
+  @data.setter
+  def data(self, data:pd.DataFrame):
+    """
+    Replacing the data drops the indexes; they are rebuilt the next time they are needed.
+    The caller may still hold the frame, so all its columns count as shared.
+    """
+    self._data = data
+    self._shared = set(data.columns)
+    self._reset_indexes()
+    self._text = None
+    self._unindexed = set()
+    self.base_revision = self.revision = next(revisions)
+    self.row_revisions:Dict[object,int] = {}
+
+  def _reset_indexes(self):
+    self._names = None
+    self._prefixes = None
+    self._groups = None
+
+  def view(self) -> pd.DataFrame:
+    """
+    The data, sharing its columns rather than copying them. Later changes to the style file don't affect it
+    (see _writable); it must be treated as read-only.
+    """
+    self._shared = set(self._data.columns)
+    return self._data.copy(deep=False)
+
+  def _writable(self, columns:List[str]):
+    """
+    Call before changing values of these columns in place: any that a view might be using are replaced by a copy first
+    """
+    for column in self._shared.intersection(columns):
+      self._data[column] = self._data[column].to_numpy(copy=True)
+    self._shared.difference_update(columns)
+
+  def row_revision(self, label) -> int:
+    """
+    The revision at which the row with this label was last changed
+    """
+    return self.row_revisions.get(label, self.base_revision)
 
   def _load(self):
-    try:
-      data = pd.read_csv(self.filename, header=None, names=columns, 
-                              encoding="utf-8-sig", dtype=d_types,
-                              skiprows=[0], usecols=[0,1,2])
-    except:
-      data = pd.DataFrame(columns=columns)
+    """
+    The data from the sidecar cache if it is up to date, otherwise parsed from storage (and cached later).
+    If the file can't be read it is treated as empty, and the exception is kept in load_error.
+    """
+    cached = FileManager.cache.load(self.prefix, FileManager.storage.state(self.prefix)) if FileManager.cache else None
+    if cached is not None:
+      self.journaled, data, self.version, self.saved_hash = cached
+    else:
+      try:
+        data, self.version = FileManager.storage.load(self.prefix)
+      except Exception as e:
+        self.load_error = e
+        data = pd.DataFrame(columns=columns)
+      data.fillna('', inplace=True)
+      self.journaled = pd.DataFrame({column:data[column] for column in columns}, copy=False)
+      if len(data)>0:
+        data = data.assign(**{ column:display_form(data[column]) for column in user_columns if column in columns })
+      if FileManager.cache and self.version is not None:
+        scheduler.set_pending("cache")
 
     indices = range(data.shape[0])
     data.insert(loc=0, column="sort", value=[i+1 for i in indices])
-    data.fillna('', inplace=True)
-    data.insert(loc=4, column="notes", 
-                     value=[FileManager.lookup_notes(data['name'][i], self.prefix) for i in indices])
-    if len(data)>0:
-      for column in user_columns:
-        data[column] = data[column].str.replace('\n', '<br>',regex=False)
+    notes = FileManager.notes.lookup(data[name_column], self.prefix)
+    with_notes = notes!=''
+    notes[with_notes] = display_form(notes[with_notes])
+    data.insert(loc=4, column="notes", value=notes.to_numpy())
     return data
   
   @staticmethod
@@ -51,256 +126,1387 @@ class StyleFile:
       return data.sort_values(by='sort', axis='index', inplace=False, na_position='first', key=_to_numeric)
     except:
       return data
-  
-  def save(self):
+
+  def sort(self):
+    """
+    Sort the data in place. Row labels don't change, so the name index stays valid.
+    """
+    self._data = StyleFile.sort_dataset(self._data)
+
+  def names(self) -> Dict[str,object]:
+    """
+    Index from style name to row label (the first row, if a name is duplicated)
+    """
+    if self._names is None:
+      self._names = {}
+      for label, name in zip(self._data.index, self._data[name_column]):
+        self._names.setdefault(name, label)
+    return self._names
+
+  def prefixes(self) -> Dict[str,Dict[str,object]]:
+    """
+    Index from prefix to {unprefixed name : row label} for the rows named prefix::name
+    """
+    if self._prefixes is None:
+      self._prefixes = {}
+      for name, label in self.names().items():
+        prefix, style = Additionals.split_stylename(name)
+        if prefix is not None:
+          self._prefixes.setdefault(prefix, {})[style] = label
+    return self._prefixes
+
+  def prefixed_groups(self) -> Dict[str,pd.DataFrame]:
+    """
+    The prefix::name rows, as {prefix : rows with just the name} (see FileManager._prefixed_groups).
+    Kept, with their content hashes, until the data is changed or sorted.
+    """
+    if self._groups is None or self._groups[0]!=self.revision or self._groups[1] is not self._data:
+      self._groups = (self.revision, self._data, FileManager._prefixed_groups(self._data), {})
+    return self._groups[2]
+
+  def group_hashes(self) -> Dict[str,str]:
+    """
+    The content hash of each of the prefixed_groups
+    """
+    groups, hashes = self.prefixed_groups(), self._groups[3]
+    for prefix, group in groups.items():
+      if not prefix in hashes:
+        hashes[prefix] = StyleFile.content_hash(group)
+    return hashes
+
+  def _index_add(self, name:str, label):
+    if self._names is not None and not name in self._names:
+      self._names[name] = label
+      if self._prefixes is not None:
+        prefix, style = Additionals.split_stylename(name)
+        if prefix is not None:
+          self._prefixes.setdefault(prefix, {})[style] = label
+
+  def _index_remove(self, name:str, label):
+    if self._names is not None and self._names.get(name)==label:
+      del self._names[name]
+      if self._prefixes is not None:
+        prefix, style = Additionals.split_stylename(name)
+        if prefix is not None and self._prefixes.get(prefix, {}).get(style)==label:
+          del self._prefixes[prefix][style]
+          if len(self._prefixes[prefix])==0:
+            del self._prefixes[prefix]
+
+  def needs_text_index(self) -> bool:
+    """
+    True if the text index has been asked for, and is missing, has too many dead entries or has rows left out of it
+    """
+    return self.text_wanted and (self._text is None or self._text.needs_rebuild() or len(self._unindexed)>0)
+
+  def text_index(self) -> TextIndex:
+    """
+    The full text index of the rows, kept up to date by edits, or None if it isn't ready yet.
+    Asking for it has it built in the background (by the "index" job, see FileManager.rebuild_text_indexes).
+    """
+    self.text_wanted = True
+    if self.needs_text_index():
+      scheduler.set_pending("index")
+    return self._text
+
+  def adopt_text_index(self, text:TextIndex, revision:int) -> bool:
+    """
+    Use a text index built from a view of the data at this revision, after reindexing the rows changed
+    since then. Returns False (and the index isn't used) if too much has changed.
+    """
+    if self.base_revision>revision:
+      return False
+    since = [label for label, row_revision in self.row_revisions.items() if row_revision>revision]
+    if len(since)>StyleFile.reindex_limit:
+      return False
+    for label in since:
+      text.remove(label)
+    text.update_rows(self._data.loc[[label for label in since if label in self._data.index], display_columns])
+    self._text = text
+    self._unindexed = set()
+    return True
+
+  def narrow(self, text:str, filter_type:str) -> pd.DataFrame:
+    """
+    The rows that might match the filter (all of them if the text index isn't ready or can't narrow it down).
+    Rows left out of the index by a large change are always included.
+    """
+    text_index = self.text_index()
+    return self._data if text_index is None else text_index.narrow(self._data, text, filter_type, also=self._unindexed)
+
+  def find(self, text:str, filter_type:str) -> pd.Index:
+    """
+    Labels of the rows that match the filter text (see textindex.matches). Until the text index is ready, every row is scanned.
+    """
+    if text=='':
+      return self._data.index
+    rows = self.narrow(text, filter_type)
+    return rows.index[matches(rows, text, filter_type)]
+
+  reindex_limit = 5000
+
+  def _changed(self, labels, removed=()):
+    """
+    Call after changing or adding (and removing) rows: gives them a new revision and updates the text index
+    """
+    self.revision = next(revisions)
+    labels = list(labels)
+    self.row_revisions.update(dict.fromkeys([*labels, *removed], self.revision))
+    self._reindex(labels, removed)
+
+  def _reindex(self, labels:List, removed=()):
+    """
+    Update the text index for changed and removed rows. If more than reindex_limit rows changed, they are
+    taken out of the index instead, and scanned by narrow until the index is rebuilt in the background.
+    """
+    if self._text is not None:
+      for label in removed:
+        self._text.remove(label)
+      self._unindexed.difference_update(removed)
+      if len(labels)>StyleFile.reindex_limit:
+        for label in labels:
+          self._text.remove(label)
+        self._unindexed.update(labels)
+        scheduler.set_pending("index")
+      else:
+        self._text.update_rows(self._data.loc[labels, display_columns])
+        self._unindexed.difference_update(labels)
+
+  def _removed(self, label):
+    self.revision = next(revisions)
+    self.row_revisions[label] = self.revision
+    if self._text is not None:
+      self._text.remove(label)
+      self._unindexed.discard(label)
+
+  def _check_index(self):
+    """
+    If some names are duplicated, incremental updates can't keep the index right, so drop it
+    """
+    if self._names is not None and len(self._names)!=len(self._data):
+      self._names = None
+      self._prefixes = None
+
+  def _next_label(self) -> int:
+    return int(self._data.index.max())+1 if len(self._data)>0 else 0
+
+  def remove(self, name:str) -> bool:
+    """
+    Remove the style with this name. Returns True if there was one.
+    """
+    label = self.names().get(name)
+    if label is None:
+      return False
+    self._data = self._data.drop(index=label)
+    self._index_remove(name, label)
+    self._removed(label)
+    self._check_index()
+    return True
+
+  def duplicate(self, name:str):
+    """
+    Add a copy of the style with this name directly after it; the copy gets an unused name.
+    Returns the label of the new row, or None if there was no such style.
+    """
+    label = self.names().get(name)
+    if label is None:
+      return None
+    copy = self._data.loc[[label]].copy()
+    new_label = self._next_label()
+    new_name = self._unused_name(name)
+    copy.index = [new_label]
+    copy.iat[0, copy.columns.get_loc(name_column)] = new_name
+    position = self._data.index.get_loc(label)+1
+    self._data = pd.concat([self._data.iloc[:position], copy, self._data.iloc[position:]])
+    self._index_add(new_name, new_label)
+    self._changed([new_label])
+    self._check_index()
+    return new_label
+
+  def rename(self, name:str, new_name:str) -> str:
+    """
+    Rename a style (an unused name is made from new_name if necessary). Returns the new name, or None if there was no such style.
+    """
+    label = self.names().get(name)
+    if label is None:
+      return None
+    new_name = self._unused_name(new_name, exclude=label)
+    self._writable([name_column])
+    self._data.at[label, name_column] = new_name
+    self._index_remove(name, label)
+    self._index_add(new_name, label)
+    self._changed([label])
+    self._check_index()
+    return new_name
+
+  def upsert(self, rows:pd.DataFrame, update_columns:List[str]=display_columns):
+    """
+    Replace the rows whose names are already present (just the update_columns), and append the others
+    """
+    names = self.names()
+    existing = rows[name_column].isin(names)
+    if existing.any():
+      labels = [names[name] for name in rows[name_column][existing]]
+      values = rows.loc[existing, update_columns].to_numpy()
+      differs = (self._data.loc[labels, update_columns].astype(str).to_numpy()!=values.astype(str)).any(axis=1)
+      if differs.any():
+        labels = [label for label, different in zip(labels, differs) if different]
+        self._writable(update_columns)
+        self._data.loc[labels, update_columns] = values[differs]
+        self._changed(labels)
+    new_rows = rows[~existing].drop_duplicates(subset=name_column)
+    if len(new_rows)>0:
+      first = self._next_label()
+      new_rows = new_rows.set_axis(range(first, first+len(new_rows)), axis='index')
+      self._data = pd.concat([self._data, new_rows[display_columns]]) if len(self._data)>0 else new_rows[display_columns]
+      for label, name in zip(new_rows.index, new_rows[name_column]):
+        self._index_add(name, label)
+      self._changed(new_rows.index)
+    self._check_index()
+
+  def apply_changes(self, changes:Dict, inverse=False):
+    """
+    Make (or, if inverse is True, undo) changes recorded in the journal. New rows go at the end.
+    """
+    removed, rows = journal.resolve(changes, inverse)
+    for name in removed:
+      self.remove(name)
+    if len(rows)==0:
+      return
+    first = len(self._data)+1
+    new_rows = pd.DataFrame([[first+i, name, *values, ''] for i, (name, values) in enumerate(rows.items())], columns=display_columns)
+    new_rows['notes'] = FileManager.notes.lookup(new_rows[name_column], self.prefix)
+    for column in ['prompt', 'negative_prompt']:
+      new_rows[column] = new_rows[column].str.replace('\n', '<br>', regex=False)
+    self.upsert(new_rows, update_columns=columns)
+
+  @staticmethod
+  def content_hash(data:pd.DataFrame) -> str:
+    """
+    A hash of the saved columns, in order, so a file only gets written if its contents have changed
+    """
+    return hashlib.sha1(pd.util.hash_pandas_object(data[columns].astype(str), index=False).to_numpy().tobytes()).hexdigest()
+
+  def replace_values(self, column:str, values:pd.Series):
+    """
+    Set the values of a (non-name) column for the rows in the index of values
+    """
+    self._writable([column])
+    self._data.loc[values.index, column] = values
+    self._changed(values.index)
+
+  def snapshot(self) -> pd.DataFrame:
+    """
+    Fix duplicates and return the saved columns in the form they are written to disk.
+    Only the columns with line breaks to convert are new; the name column is shared with the data.
+    """
     self.fix_duplicates()
-    clone = self.data.copy()
+    return StyleFile.saved_form(self.view())
+
+  @staticmethod
+  def saved_form(data:pd.DataFrame) -> pd.DataFrame:
+    """
+    The saved columns of a view of the data, in the form they are written to disk
+    """
+    clone = pd.DataFrame({column:data[column] for column in columns}, copy=False)
     if len(clone)>0:
       for column in user_columns:
-        clone[column] = clone[column].str.replace('<br>', '\n',regex=False)
-    clone.to_csv(self.filename, encoding="utf-8-sig", columns=columns, index=False)
+        if column in columns:
+          clone[column] = clone[column].str.replace('<br>', '\n',regex=False)
+    return clone
+
+  def write(self, clone:pd.DataFrame, changes:Dict=None, reordered=True):
+    """
+    Write a snapshot to storage (changes, from journal.diff, let the storage write just the rows that changed).
+    Returns the new version.
+    """
+    return FileManager.storage.save(self.prefix, clone[columns], changes, reordered)
+
+  def changed_on_disk(self) -> bool:
+    """
+    True if the file has been changed by something else since it was loaded or written by us
+    """
+    changed, self.version = FileManager.storage.check(self.prefix, self.version)
+    return changed
+
+  def apply_edits(self, edits:List[Tuple[object,str,str]]) -> List:
+    """
+    Apply (row label, column, value) edits in place.
+    Returns the labels of the rows that were changed.
+    """
+    changed = []
+    for label, column, value in edits:
+      if column not in display_columns or not label in self._data.index:
+        continue
+      if column=='sort':
+        try:
+          value = int(value)
+        except ValueError:
+          continue
+      if column==name_column:
+        old_name = self._data.at[label, name_column]
+        value = self._unused_name(value, exclude=label)
+        self._index_remove(old_name, label)
+        self._index_add(value, label)
+      self._writable([column])
+      self._data.at[label, column] = value
+      if not label in changed:
+        changed.append(label)
+    self._changed(changed)
+    self._check_index()
+    return changed
+
+  def set_rows(self, labels:List, rows:pd.DataFrame) -> List:
+    """
+    Replace the rows with the given labels with the first len(labels) rows, and append any others as new rows.
+    Labels which are no longer in the data are skipped. Returns the labels of all the rows set.
+    """
+    existing = [(i, label) for i, label in enumerate(labels[:len(rows)]) if label in self._data.index]
+    if len(existing)>0:
+      self._writable(display_columns)
+      self._data.loc[[label for _, label in existing], display_columns] = rows.iloc[[i for i, _ in existing]][display_columns].to_numpy()
+    new_rows = rows.iloc[len(labels):]
+    first = self._next_label()
+    new_labels = list(range(first, first+len(new_rows)))
+    if len(new_rows)>0:
+      new_rows = new_rows[display_columns].set_axis(new_labels, axis='index')
+      self._data = pd.concat([self._data, new_rows]) if len(self._data)>0 else new_rows
+    self._reset_indexes()
+    labels = [label for _, label in existing] + new_labels
+    self._changed(labels)
+    return labels
+
+  def replace_rows(self, data:pd.DataFrame) -> bool:
+    """
+    Make the rows those of data, in its order. Rows whose names are already present keep their labels, and
+    their revisions unless their values change, so replacing the rows with the same styles doesn't look like
+    a change to every row. Returns False (and changes nothing) if the styles and their order are the same.
+    """
+    compared = columns + ['notes']
+    same_length = len(data)==len(self._data)
+    if same_length and (data[compared].astype(str).to_numpy()==self._data[compared].astype(str).to_numpy()).all():
+      return False
+    names = self.names()
+    next_label = self._next_label()
+    labels, used = [], set()
+    for name in data[name_column]:
+      label = names.get(name)
+      if label is None or label in used:
+        label, next_label = next_label, next_label+1
+      used.add(label)
+      labels.append(label)
+    new = data[display_columns].set_axis(labels, axis='index')
+    kept = [label for label in labels if label in self._data.index]
+    differs = (new.loc[kept, compared].astype(str).to_numpy()!=self._data.loc[kept, compared].astype(str).to_numpy()).any(axis=1)
+    changed = [label for label, different in zip(kept, differs) if different] + [label for label in labels if not label in self._data.index]
+    resorted = [label for label, different, old, now in zip(kept, differs, self._data.loc[kept, 'sort'].astype(str), new.loc[kept, 'sort'].astype(str)) if old!=now and not different]
+    removed = self._data.index.difference(new.index)
+    self._data = new
+    self._shared = set(new.columns)
+    self._reset_indexes()
+    self._changed(changed, removed)
+    self._reindex(resorted)
+    return True
+
+  def _unused_name(self, name:str, exclude=None) -> str:
+    names = self.names()
+    while name in names and names[name]!=exclude:
+      name = name + "x"
+    return name
 
   def fix_duplicates(self):
-    names = self.data['name']
-    used = set()
-    for index, value in names.items():
-      if value in used:
-        while value in used:
-          value = value + "x"
-        names.at[index] = value
-      used.add(value)
-
-class FileManager:
-  basedir = scripts.basedir()
-  additional_style_files_directory = os.path.join(basedir,"additonal_style_files")
-  backup_directory = os.path.join(basedir,"backups")
-  if not os.path.exists(backup_directory):
-    os.mkdir(backup_directory)
-  if not os.path.exists(additional_style_files_directory):
-    os.mkdir(additional_style_files_directory)
-
-  try:
-    default_style_file_path = cmd_opts.styles_file 
-  except:
-    default_style_file_path = getattr(opts, 'styles_dir', None)
-  current_styles_file_path = default_style_file_path
-
-  Additionals.init(default_style_file_path=default_style_file_path, additional_style_files_directory=additional_style_files_directory)
-
-  try:
-    with open(os.path.join(basedir, "notes.json")) as f:
-      notes_dictionary = json.load(f)
-  except:
-    notes_dictionary = {}
+    """
+    Append 'x' to names which are already in use by an earlier row.
+    The name index holds the first row for each name, so only the others need renaming.
+    """
+    names = self.names()
+    if len(names)==len(self._data):
+      return
+    self._writable([name_column])
+    for label, value in zip(list(self._data.index), list(self._data[name_column])):
+      if names[value]!=label:
+        new_value = self._unused_name(value)
+        self._data.at[label, name_column] = new_value
+        names[new_value] = label
+        self._changed([label])
+    self._prefixes = None
+
+class LazyInit(type):
+  """
+  Metaclass for FileManager: the first time one of the attributes set by init is used, init is called
+  """
+  def __getattr__(cls, name):
+    if name in cls.initialized_attributes:
+      cls.init()
+      return type.__getattribute__(cls, name)
+    raise AttributeError(f"type object '{cls.__name__}' has no attribute '{name}'")
+
+class FileManager(metaclass=LazyInit):
+  initialized_attributes = ("basedir", "additional_style_files_directory", "backup_directory", "default_style_file_path", 
+                            "storage", "backup_store", "notes", "journal", "file_meta_path", "file_meta", "cache")
+  init_lock = threading.RLock()
+  initialized = False
 
   encrypt = False
   encrypt_key = ""
   loaded_styles:Dict[str,StyleFile] = {}
 
+  write_delay = 2
+  max_write_delay = 10
+  max_workers = 8
+  save_lock = threading.RLock()
+  flush_lock = threading.Lock()
+
+  file_meta_dirty = False
+  operations = set()
+  queued_backups:List[Dict[str,bytes]] = []
+
+  @classmethod
+  def init(cls, styles_file:str=None, basedir:str=None, storage:str=None):
+    """
+    Set up the storage, notes, journal and backups. This happens the first time they are needed, using the webui's
+    styles file and settings; to use the Style Editor without the webui, call it first with the path to a styles file
+    (basedir is where the additional style files, backups and so on go, by default the extension directory).
+    Does nothing if already done, unless arguments are given.
+    """
+    with cls.init_lock:
+      if cls.initialized and styles_file is None and basedir is None and storage is None:
+        return
+      cls.basedir = basedir or webui.extension_directory
+      cls.additional_style_files_directory = os.path.join(cls.basedir,"additonal_style_files")
+      cls.backup_directory = os.path.join(cls.basedir,"backups")
+      os.makedirs(cls.backup_directory, exist_ok=True)
+      os.makedirs(cls.additional_style_files_directory, exist_ok=True)
+
+      cls.default_style_file_path = styles_file or webui.styles_file_path()
+      locks.use_lock_directory(os.path.join(cls.basedir, "locks"))
+      cls.storage = make_storage(storage or webui.option("style_editor_storage", "CSV files"), cls.basedir, cls.default_style_file_path, cls.additional_style_files_directory)
+      Additionals.init(default_style_file_path=cls.default_style_file_path, additional_style_files_directory=cls.additional_style_files_directory, lister=cls.storage.prefixes)
+      cls.backup_store = BackupStore(cls.backup_directory)
+      cls.notes = make_notes_store(cls.storage, cls.basedir)
+      cls.journal = Journal(os.path.join(cls.basedir, "journal.jsonl"))
+      cls.cache = StyleCache(os.path.join(cls.basedir, "cache")) if cls.storage.uses_cache else None
+
+      cls.file_meta_path = os.path.join(cls.basedir, "style_files.json")
+      try:
+        with open(cls.file_meta_path) as f:
+          cls.file_meta:Dict[str,Dict] = json.load(f)
+      except:
+        cls.file_meta = {}
+      cls.loaded_styles = {}
+      cls.initialized = True
+      if cls.storage.exports_master:
+        scheduler.add_job("export", cls.storage.export_master, 5, 30)
+        if cls.storage.export_pending:
+          scheduler.set_pending("export")
+
   @classmethod
   def clear_style_cache(cls):
     """
-    Drop all loaded styles
+    Write any unsaved changes, then drop all loaded styles
     """
-    cls.loaded_styles = {}
+    cls.flush()
+    with cls.save_lock:
+      cls.loaded_styles = {}
 
   @classmethod
-  def get_current_styles(cls):
-    return cls.get_styles(cls._current_prefix())
-  
+  def discard_styles(cls, prefix):
+    """
+    Drop a style file from the cache without saving it (used when the file is deleted)
+    """
+    with cls.save_lock:
+      cls.loaded_styles.pop(prefix, None)
+      if cls.file_meta.pop(prefix, None) is not None:
+        cls.file_meta_dirty = True
+
   @classmethod
-  def using_additional(cls):
-    return cls._current_prefix()!=''
-  
+  def mark_dirty(cls, prefix, operation:str=None):
+    """
+    Mark a loaded style file as needing to be written. The "save" job writes it write_delay seconds
+    after the last edit (or max_write_delay after the first), so a burst of edits results in a single write 
+    (and a single journal record, labelled with the operations that were done).
+    """
+    with cls.save_lock:
+      style_file = cls.loaded_styles[prefix]
+      style_file.dirty = True
+      if operation is not None:
+        cls.operations.add(operation)
+    scheduler.set_pending("save")
+    if style_file.needs_text_index():
+      scheduler.set_pending("index")
+
   @classmethod
-  def get_styles(cls, prefix='') -> pd.DataFrame:
+  def rebuild_text_indexes(cls):
+    """
+    Build the text indexes which have been asked for and are missing, or have had a lot of rows replaced or removed.
+    Each is built from a view of the data outside the save lock, then brought up to date with the edits made meanwhile.
+    """
+    with cls.save_lock:
+      wanted = [(style_file, style_file.view(), style_file.revision) for style_file in cls.loaded_styles.values() if style_file.needs_text_index()]
+    for style_file, data, revision in wanted:
+      text = TextIndex(data)
+      with cls.save_lock:
+        if cls.loaded_styles.get(style_file.prefix) is style_file and not style_file.adopt_text_index(text, revision):
+          scheduler.set_pending("index")
+
+  @classmethod
+  def flush(cls):
+    """
+    Write all dirty style files now. Only taking a view of the data and the bookkeeping are done under
+    the save lock; checking the disk, merging, hashing, diffing and writing are done outside it (see prepare_write).
+    The changes (by style name) are appended to the journal.
+
+    If a file has been changed by something else since we read it, their changes are merged in first
+    (ours win for styles we have changed too). Each file is checked again and written while holding 
+    its write lock; if it changed in between, it stays dirty and is merged next time.
+    Several dirty files are written concurrently (see for_each_file).
+    While encryption is on the journal isn't written to disk, as it holds the prompts in plain text.
+    """
+    with cls.flush_lock:
+      cls.journal.set_persist(cls.backup_key() is None)
+      with cls.save_lock:
+        taken = []
+        for style_file in cls.loaded_styles.values():
+          if style_file.dirty:
+            style_file.dirty = False
+            style_file.fix_duplicates()
+            taken.append((style_file, style_file.view(), style_file.revision, style_file.journaled, style_file.version))
+        operation = "+".join(sorted(cls.operations)) or "edit"
+        cls.operations = set()
+      pending = {}
+      for style_file, data, revision, journaled, version in taken:
+        prepared = cls.prepare_write(style_file, data, revision, journaled, version)
+        if prepared is not None:
+          pending[style_file.prefix] = prepared
+      if any(file_changes for _, _, _, file_changes, *_ in pending.values()) and cls.journal.needs_checkpoint():
+        cls.journal_checkpoint()
+
+      def write(prefix):
+        style_file, clone, _, file_changes, reordered, _, version = pending[prefix]
+        with cls.storage.write_lock(prefix):
+          if version is not None and cls.storage.check(prefix, version)[0]:
+            raise InterruptedError("changed by something else while saving, will merge and retry")
+          return style_file.write(clone, file_changes, reordered)
+      versions, errors = cls.for_each_file(write, list(pending))
+
+      changes = {}
+      written = []
+      for prefix, (style_file, clone, new_hash, file_changes, reordered, journaled, version) in pending.items():
+        if prefix in versions:
+          with cls.save_lock:
+            style_file.saved_hash = new_hash
+            style_file.version = versions[prefix]
+            cls.note_file(style_file)
+          if file_changes:
+            changes[prefix] = file_changes
+          written.append((style_file, clone))
+        else:
+          print(f"Style Editor didn't save {prefix or 'the master style file'}: {errors[prefix]}")
+          with cls.save_lock:
+            style_file.journaled = journaled
+            style_file.dirty = True
+          if isinstance(errors[prefix], InterruptedError):
+            scheduler.set_pending("save")
+      if changes:
+        cls.journal.record(operation, changes)
+      if written and cls.cache:
+        scheduler.set_pending("cache")
+      cls.save_file_meta()
+      for style_file, clone in written:
+        if style_file.prefix=='':
+          cls.push_to_webui(clone)
+          if cls.storage.exports_master:
+            scheduler.set_pending("export")
+
+  @classmethod
+  def prepare_write(cls, style_file:StyleFile, data:pd.DataFrame, revision:int, journaled:pd.DataFrame, version):
+    """
+    Work out what flush is to write for a style file, from a view of its data taken under the save lock:
+    merge in changes made by something else, hash, and diff against the journal. Only the bookkeeping at the
+    end takes the save lock. Returns the pending write, or None if there is nothing to write (or the file 
+    changed meanwhile, in which case it is left dirty to try again).
+    """
+    changed, version = cls.storage.check(style_file.prefix, version)
+    if changed:
+      merged = cls.merge_external(style_file, data, revision, journaled)
+      if merged is None:
+        return None
+      data, journaled, version = merged
+    new_hash = StyleFile.content_hash(data)
+    clone = StyleFile.saved_form(data) if new_hash!=style_file.saved_hash else None
+    if clone is not None:
+      file_changes = journal.diff(journaled, clone)
+      reordered = not journaled[name_column].reset_index(drop=True).equals(clone[name_column].reset_index(drop=True))
+    with cls.save_lock:
+      if style_file.journaled is not journaled:
+        style_file.dirty = True
+        scheduler.set_pending("save")
+        return None
+      style_file.version = version
+      if clone is None:
+        return None
+      style_file.journaled = clone
+    return (style_file, clone, new_hash, file_changes, reordered, journaled, version)
+
+  @classmethod
+  def merge_external(cls, style_file:StyleFile, data:pd.DataFrame, revision:int, journaled:pd.DataFrame):
+    """
+    Bring in the changes made to a style file by something else since we last read or wrote it (journaled), 
+    except to styles we have changed since then (in data, a view at revision). Reading and diffing is done
+    outside the save lock; if the style file is edited meanwhile, nothing is merged and it is left dirty to
+    try again. Returns the merged (data, journaled, version), or None.
+    """
+    try:
+      disk, version = cls.storage.load(style_file.prefix)
+    except Exception as e:
+      print(f"Style Editor couldn't read {style_file.prefix or 'the master style file'} to merge changes ({e}), it will be rewritten")
+      return data, journaled, None
+    disk = disk.fillna('')[columns]
+    theirs = journal.diff(journaled, disk)
+    if theirs:
+      ours = journal.diff(journaled, StyleFile.saved_form(data))
+      mine = set(name for kind in ours.values() for name in kind)
+      theirs_only = { kind:{ name:values for name, values in changed.items() if not name in mine } for kind, changed in theirs.items() }
+    with cls.save_lock:
+      if style_file.journaled is not journaled or (theirs and style_file.revision!=revision):
+        style_file.dirty = True
+        scheduler.set_pending("save")
+        return None
+      if theirs:
+        style_file.apply_changes(theirs_only)
+        style_file.fix_duplicates()
+        data = style_file.view()
+      style_file.journaled = disk
+      style_file.version = version
+    if theirs:
+      cls.journal.record("external", {style_file.prefix:theirs})
+    return data, disk, version
+
+  @classmethod
+  def update_cache(cls):
+    """
+    Bring the sidecar cache up to date with the loaded style files that have no unsaved changes
+    """
+    if not cls.cache:
+      return
+    with cls.save_lock:
+      files = [(style_file.prefix, style_file.version, style_file.journaled, style_file.saved_hash) 
+                for style_file in cls.loaded_styles.values() if not style_file.dirty]
+    for prefix, version, journaled, content_hash in files:
+      cls.cache.save(prefix, version, journaled, content_hash)
+
+  @classmethod
+  def journal_checkpoint(cls):
+    """
+    Snapshot the style files as they are on disk into the backup store, and note it in the journal
+    """
+    try:
+      name = cls.backup_store.snapshot(cls._read_style_files(), checkpoint=True)
+      for dropped in cls.journal.add_checkpoint(name):
+        cls.backup_store.remove(dropped)
+    except Exception as e:
+      print(f"Style Editor couldn't checkpoint the journal ({e})")
+
+  @classmethod
+  def undo(cls) -> bool:
+    """
+    Undo the most recent change made this session. Returns False if there was nothing to undo.
+    """
+    return cls._replay(cls.journal.pop_undo, inverse=True, operation="undo")
+
+  @classmethod
+  def redo(cls) -> bool:
+    """
+    Redo the most recently undone change. Returns False if there was nothing to redo.
+    """
+    return cls._replay(cls.journal.pop_redo, inverse=False, operation="redo")
+
+  @classmethod
+  def _replay(cls, pop, inverse:bool, operation:str) -> bool:
+    cls.flush()
+    with cls.save_lock:
+      files = pop()
+      if files is None:
+        return False
+      for prefix, changes in files.items():
+        if prefix!='':
+          cls.create_file_if_missing(prefix)
+        cls.style_file(prefix).apply_changes(changes, inverse)
+        cls.mark_dirty(prefix, operation)
+    cls.flush()
+    return True
+
+  @classmethod
+  def restore_to_time(cls, timestamp:float):
+    """
+    Rebuild the master and additional style files as they were at timestamp, by replaying the journal 
+    from the last checkpoint before then. Additional style files that didn't exist then are deleted.
+    The current files are backed up first. Returns an error message, or None.
+    """
+    before = cls._before_rewrite()
+    cls.backup_later(before)
+    checkpoint, records = cls.journal.replay_plan(timestamp)
+    if checkpoint is None:
+      return "The journal doesn't go back that far (or encryption was on then)"
+    try:
+      files = { prefix:parse_csv(data) for prefix, data in cls.backup_store.read(checkpoint, None).items() }
+    except Exception as e:
+      return f"Failed to read checkpoint {checkpoint} ({e})"
+    files = { prefix:data.drop_duplicates(subset=name_column) for prefix, data in files.items() }
+    rows = { prefix:dict(zip(data[name_column], data[['prompt','negative_prompt']].values.tolist())) for prefix, data in files.items() }
+    for record in records:
+      for prefix, changes in record['files'].items():
+        journal.apply_changes(rows.setdefault(prefix, {}), changes)
+    with cls.save_lock:
+      for prefix in Additionals.prefixes():
+        if not prefix in rows:
+          cls.discard_styles(prefix)
+          cls.storage.delete(prefix)
+      for prefix, styles in rows.items():
+        cls.storage.write_bytes(prefix, to_csv(pd.DataFrame([[name, *values] for name, values in styles.items()], columns=columns)))
+    cls._after_rewrite(before, "restore")
+    return None
+
+  @classmethod
+  def _before_rewrite(cls) -> Dict[str,bytes]:
+    """
+    Call before replacing style files on disk (restoring). Returns the current contents, for _after_rewrite.
+    """
+    cls.flush()
+    if cls.journal.needs_checkpoint():
+      cls.journal_checkpoint()
+    return cls._read_style_files()
+
+  @classmethod
+  def _after_rewrite(cls, before:Dict[str,bytes], operation:str):
+    """
+    Journal the changes made by replacing style files on disk
+    """
+    def parse(raw):
+      try:
+        return parse_csv(raw)
+      except Exception:
+        return pd.DataFrame(columns=columns)
+    after = cls._read_style_files()
+    changes = {}
+    for prefix in list(dict.fromkeys(list(before)+list(after))):
+      file_changes = journal.diff(parse(before.get(prefix, b'')), parse(after.get(prefix, b'')))
+      if file_changes:
+        changes[prefix] = file_changes
+    if changes:
+      cls.journal.record(operation, changes)
+
+  @classmethod
+  def push_to_webui(cls, clone:pd.DataFrame):
+    """
+    Apply the styles that were added, changed or removed in the master style file directly to
+    the webui's style database, instead of having it reread and parse the whole file. The new dictionary is
+    built aside and swapped in at once, as webui threads may be reading the old one. If that isn't possible, 
+    fall back to a single reload.
+    """
+    prompt_styles = webui.prompt_styles()
+    if prompt_styles is None:
+      return
+    try:
+      from modules.styles import PromptStyle
+      path = cls.default_style_file_path
+      def make_style(name, prompt, negative_prompt):
+        values = {'name':name, 'prompt':prompt, 'negative_prompt':negative_prompt, 'path':path}
+        return PromptStyle(*[values.get(field) for field in PromptStyle._fields])
+      def ours(style):
+        return getattr(style, 'path', path) in (path, None)
+
+      old = prompt_styles.styles
+      wanted = { name:(prompt, negative_prompt) for name, prompt, negative_prompt in 
+                  zip(clone[name_column].astype(str), clone['prompt'].astype(str), clone['negative_prompt'].astype(str)) }
+      def updated(name, prompt, negative_prompt):
+        style = old.get(name)
+        return style if style is not None and style.prompt==prompt and style.negative_prompt==negative_prompt else make_style(name, prompt, negative_prompt)
+      styles = {}
+      for name, style in old.items():
+        if name in wanted:
+          styles[name] = updated(name, *wanted[name])
+        elif not ours(style):
+          styles[name] = style
+      for name, values in wanted.items():
+        if not name in styles:
+          styles[name] = updated(name, *values)
+      if [name for name, style in styles.items() if ours(style)] != list(wanted):
+        others = {name:style for name, style in styles.items() if not ours(style)}
+        styles = {**others, **{name:styles[name] for name in wanted}}
+      prompt_styles.styles = styles
+    except Exception as e:
+      print(f"Style Editor couldn't update styles in place ({e}), reloading")
+      metrics.count("webui_reloads")
+      prompt_styles.reload()
+
+  @classmethod
+  def style_file(cls, prefix='') -> StyleFile:
     """
     If prefix is '', this is the default style file.
-    Load or retrieve from cache
+    Retrieve from cache, or load if it isn't cached or the file has been changed by something else.
+    Files with unsaved changes are never reloaded.
     """
-    if not prefix in cls.loaded_styles:
-      cls.loaded_styles[prefix] = StyleFile(prefix)
-    return cls.loaded_styles[prefix].data.copy()
-  
+    with cls.save_lock:
+      style_file = cls.loaded_styles.get(prefix)
+      if style_file is None or (not style_file.dirty and style_file.changed_on_disk()):
+        style_file = cls._adopt(style_file, StyleFile(prefix))
+      else:
+        metrics.count("style_cache", result="hit")
+      return style_file
+
   @classmethod
-  def save_current_styles(cls, data):
-    cls.save_styles(data, cls._current_prefix())
-    
+  def _adopt(cls, old:StyleFile, style_file:StyleFile) -> StyleFile:
+    """
+    Put a newly loaded style file in the cache in place of old (None if it wasn't loaded), noting any changes 
+    made by something else in the journal. Call holding the save lock.
+    """
+    metrics.count("style_cache", result="miss" if old is None else "stale")
+    cls.loaded_styles[style_file.prefix] = style_file
+    cls.note_file(style_file)
+    if old is not None:
+      changes = journal.diff(old.journaled, style_file.journaled)
+      if changes:
+        cls.journal.record("external", {style_file.prefix:changes})
+    return style_file
+
   @classmethod
-  def save_styles(cls, data:pd.DataFrame, prefix=''):
-    if not prefix in cls.loaded_styles:
-      cls.loaded_styles[prefix] = StyleFile(prefix)
-    cls.loaded_styles[prefix].data = data
-    cls.loaded_styles[prefix].save()
-    
-    cls.update_notes_dictionary(data, prefix)
-    cls.save_notes_dictionary()
-    prompt_styles.reload()
+  def for_each_file(cls, method, prefixes:List[str]) -> Tuple[Dict[str,object],Dict[str,Exception]]:
+    """
+    Call method(prefix) for each prefix, on up to max_workers threads at once, so that many small files 
+    (on a slow or network disk in particular) are read or written concurrently rather than one after another.
+    Returns {prefix : result} for the calls that worked and {prefix : exception} for those that raised, in the order of prefixes.
+    The caller may be holding the save lock, so method mustn't wait for it.
+    """
+    def call(prefix):
+      try:
+        return prefix, method(prefix), None
+      except Exception as e:
+        return prefix, None, e
+    outcomes = None
+    if len(prefixes)>1 and cls.max_workers>1:
+      try:
+        with futures.ThreadPoolExecutor(max_workers=min(cls.max_workers, len(prefixes)), thread_name_prefix="style_editor_files") as pool:
+          outcomes = list(pool.map(call, prefixes))
+      except RuntimeError: # no new threads while the interpreter is shutting down (the last flush)
+        pass
+    if outcomes is None:
+      outcomes = [call(prefix) for prefix in prefixes]
+    results, errors = {}, {}
+    for prefix, result, error in outcomes:
+      if error is None:
+        results[prefix] = result
+      else:
+        errors[prefix] = error
+    return results, errors
+
+  @classmethod
+  def _fresh_style_file(cls, prefix:str, loaded:StyleFile) -> StyleFile:
+    """
+    The style file read again from storage, or None if loaded (the one in the cache) is up to date or has unsaved changes.
+    Raises the exception if it can't be read. Doesn't take the save lock, so it can be used with for_each_file.
+    """
+    if loaded is not None and (loaded.dirty or not loaded.changed_on_disk()):
+      return None
+    style_file = StyleFile(prefix)
+    if style_file.load_error is not None:
+      raise style_file.load_error
+    return style_file
+
+  @classmethod
+  def _adopt_all(cls, loaded:Dict[str,StyleFile], fresh:Dict[str,StyleFile]):
+    """
+    Put the style files read by _fresh_style_file into the cache, unless the ones they were read to replace (loaded) 
+    have since been replaced or changed
+    """
+    with cls.save_lock:
+      for prefix, style_file in fresh.items():
+        old = loaded[prefix]
+        if isinstance(style_file, StyleFile) and cls.loaded_styles.get(prefix) is old and not (old is not None and old.dirty):
+          cls._adopt(old, style_file)
+
+  @classmethod
+  def get_styles(cls, prefix='') -> pd.DataFrame:
+    """
+    The styles in the file (prefix '' is the default style file). This is a view sharing the style file's columns,
+    which later changes don't affect; treat it as read-only.
+    """
+    with cls.save_lock:
+      return cls.style_file(prefix).view()
   
-  @staticmethod
-  def create_file_if_missing(filename):
-    filename = Additionals.full_path(filename)
-    if not os.path.exists(filename):
-      print("", file=open(filename,"w"))
+  @classmethod
+  def save_styles(cls, data:pd.DataFrame, prefix='', operation="save"):
+    """
+    Replace the styles in a file (see StyleFile.replace_rows); nothing happens if they are the same
+    """
+    with cls.save_lock:
+      if not cls.style_file(prefix).replace_rows(data):
+        return
+      cls.mark_dirty(prefix, operation)
+    cls.update_notes(data, prefix)
+  
+  @classmethod
+  def conflicts(cls, style_file:StyleFile, seen:Dict[object,int]) -> List:
+    """
+    The labels (from seen, {label : revision}) of rows that have been removed, or changed since the given revision
+    """
+    return [label for label, revision in seen.items() if not label in style_file.data.index or style_file.row_revision(label)>revision]
 
-  @staticmethod
-  def add_or_replace(array:np.ndarray, row):
-    for i in range(len(array)):
-      if array[i][1] == row.iloc[1]:
-        array[i] = row
-        return array
-    return np.vstack([array,row])
-
-  @classmethod
-  def update_additional_style_files(cls):
-    additional_files_as_numpy = { prefix : FileManager.get_styles(prefix=prefix).to_numpy() for prefix in Additionals.additional_style_files(include_new=False, display_names=True) }
-    for _, row in cls.get_styles().iterrows():
-      prefix, row.iloc[1] = Additionals.split_stylename(row.iloc[1])
-      if prefix:
-        if prefix in additional_files_as_numpy:
-          additional_files_as_numpy[prefix] = cls.add_or_replace(additional_files_as_numpy[prefix], row)
-        else:
-          additional_files_as_numpy[prefix] = np.vstack([row])
-    for prefix in additional_files_as_numpy:
-      cls.save_styles(pd.DataFrame(additional_files_as_numpy[prefix], columns=display_columns), prefix=prefix)
-
-  @classmethod
-  def merge_additional_style_files(cls):
-    styles = cls.get_styles('')
-    styles = styles.drop(index=[i for (i, row) in styles.iterrows() if Additionals.has_prefix(row.iloc[1])])
-    for prefix in Additionals.prefixes():
-      styles_with_prefix = cls.get_styles(prefix=prefix).copy()
-      if len(styles_with_prefix)==0:
-        os.remove(Additionals.full_path(prefix))
+  @classmethod
+  def edit_styles(cls, prefix:str, edits:List[Tuple[object,str,str]], autosort=False, seen:Dict[object,int]=None):
+    """
+    Apply (row label, column, value) edits to a style file without a full round trip of the table.
+    If seen ({label : revision}) is given, edits to rows changed since that revision are rejected (unless they 
+    wouldn't change anything). Returns a list of (label, values) for the rows that changed, a flag which is True if
+    the rows were reordered (in which case the client needs the whole table again), and the labels of rejected edits.
+    """
+    with cls.save_lock:
+      style_file = cls.style_file(prefix)
+      conflicts = cls.conflicts(style_file, seen or {})
+      rejected = [label for label, column, value in edits if label in conflicts and
+                    not (label in style_file.data.index and str(style_file.data.at[label, column])==value)]
+      edits = [edit for edit in edits if not edit[0] in conflicts]
+      renamed = [label for label, column, _ in edits if column==name_column and label in style_file.data.index]
+      old_names = style_file.data.loc[renamed, name_column].copy()
+      changed = style_file.apply_edits(edits)
+      if len(changed)==0:
+        return [], False, rejected
+      cls.move_notes(old_names, style_file.data.loc[renamed, name_column], prefix)
+      rows = [(label, [str(x) for x in style_file.data.loc[label]]) for label in changed]
+      reordered = False
+      if autosort and any(column=='sort' for _, column, _ in edits):
+        order = style_file.data.index
+        style_file.sort()
+        reordered = not style_file.data.index.equals(order)
+      cls.mark_dirty(prefix, "edit")
+      cls.update_notes(style_file.data.loc[changed], prefix)
+    return rows, reordered, rejected
+
+  @classmethod
+  def save_page(cls, prefix:str, page:pd.DataFrame, labels:List, autosort=False, seen:Dict[object,int]=None) -> List:
+    """
+    Save a page of the grid back into a style file. labels are the row labels of the page when
+    it was shown; rows after those are new rows. If seen ({label : revision}) is given, rows that have been
+    changed since then are left alone. Returns the labels of the rows left alone.
+    """
+    with cls.save_lock:
+      style_file = cls.style_file(prefix)
+      conflicts = cls.conflicts(style_file, seen or {})
+      if conflicts:
+        labels = labels[:len(page)]
+        keep = [i for i, label in enumerate(labels) if not label in conflicts]
+        page = pd.concat([page.iloc[keep], page.iloc[len(labels):]])
+        labels = [labels[i] for i in keep]
+      old_names = style_file.data[name_column].reindex(labels)
+      changed = style_file.set_rows(labels, page)
+      cls.move_notes(old_names, style_file.data[name_column].reindex(labels), prefix)
+      if autosort:
+        style_file.sort()
+      cls.mark_dirty(prefix, "edit")
+      cls.update_notes(style_file.data.loc[changed], prefix)
+    return conflicts
+
+  @classmethod
+  def create_file_if_missing(cls, prefix):
+    cls.storage.create(Additionals.display_name(prefix))
+
+  @classmethod
+  def note_file(cls, style_file:StyleFile):
+    """
+    Remember the version and content hash of a style file as loaded or saved
+    """
+    cls.file_meta[style_file.prefix] = {"version":style_file.version, "hash":style_file.saved_hash, "count":len(style_file.data)}
+    cls.file_meta_dirty = True
+
+  @classmethod
+  def save_file_meta(cls):
+    if cls.file_meta_dirty:
+      cls.file_meta_dirty = False
+      with open(cls.file_meta_path+".tmp", 'w') as f:
+        json.dump(cls.file_meta, f)
+      os.replace(cls.file_meta_path+".tmp", cls.file_meta_path)
+
+  @classmethod
+  def in_sync(cls, prefix:str, content_hash:str) -> bool:
+    """
+    True if the additional style file hasn't been changed since we last loaded or saved it (and, if it is loaded,
+    has no unsaved changes), and held rows with this content hash then. So it doesn't need to be read or updated.
+    """
+    style_file = cls.loaded_styles.get(prefix)
+    if style_file is not None:
+      if style_file.dirty or style_file.saved_hash!=content_hash:
+        return False
+      changed, _ = cls.storage.check(prefix, style_file.version)
+      return not changed
+    meta = cls.file_meta.get(prefix)
+    if meta is None or meta['hash']!=content_hash:
+      return False
+    version = meta['version']
+    changed, _ = cls.storage.check(prefix, tuple(version) if isinstance(version, list) else version)
+    return not changed
+
+  @classmethod
+  def match_counts(cls, text:str, filter_type:str, prefixes:List[str]) -> Dict[str,int]:
+    """
+    The number of rows matching the filter in each of these style files ('' is the master). Additional style files
+    that aren't loaded are counted from their prefix::name rows in the master (which hold the same styles once
+    update_additional_style_files has run), so counting doesn't load and index every file.
+    """
+    with cls.save_lock:
+      master = cls.style_file('')
+      rows = master.data if text=='' else master.narrow(text, filter_type)
+      split = rows[name_column].str.split('::', n=1, expand=True)
+      if split.shape[1]<2:
+        in_files = pd.Series(dtype=object)
       else:
-        styles_with_prefix[name_column] = [Additionals.merge_name(prefix,x) for x in styles_with_prefix[name_column]]
-        styles = pd.concat([styles, styles_with_prefix], ignore_index=True)
-    styles['sort'] = [i+1 for i in range(len(styles['sort']))]
-    cls.save_styles(styles)
+        prefixed = split[1].notna()
+        unprefixed = rows[prefixed].assign(**{name_column: split[1][prefixed]})
+        in_files = split[0][prefixed][matches(unprefixed, text, filter_type)].value_counts()
+      counts = {}
+      for prefix in prefixes:
+        if prefix=='':
+          counts[prefix] = len(master.find(text, filter_type))
+        elif prefix in cls.loaded_styles:
+          counts[prefix] = len(cls.loaded_styles[prefix].find(text, filter_type))
+        else:
+          counts[prefix] = int(in_files.get(prefix, 0))
+      return counts
+
+  @staticmethod
+  def _prefixed_groups(master:pd.DataFrame) -> Dict[str,pd.DataFrame]:
+    """
+    The prefix::name rows of the master style file, as {prefix : rows with just the name}
+    """
+    master = master.drop_duplicates(subset=name_column)
+    split = master[name_column].str.split('::', n=1, expand=True)
+    if split.shape[1]<2:
+      return {}
+    prefixed = split[1].notna()
+    rows = master[prefixed].copy()
+    rows[name_column] = split[1][prefixed]
+    return { prefix:group for prefix, group in rows.groupby(split[0][prefixed], sort=False) }
+
+  @classmethod
+  def update_additional_style_files(cls) -> Dict[str,Exception]:
+    """
+    Copy the prefix::name rows in the master style file into the additional style files.
+    Files are marked dirty, but only written if their contents actually changed.
+    Files which already hold exactly those rows aren't loaded; the others are read concurrently (see for_each_file).
+    A file that can't be read is left alone. Returns {prefix : exception} for those.
+    """
+    with cls.save_lock:
+      master = cls.style_file('')
+      revision, groups, hashes = master.revision, master.prefixed_groups(), master.group_hashes()
+      loaded = { prefix:cls.loaded_styles.get(prefix) for prefix in groups }
+
+    def read(prefix):
+      if cls.in_sync(prefix, hashes[prefix]):
+        return False
+      cls.create_file_if_missing(prefix)
+      return cls._fresh_style_file(prefix, loaded[prefix])
+    fresh, errors = cls.for_each_file(read, list(groups))
+
+    with cls.save_lock:
+      cls._adopt_all(loaded, fresh)
+      master = cls.style_file('')
+      if master.revision!=revision:
+        groups, hashes, fresh = master.prefixed_groups(), master.group_hashes(), {}
+      for prefix, group in groups.items():
+        if prefix in errors or fresh.get(prefix) is False or (not prefix in fresh and cls.in_sync(prefix, hashes[prefix])):
+          continue
+        if not prefix in fresh:
+          cls.create_file_if_missing(prefix)
+        cls.style_file(prefix).upsert(group)
+        cls.mark_dirty(prefix)
+    for prefix, error in errors.items():
+      print(f"Style Editor couldn't update {prefix} ({error})")
+    return errors
 
   @classmethod
-  def _current_prefix(cls):
-    return Additionals.display_name(cls.current_styles_file_path)
+  def merge_additional_style_files(cls) -> Dict[str,Exception]:
+    """
+    Rebuild the master style file from its unprefixed rows and the contents of the additional style files.
+    Empty additional style files are deleted. Files that are in sync with the master's rows aren't loaded;
+    the others are read concurrently (see for_each_file). For a file that can't be read, the master's rows with 
+    its prefix are kept as they are. Returns {prefix : exception} for those files (and any that couldn't be deleted).
+    If every file is in sync and the master is already in merged order, nothing needs to change.
+    """
+    with cls.save_lock:
+      master_file = cls.style_file('')
+      master, groups, hashes = master_file.data, master_file.prefixed_groups(), master_file.group_hashes()
+      prefixes = Additionals.prefixes()
+      loaded = { prefix:cls.loaded_styles.get(prefix) for prefix in prefixes }
+    no_rows = master.iloc[:0]
+    rows = { prefix:groups.get(prefix, no_rows) for prefix in prefixes }
+
+    def read(prefix):
+      if cls.in_sync(prefix, hashes[prefix] if prefix in hashes else StyleFile.content_hash(no_rows)):
+        return False
+      return cls._fresh_style_file(prefix, loaded[prefix])
+    fresh, errors = cls.for_each_file(read, prefixes)
+    cls._adopt_all(loaded, fresh)
+
+    parts = { '':master[~master[name_column].str.contains('::', regex=False)] }
+    empty = []
+    for prefix, in_master in rows.items():
+      styles_with_prefix = in_master if prefix in errors or fresh[prefix] is False else cls.style_file(prefix).data
+      if len(styles_with_prefix)>0:
+        parts[prefix] = styles_with_prefix
+      elif not prefix in errors:
+        cls.discard_styles(prefix)
+        empty.append(prefix)
+    errors.update(cls.for_each_file(cls.storage.delete, empty)[1])
+    unchanged = len(empty)==0 and all(prefix in errors or fresh[prefix] is False for prefix in rows) and \
+                  parts[''].index.append([part.index for prefix, part in parts.items() if prefix!='']).equals(master.index) and \
+                  list(master['sort'])==list(range(1, len(master)+1))
+    if not unchanged:
+      styles = pd.concat([part if prefix=='' else part.assign(**{name_column: prefix + "::" + part[name_column]}) for prefix, part in parts.items()], ignore_index=True)
+      styles['sort'] = range(1, len(styles)+1)
+      cls.save_styles(styles, operation="merge")
+    for prefix, error in errors.items():
+      print(f"Style Editor couldn't merge {prefix} ({error})")
+    return errors
 
   @classmethod
   def move_to_additional(cls, maybe_prefixed_style, new_prefix):
-    old_prefixed_style = Additionals.prefixed_style(maybe_prefixed_style, cls._current_prefix())
-    new_prefixed_style = Additionals.prefixed_style(maybe_prefixed_style, new_prefix, force=True)
-    data = cls.get_styles()
-    data[name_column] = data[name_column].str.replace(old_prefixed_style, new_prefixed_style)
-    cls.save_styles(data)
-    cls.remove_from_additional(old_prefixed_style)
-    cls.update_additional_style_files()
+    cls.bulk_operations([("move", maybe_prefixed_style, new_prefix)])
 
   @classmethod
   def remove_style(cls, maybe_prefixed_style):
-    prefixed_style = Additionals.prefixed_style(maybe_prefixed_style, cls._current_prefix())
-    data = cls.get_styles()
-    rows_to_drop = [i for (i, row) in data.iterrows() if row.iloc[1]==prefixed_style]
-    cls.save_styles(data.drop(index=rows_to_drop))
-    cls.remove_from_additional(prefixed_style)
-    cls.update_additional_style_files()
+    cls.bulk_operations([("delete", maybe_prefixed_style, None)])
 
   @classmethod
   def duplicate_style(cls, maybe_prefixed_style):
-    prefixed_style = Additionals.prefixed_style(maybe_prefixed_style, cls._current_prefix())
-    data = cls.get_styles()
-    new_rows = pd.DataFrame([row for (i, row) in data.iterrows() if row.iloc[1]==prefixed_style])
-    data = pd.concat([data, new_rows], ignore_index=True)
-    data = StyleFile.sort_dataset(data)
-    cls.save_styles(data)
-    cls.update_additional_style_files()
+    cls.bulk_operations([("duplicate", maybe_prefixed_style, None)])
+
+  @classmethod
+  def bulk_operations(cls, operations:List[Tuple[str,str,str]], prefix='') -> List[str]:
+    """
+    Apply a list of (operation, style, new_prefix) as one batch. Operation is "delete", "duplicate" or "move" 
+    (new_prefix is only used by "move"); unprefixed styles are taken to be in the file with this prefix. All of the operations are applied to the loaded styles while holding
+    the save lock, so the background writer sees none or all of them, and each touched file is written once.
+    Returns a list with None for each operation that succeeded, or an error message.
+    """
+    results = []
+    with cls.save_lock:
+      for operation, maybe_prefixed_style, new_prefix in operations:
+        prefixed_style = Additionals.prefixed_style(maybe_prefixed_style, prefix)
+        match operation:
+          case "delete":
+            done = cls._remove_from_master(prefixed_style)
+            done = cls.remove_from_additional(prefixed_style) or done
+          case "duplicate":
+            done = cls._duplicate_in_master(prefixed_style)
+          case "move":
+            done = cls._rename_in_master(prefixed_style, Additionals.prefixed_style(maybe_prefixed_style, new_prefix, force=True))
+            cls.remove_from_additional(prefixed_style)
+          case _:
+            results.append(f"Unknown operation {operation}")
+            continue
+        results.append(None if done else f"No style called {prefixed_style}")
+        if done:
+          cls.operations.add(operation)
+      cls.update_additional_style_files()
+    return results
+
+  @classmethod
+  def _remove_from_master(cls, prefixed_style) -> bool:
+    if cls.style_file('').remove(prefixed_style):
+      cls.mark_dirty('')
+      return True
+    return False
 
   @classmethod
-  def remove_from_additional(cls, maybe_prefixed_style):
+  def _duplicate_in_master(cls, prefixed_style) -> bool:
+    master = cls.style_file('')
+    label = master.duplicate(prefixed_style)
+    if label is None:
+      return False
+    cls.mark_dirty('')
+    cls.update_notes(master.data.loc[[label]], '')
+    return True
+
+  @classmethod
+  def _rename_in_master(cls, prefixed_style, new_prefixed_style) -> bool:
+    new_name = cls.style_file('').rename(prefixed_style, new_prefixed_style)
+    if new_name is None:
+      return False
+    cls.notes.rename(prefixed_style, new_name)
+    cls.mark_dirty('')
+    return True
+
+  @classmethod
+  def remove_from_additional(cls, maybe_prefixed_style) -> bool:
     prefix, style = Additionals.split_stylename(maybe_prefixed_style)
     if prefix:
-      data = cls.get_styles(prefix)
-      data = data.drop(index=[i for (i, row) in data.iterrows() if row.iloc[1]==style])
-      cls.save_styles(data, prefix=prefix)
+      with cls.save_lock:
+        if cls.style_file(prefix).remove(style):
+          cls.mark_dirty(prefix)
+          return True
+    return False
+
+  @classmethod
+  def search_and_replace(cls, search:str, replace:str, regex:bool, columns:List[str], prefixes:List[str], dry_run=False) -> Dict[str,Dict[str,int]]:
+    """
+    Replace search with replace in the given columns (from user_columns) of the given style files ('' is the master file).
+    Returns {prefix : {column : number of replacements}} for the files and columns with any.
+    If dry_run is True, just count.
+
+    Rows are narrowed down with the text index if it is ready (the count in each column is the real check) and then replaced with vectorised str.replace.
+    Replacements in additional style files are copied to the master file, and replacements in the master file 
+    are copied to the additional style files. Master rows with the prefix of a selected additional file are left
+    to that file, so no style gets replaced twice. Raises re.error for a bad regex.
+    Unless regex is True, replace is used as it is (backslashes aren't escapes or group references).
+    """
+    pattern = search if regex else re.escape(search)
+    re.compile(pattern)
+    additional = [prefix for prefix in prefixes if prefix!='']
+    counts = {}
+    with cls.save_lock:
+      for prefix in additional + ([''] if '' in prefixes else []):
+        style_file = cls.style_file(prefix)
+        rows = style_file.narrow(search, "regex" if regex else "Exact match")
+        if prefix=='' and len(additional)>0:
+          row_prefixes = rows[name_column].str.split('::', n=1).str[0].where(rows[name_column].str.contains('::', regex=False))
+          rows = rows[~row_prefixes.isin(additional)]
+        changed = rows.index[:0]
+        for column in columns:
+          hits = rows[column].astype(str).str.count(pattern)
+          if hits.sum()>0:
+            counts.setdefault(prefix, {})[column] = int(hits.sum())
+            if not dry_run:
+              style_file.replace_values(column, rows.loc[hits>0, column].astype(str).str.replace(search if not regex else pattern, replace, regex=regex))
+              changed = changed.union(hits.index[hits>0], sort=False)
+        if dry_run or len(changed)==0:
+          continue
+        changed = style_file.data.loc[changed]
+        cls.mark_dirty(prefix, "replace")
+        if 'notes' in counts[prefix]:
+          cls.update_notes(changed, prefix)
+        if prefix!='':
+          cls.style_file('').upsert(changed.assign(**{name_column: prefix + "::" + changed[name_column]}))
+          cls.mark_dirty('')
+      if not dry_run and '' in counts:
+        cls.update_additional_style_files()
+    return counts
+
+  @classmethod
+  def backup_retention(cls) -> Dict[str,int]:
+    return { bucket:int(webui.option(f"style_editor_backups_{bucket}", default)) for bucket, default in BackupStore.default_retention.items() }
+
+  @classmethod
+  def backup_key(cls) -> str:
+    """
+    The key to encrypt backups with, or None if encryption is off
+    """
+    return cls.encrypt_key if cls.encrypt and len(cls.encrypt_key)>0 else None
 
   @classmethod
   def do_backup(cls):
-    fileroot = os.path.join(cls.backup_directory, datetime.datetime.now().strftime("%y%m%d_%H%M"))
-    if not os.path.exists(cls.default_style_file_path):
-      return
-    shutil.copyfile(cls.default_style_file_path, fileroot+".csv")
-    paths = sorted(Path(cls.backup_directory).iterdir(), key=os.path.getmtime, reverse=True)
-    for path in paths[24:]:
-      os.remove(str(path))
-    if cls.encrypt and len(cls.encrypt_key)>0:
-      try:
-        pyAesCrypt.encryptFile(fileroot+".csv", fileroot+".csv.aes", cls.encrypt_key)
-        os.remove(fileroot+".csv")
-      except:
-        print("Failed to encrypt")
+    """
+    Snapshot the master and additional style files into the backup store, after any contents queued by backup_later
+    """
+    cls.flush()
+    with cls.save_lock:
+      queued, cls.queued_backups = cls.queued_backups, []
+    if cls.storage.exists(''):
+      queued.append(cls._read_style_files())
+    try:
+      for files in queued:
+        cls.backup_store.snapshot(files, cls.backup_key(), cls.backup_retention())
+    except Exception as e:
+      print(f"Style Editor backup failed ({e})")
+
+  @classmethod
+  def backup_later(cls, files:Dict[str,bytes]):
+    """
+    Back up these file contents ({prefix : bytes}) with the next background backup, so the caller
+    doesn't wait for them to be compressed and encrypted
+    """
+    with cls.save_lock:
+      cls.queued_backups.append(files)
+    if "backup" in scheduler.jobs:
+      scheduler.set_pending("backup")
+    else:
+      cls.do_backup()
+
+  @classmethod
+  def _read_style_files(cls) -> Dict[str,bytes]:
+    """
+    The contents of the master and additional style files on disk, as {prefix : bytes}
+    """
+    files, errors = cls.for_each_file(cls.storage.read_bytes, ['']+Additionals.prefixes())
+    for prefix, e in errors.items():
+      print(f"Style Editor couldn't read {prefix or 'the master style file'} ({e})")
+    return files
 
   @classmethod
   def list_backups(cls):
-    return [file for file in os.listdir(cls.backup_directory) if (file.endswith('csv') or file.endswith('aes'))]
+    return cls.backup_store.names()
 
   @classmethod
-  def backup_file_path(cls, file):
-    return os.path.join(cls.backup_directory, file)
+  def backup_file_path(cls, name):
+    return cls.backup_store.export(name, cls.encrypt_key)
   
   @classmethod
-  def restore_from_backup(cls, file):
-    path = cls.backup_file_path(file)
-    if not os.path.exists(path):
-      return "Invalid selection"
-    if os.path.splitext(file)[1]==".aes":
-      try:
-        temp = os.path.join(cls.backup_directory, "temp.aes")
-        temd = os.path.join(cls.backup_directory, "temp.csv")
-        shutil.copyfile(file,temp)
-        pyAesCrypt.decryptFile(temp, temd, cls.encrypt_key)
-        os.rename(temd, cls.default_style_file_path)
-      except:
-        error = "Failed to decrypt .aes file"
-      finally:
-        if os.path.exists(temp):
-          os.remove(temp)
-        if os.path.exists(temd):
-          os.remove(temd)
-    else:
-      shutil.copyfile(path, cls.default_style_file_path)
+  def restore_from_backup(cls, name):
+    """
+    Restore the master and additional style files from a snapshot. Returns an error message, or None
+    """
+    before = cls._before_rewrite()
+    try:
+      files = cls.backup_store.read(name, cls.encrypt_key)
+    except Exception as e:
+      return f"Failed to restore {name} ({e})"
+    for prefix, data in files.items():
+      cls.storage.write_bytes(prefix, data)
+    cls._after_rewrite(before, "restore")
     return None
-
   
   @classmethod
   def restore_from_upload(cls, tempfile):
-    error = None
-    if os.path.exists(cls.default_style_file_path):
-      if os.path.exists(cls.default_style_file_path+".temp"):
-        os.remove(cls.default_style_file_path+".temp")
-      os.rename(cls.default_style_file_path, cls.default_style_file_path+".temp")
-    if os.path.splitext(tempfile)[1]==".aes":
-      try:
-        pyAesCrypt.decryptFile(tempfile, cls.default_style_file_path, cls.encrypt_key)
-      except:
-        error = "Failed to decrypt .aes file"
-    elif os.path.splitext(tempfile)[1]==".csv":
-      os.rename(tempfile, cls.default_style_file_path)
-    else:
-      error = "Can only restore from .csv or .aes file"
-    if os.path.exists(cls.default_style_file_path+".temp"):    
-      if os.path.exists(cls.default_style_file_path):
-        os.remove(cls.default_style_file_path+".temp")
-      else:
-        os.rename(cls.default_style_file_path+".temp", cls.default_style_file_path)
-    return error
+    """
+    Replace the master style file with an uploaded .csv or .aes file (decrypted in memory). Returns an error message, or None
+    """
+    extension = os.path.splitext(tempfile)[1]
+    if not extension in (".csv", ".aes"):
+      return "Can only restore from .csv or .aes file"
+    try:
+      with open(tempfile, 'rb') as f:
+        if extension==".aes":
+          if pyAesCrypt is None:
+            return "Failed to decrypt .aes file (pyAesCrypt isn't installed)"
+          data = decrypt_from(f, cls.encrypt_key)
+        else:
+          data = f.read()
+    except Exception:
+      return "Failed to decrypt .aes file" if extension==".aes" else "Failed to read .csv file"
+    try:
+      if data.strip():
+        parse_csv(data)
+    except Exception as e:
+      return f"Not a valid style file ({e})"
+    before = cls._before_rewrite()
+    cls.storage.write_bytes('', data)
+    cls._after_rewrite(before, "restore")
+    return None
   
   @classmethod
-  def save_notes_dictionary(cls):
-    print(json.dumps(cls.notes_dictionary),file=open(os.path.join(cls.basedir, "notes.json"), 'w'))   
+  def update_notes(cls, data:pd.DataFrame, prefix:str):
+    cls.notes.update(data[name_column], data['notes'], prefix)
 
   @classmethod
-  def update_notes_dictionary(cls, data:pd.DataFrame, prefix:str):
-    for _, row in data.iterrows():
-      stylename = prefix+"::"+row.iloc[1] if prefix!='' else row.iloc[1]
-      cls.notes_dictionary[stylename] = row.iloc[4]
+  def move_notes(cls, old_names:pd.Series, new_names:pd.Series, prefix:str):
+    """
+    Move the notes of renamed styles (old_names and new_names have the same index; NaN for rows that didn't exist)
+    """
+    renamed = old_names.notna() & new_names.notna() & (old_names!=new_names)
+    for old, new in zip(old_names[renamed], new_names[renamed]):
+      cls.notes.rename(NotesStore.key(old, prefix), NotesStore.key(new, prefix))
 
-  @classmethod
-  def lookup_notes(cls, stylename, prefix):
-    stylename = prefix+"::"+stylename if prefix!='' else stylename
-    return cls.notes_dictionary[stylename] if stylename in cls.notes_dictionary else ''
\ No newline at end of file
+metrics.instrument(StyleFile, ["_load", "sort", "text_index", "find", "upsert", "apply_changes", "save", "snapshot", "write",
+                               "apply_edits", "set_rows", "fix_duplicates"])
+metrics.instrument(FileManager)
+
+scheduler.add_job("save", FileManager.flush, FileManager.write_delay, FileManager.max_write_delay)
+scheduler.add_job("index", FileManager.rebuild_text_indexes, 5, 30)
+scheduler.add_job("cache", FileManager.update_cache, 30, 300)
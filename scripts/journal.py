@@ -0,0 +1,196 @@
+from __future__ import annotations
+import os, json, time, threading
+from typing import Dict, List, Tuple
+from scripts.shared import columns, name_column, lazy_import
+from scripts.metrics import metrics
+pd = lazy_import("pandas")
+
+def diff(old:pd.DataFrame, new:pd.DataFrame) -> Dict:
+  """
+  The changes between two versions of a style file (in saved form), keyed by style name:
+  {"removed":{name:[prompt, negative_prompt]}, "added":{...}, "changed":{name:[[before...],[after...]]}}
+  Empty if nothing changed (row order isn't recorded).
+  """
+  old = old[columns].drop_duplicates(subset=name_column)
+  new = new[columns].drop_duplicates(subset=name_column)
+  merged = old.merge(new, on=name_column, how='outer', suffixes=('_old','_new'), indicator=True)
+  before = ['prompt_old', 'negative_prompt_old']
+  after = ['prompt_new', 'negative_prompt_new']
+  removed = merged[merged['_merge']=='left_only']
+  added = merged[merged['_merge']=='right_only']
+  both = merged[merged['_merge']=='both']
+  changed = both[(both['prompt_old']!=both['prompt_new']) | (both['negative_prompt_old']!=both['negative_prompt_new'])]
+  changes = {}
+  if len(removed)>0:
+    changes['removed'] = dict(zip(removed[name_column], removed[before].values.tolist()))
+  if len(added)>0:
+    changes['added'] = dict(zip(added[name_column], added[after].values.tolist()))
+  if len(changed)>0:
+    changes['changed'] = dict(zip(changed[name_column], zip(changed[before].values.tolist(), changed[after].values.tolist())))
+  return changes
+
+def resolve(changes:Dict, inverse=False) -> Tuple[List[str],Dict[str,List[str]]]:
+  """
+  The names to remove, and the {name:[prompt, negative_prompt]} to set, to make the changes (or undo them if inverse is True)
+  """
+  removed, added = (changes.get('added', {}), changes.get('removed', {})) if inverse else (changes.get('removed', {}), changes.get('added', {}))
+  rows = dict(added)
+  rows.update({ name:(before if inverse else after) for name, (before, after) in changes.get('changed', {}).items() })
+  return list(removed), rows
+
+def apply_changes(rows:Dict[str,List[str]], changes:Dict, inverse=False):
+  """
+  Apply changes (from diff) to a dictionary of {name:[prompt, negative_prompt]}, or undo them if inverse is True
+  """
+  removed, updated = resolve(changes, inverse)
+  for name in removed:
+    rows.pop(name, None)
+  rows.update(updated)
+
+class Journal:
+  """
+  An append-only record of the changes made to the style files, one JSON object per line.
+
+  Change records are {"seq", "time", "operation", "files":{prefix:changes}}, where changes come from diff.
+  Checkpoint records {"seq", "time", "checkpoint":name} name a snapshot in the BackupStore holding all the
+  style files at that point, so the files at any later time can be rebuilt by replaying the changes after
+  the nearest checkpoint. Once there are more than max_checkpoints, the records before the second one are
+  dropped.
+
+  The changes recorded this session can be undone and redone. While persist is off (encryption is on) nothing
+  is written to disk, so the changes can still be undone but not replayed; a pause record marks the gap.
+  """
+  checkpoint_interval = 500
+  max_checkpoints = 5
+  undo_depth = 100
+
+  def __init__(self, path:str):
+    self.path = path
+    self.lock = threading.Lock()
+    self.seq = 0
+    self.checkpoints:List[Tuple[int,str]] = []
+    self.since_checkpoint = 0
+    self.recent:Dict[int,Dict] = {}
+    self.undoable:List[int] = []
+    self.redoable:List[int] = []
+    self.persist = True
+    for record in self.records():
+      self.seq = record['seq']
+      if 'checkpoint' in record:
+        self.checkpoints.append((record['seq'], record['checkpoint']))
+        self.since_checkpoint = 0
+      elif 'pause' in record:
+        self.since_checkpoint = self.checkpoint_interval
+      else:
+        self.since_checkpoint += 1
+
+  def records(self):
+    try:
+      with open(self.path, encoding="utf-8") as f:
+        for line in f:
+          try:
+            yield json.loads(line)
+          except json.JSONDecodeError:
+            pass # a partly written last line
+    except FileNotFoundError:
+      return
+
+  def _append(self, record:Dict) -> int:
+    self.seq += 1
+    if not self.persist:
+      return self.seq
+    record = { 'seq':self.seq, 'time':time.time(), **record }
+    line = json.dumps(record)+"\n"
+    with open(self.path, 'a', encoding="utf-8") as f:
+      f.write(line)
+    metrics.count("bytes_written", len(line), file="journal")
+    return self.seq
+
+  def set_persist(self, persist:bool):
+    """
+    Start or stop writing to disk. After a pause, a new checkpoint is needed before the changes can be replayed.
+    """
+    with self.lock:
+      if persist==self.persist:
+        return
+      if not persist:
+        self._append({'pause':True})
+        self.since_checkpoint = self.checkpoint_interval
+      self.persist = persist
+
+  def needs_checkpoint(self) -> bool:
+    return self.persist and (len(self.checkpoints)==0 or self.since_checkpoint>=self.checkpoint_interval)
+
+  def add_checkpoint(self, name:str) -> List[str]:
+    """
+    Record a checkpoint. Returns the names of any checkpoints that are no longer needed.
+    """
+    with self.lock:
+      self.checkpoints.append((self._append({'checkpoint':name}), name))
+      self.since_checkpoint = 0
+      if len(self.checkpoints)<=self.max_checkpoints:
+        return []
+      dropped = self.checkpoints[:-self.max_checkpoints]
+      self.checkpoints = self.checkpoints[-self.max_checkpoints:]
+      first = self.checkpoints[0][0]
+      kept = [json.dumps(record) for record in self.records() if record['seq']>=first]
+      with open(self.path+".tmp", 'w', encoding="utf-8") as f:
+        f.write("".join(line+"\n" for line in kept))
+      os.replace(self.path+".tmp", self.path)
+      return [name for _, name in dropped]
+
+  def record(self, operation:str, files:Dict[str,Dict]):
+    """
+    Append a change record. Changes made by undo and redo, or by something other than the Style Editor,
+    don't affect the undo and redo stacks.
+    """
+    with self.lock:
+      seq = self._append({'operation':operation, 'files':files})
+      self.since_checkpoint += 1
+      if operation in ("undo", "redo", "external"):
+        return
+      self.recent[seq] = files
+      self.undoable.append(seq)
+      self.redoable = []
+      for old in self.undoable[:-self.undo_depth]:
+        self.recent.pop(old, None)
+      self.undoable = self.undoable[-self.undo_depth:]
+
+  def pop_undo(self) -> Dict:
+    """
+    The changes to undo next (or None), which move to the redo stack
+    """
+    with self.lock:
+      if len(self.undoable)==0:
+        return None
+      seq = self.undoable.pop()
+      self.redoable.append(seq)
+      return self.recent[seq]
+
+  def pop_redo(self) -> Dict:
+    """
+    The changes to redo next (or None), which move back to the undo stack
+    """
+    with self.lock:
+      if len(self.redoable)==0:
+        return None
+      seq = self.redoable.pop()
+      self.undoable.append(seq)
+      return self.recent[seq]
+
+  def replay_plan(self, timestamp:float):
+    """
+    The name of the latest checkpoint at or before timestamp, and the change records after it up to timestamp.
+    Returns None, [] if there is no such checkpoint, or the journal was paused between it and timestamp.
+    """
+    checkpoint, changes = None, []
+    for record in self.records():
+      if record['time']>timestamp:
+        break
+      if 'checkpoint' in record:
+        checkpoint, changes = record['checkpoint'], []
+      elif 'pause' in record:
+        checkpoint, changes = None, []
+      elif checkpoint is not None:
+        changes.append(record)
+    return checkpoint, changes
@@ -0,0 +1,51 @@
+import os, contextlib, time, hashlib
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+  import msvcrt
+
+lock_directory:str = None
+
+def lock_path(path:str) -> str:
+  """
+  The file locked for path: in lock_directory (named from path's absolute path, so every process using the
+  same extension directory uses the same one) if it has been set, otherwise path.lock
+  """
+  if lock_directory is None:
+    return path+".lock"
+  return os.path.join(lock_directory, hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:16]+".lock")
+
+def use_lock_directory(directory:str):
+  """
+  Keep lock files in directory from now on
+  """
+  global lock_directory
+  os.makedirs(directory, exist_ok=True)
+  lock_directory = directory
+
+@contextlib.contextmanager
+def file_lock(path:str):
+  """
+  Hold an advisory exclusive lock on path (using the file from lock_path), so that other processes using the same files
+  (another webui sharing the styles, say) don't interleave their read-modify-write with ours
+  """
+  with open(lock_path(path), 'a+') as f:
+    if fcntl:
+      fcntl.flock(f, fcntl.LOCK_EX)
+    else:
+      f.seek(0)
+      while True:
+        try:
+          msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+          break
+        except OSError: # LK_LOCK gives up after 10 seconds
+          time.sleep(0.1)
+    try:
+      yield
+    finally:
+      if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+      else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
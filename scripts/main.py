@@ -1,19 +1,24 @@
 import gradio as gr
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Tuple
+from typing import Dict, List, Tuple
 import modules.scripts as scripts
-from modules import script_callbacks
+from modules import script_callbacks, shared
 
-import pandas as pd
-import threading
+import pandas as pd # not lazy_import: gradio (imported above) loads pandas anyway, and the handlers here take DataFrames
+import re, datetime, uuid
 
-from scripts.filemanager import FileManager, StyleFile
+from scripts.filemanager import FileManager
 from scripts.additionals import Additionals
-from scripts.background import Background
-from scripts.shared import display_columns
+from scripts.background import scheduler
+from scripts.backups import BackupStore
+from scripts.view import StyleView
+from scripts.metrics import metrics
+from scripts.executor import executor, Busy
+from scripts import webui
+from scripts.shared import display_columns, user_columns
 
 class Script(scripts.Script):
   def __init__(self) -> None:
@@ -34,6 +39,44 @@ class ParameterString(BaseModel):
 class ParameterBool(BaseModel):
   value: bool
 
+class CellEdit(BaseModel):
+  row: int
+  column: str
+  value: str
+
+class CellEdits(BaseModel):
+  edits: List[CellEdit]
+  autosort: bool = False
+  view_id: str = ''
+
+class ChangedRow(BaseModel):
+  row: int
+  values: List[str]
+
+class CellEditResult(BaseModel):
+  rows: List[ChangedRow]
+  refresh: bool
+  conflicts: List[int] = []
+
+class BulkOperation(BaseModel):
+  operation: str
+  style: str
+  new_prefix: str = ''
+
+class BulkOperations(BaseModel):
+  operations: List[BulkOperation]
+  view_id: str = ''
+
+class BulkResult(BaseModel):
+  style: str
+  ok: bool
+  error: str = ''
+
+class BulkResults(BaseModel):
+  results: List[BulkResult]
+
+scheduler.add_job("backup", FileManager.do_backup, 60, 600)
+
 class StyleEditor:
   update_help = """# Recent changes:
 ## Changed in this update:
@@ -54,71 +97,122 @@ class StyleEditor:
 
 `Backspace/Delete` to clear selected cell/delete row(s). Ctrl- or ⌘- `X` `C` `V` cut copy or paste selected cell (not row).
 `M` to move selected row(s). `D` to duplicate selected row(s)"""
-  backup = Background(FileManager.do_backup, 600)
-  api_calls_outstanding = []
-  api_lock = threading.Lock()
-  this_tab_selected = False
 
   @classmethod
-  def handle_this_tab_selected(cls):
-    FileManager.clear_style_cache()
+  def _page(cls, view_id):
+    """
+    Outputs for the grid, the page description and the page number
+    """
+    view = StyleView.get(view_id)
+    return view.current_page(), gr.Markdown.update(value=view.description()), view.page
+
+  @classmethod
+  def handle_load(cls):
+    """
+    Start the background jobs, and give the new session its own view id
+    """
+    scheduler.start()
+    return uuid.uuid4().hex
+
+  @classmethod
+  def handle_this_tab_selected(cls, view_id):
+    """
+    Split the master file into the additional style files; the session's tab_selected state becomes True
+    """
     FileManager.update_additional_style_files()
-    cls.this_tab_selected = True
-    return FileManager.get_current_styles()
+    return *cls._page(view_id), True
 
   @classmethod
-  def handle_another_tab_selected(cls):
-    if cls.this_tab_selected:
+  def handle_another_tab_selected(cls, tab_selected):
+    """
+    If this session was on the Style Editor tab, merge the additional style files back into the master file
+    """
+    if tab_selected:
       FileManager.merge_additional_style_files()
-      FileManager.clear_style_cache()
-    cls.this_tab_selected = False
+      FileManager.flush()
+    return False
  
   @classmethod
-  def handle_autosort_checkbox_change(cls, data:pd.DataFrame, autosort) -> pd.DataFrame:
+  def handle_autosort_checkbox_change(cls, autosort, view_id):
     if autosort:
-      data = StyleFile.sort_dataset(data)
-      FileManager.save_current_styles(data)
-    return data
+      prefix = StyleView.get(view_id).prefix
+      with FileManager.save_lock:
+        FileManager.style_file(prefix).sort()
+        FileManager.mark_dirty(prefix)
+    return cls._page(view_id)
+
+  @classmethod
+  def handle_dataeditor_input(cls, data:pd.DataFrame, autosort, view_id):
+    if len(data)==0:
+      # the edit was sent as a delta to /style-editor/edit-cells/ (see style_editor_grid_input)
+      return gr.Dataframe.update(), gr.Markdown.update(), gr.Number.update()
+    scheduler.set_pending("backup")
+    StyleView.get(view_id).save_page(data, autosort)
+    return cls._page(view_id)
+
+  @classmethod
+  def handle_view_change(cls, filter_text, filter_type, order, page_size, view_id):
+    view = StyleView.get(view_id)
+    view.filter_text, view.filter_type, view.order, view.page_size = filter_text, filter_type, order, int(page_size)
+    view.page = 1
+    return *cls._page(view_id), gr.Markdown.update(value=view.match_counts_description())
 
   @classmethod
-  def handle_dataeditor_input(cls, data:pd.DataFrame, autosort) -> pd.DataFrame:
-    cls.backup.set_pending()
-    data = StyleFile.sort_dataset(data) if autosort else data
-    FileManager.save_current_styles(data)
-    return data
+  def handle_page_change(cls, page, step, view_id):
+    view = StyleView.get(view_id)
+    view.page = int(page or 1) + step
+    return cls._page(view_id)
   
   @classmethod
-  def handle_search_and_replace_click(cls, search:str, replace:str, current_data:pd.DataFrame):
-    if len(search)==0:
-      return current_data
-    data_np = current_data.to_numpy()
-    for i, row in enumerate(data_np):
-      for j, item in enumerate(row):
-        if isinstance(item,str) and search in item:
-          data_np[i][j] = item.replace(search, replace)
-    return pd.DataFrame(data=data_np, columns=display_columns)
+  def _search_and_replace(cls, search:str, replace:str, regex:bool, columns, files, view_id, dry_run):
+    current = StyleView.get(view_id).prefix
+    prefixes = list(dict.fromkeys(current if f=="Current file" else "" if f=="Master" else f for f in files))
+    choices = gr.Dropdown.update(choices=["Current file", "Master"]+Additionals.prefixes())
+    if len(search)==0 or len(columns)==0 or len(prefixes)==0:
+      return "Nothing to search for", choices
+    try:
+      counts = FileManager.search_and_replace(search, replace, regex, columns, prefixes, dry_run=dry_run)
+    except re.error as e:
+      return f"Bad regex: {e}", choices
+    if len(counts)==0:
+      return "No matches", choices
+    verb = "Would replace" if dry_run else "Replaced"
+    return "\n".join(f"- {verb} in {prefix or 'Master'}: " + ", ".join(f"{column} {n}" for column, n in by_column.items()) for prefix, by_column in counts.items()), choices
+
+  @classmethod
+  def handle_search_and_replace_click(cls, search:str, replace:str, regex:bool, columns, files, view_id):
+    scheduler.set_pending("backup")
+    result, choices = cls._search_and_replace(search, replace, regex, columns, files, view_id, dry_run=False)
+    return *cls._page(view_id), gr.Markdown.update(value=result), choices
+
+  @classmethod
+  def handle_search_and_replace_dry_run_click(cls, search:str, replace:str, regex:bool, columns, files, view_id):
+    return cls._search_and_replace(search, replace, regex, columns, files, view_id, dry_run=True)
   
   @classmethod
-  def handle_use_additional_styles_box_change(cls, activate, filename):
-    FileManager.current_styles_file_path = Additionals.full_path(filename) if activate else FileManager.default_style_file_path
+  def handle_use_additional_styles_box_change(cls, activate, filename, view_id):
+    view = StyleView.get(view_id)
+    view.prefix = Additionals.display_name(filename) if activate else ''
+    view.page = 1
     if activate:
       FileManager.update_additional_style_files()
       labels = Additionals.additional_style_files(display_names=True, include_new=True)
-      selected = Additionals.display_name(FileManager.current_styles_file_path)
-      selected = selected if selected in labels else labels[0] if len(labels)>0 else ''
-      return gr.Row.update(visible=activate), FileManager.get_current_styles(), gr.Dropdown.update(choices=labels, value=selected)
+      selected = view.prefix if view.prefix in labels else labels[0] if len(labels)>0 else ''
+      return gr.Row.update(visible=activate), *cls._page(view_id), gr.Dropdown.update(choices=labels, value=selected)
     else:
       FileManager.merge_additional_style_files()
-      return gr.Row.update(visible=activate), FileManager.get_current_styles(), gr.Dropdown.update()
+      return gr.Row.update(visible=activate), *cls._page(view_id), gr.Dropdown.update()
   
   @classmethod
-  def handle_style_file_selection_change(cls, prefix, _):
+  def handle_style_file_selection_change(cls, prefix, _, view_id):
+    view = StyleView.get(view_id)
     if prefix:
       FileManager.create_file_if_missing(prefix)
-      FileManager.current_styles_file_path = Additionals.full_path(prefix)
+      view.prefix = Additionals.display_name(prefix)
+      view.page = 1
     else:
-      prefix = Additionals.display_name(FileManager.current_styles_file_path)
-    return FileManager.get_current_styles(), gr.Dropdown.update(choices=Additionals.additional_style_files(display_names=True, include_new=True), value=prefix)
+      prefix = view.prefix
+    return *cls._page(view_id), gr.Dropdown.update(choices=Additionals.additional_style_files(display_names=True, include_new=True), value=prefix)
   
   @classmethod
   def handle_use_encryption_checkbox_changed(cls, encrypt):
@@ -130,22 +224,42 @@ class StyleEditor:
     FileManager.encrypt_key = key
 
   @classmethod
-  def handle_restore_backup_file_upload(cls, tempfile):
-    return cls._after_backup_restore( FileManager.restore_from_upload(tempfile) )
+  def handle_restore_backup_file_upload(cls, tempfile, view_id):
+    return cls._after_backup_restore( FileManager.restore_from_upload(tempfile), view_id )
   
   @classmethod
-  def handle_backup_restore_button_click(cls, selection):
-    return cls._after_backup_restore( FileManager.restore_from_backup(selection) )
+  def handle_backup_restore_button_click(cls, selection, view_id):
+    return cls._after_backup_restore( FileManager.restore_from_backup(selection), view_id )
   
   @classmethod
-  def _after_backup_restore(cls, error):
+  def _after_backup_restore(cls, error, view_id):
     if error is None:
       FileManager.clear_style_cache()
       FileManager.update_additional_style_files()
-      return gr.Text.update(visible=True, value="Styles restored"), False, FileManager.get_styles()
+      return gr.Text.update(visible=True, value="Styles restored"), False, *cls._page(view_id)
     else:
-      return gr.Text.update(visible=True, value=error), False, FileManager.get_styles()
+      return gr.Text.update(visible=True, value=error), False, *cls._page(view_id)
     
+  @classmethod
+  def handle_restore_to_time_click(cls, when:str, view_id):
+    try:
+      timestamp = datetime.datetime.fromisoformat(when.strip()).timestamp()
+    except ValueError:
+      return gr.Text.update(visible=True, value="Enter the time as YYYY-MM-DD HH:MM:SS"), gr.Checkbox.update(), *cls._page(view_id)
+    return cls._after_backup_restore( FileManager.restore_to_time(timestamp), view_id )
+
+  @classmethod
+  def handle_undo_click(cls, view_id):
+    scheduler.set_pending("backup")
+    FileManager.undo()
+    return cls._page(view_id)
+
+  @classmethod
+  def handle_redo_click(cls, view_id):
+    scheduler.set_pending("backup")
+    FileManager.redo()
+    return cls._page(view_id)
+
   @classmethod
   def handle_restore_backup_file_clear(cls):
     return gr.Text.update(visible=False)
@@ -158,23 +272,16 @@ class StyleEditor:
       return gr.Dropdown.update(choices=FileManager.list_backups()+["---","Refresh list"], value=selection), gr.File.update(value=FileManager.backup_file_path(selection))
   
   @classmethod
-  def handle_outstanding_api_calls(cls):
-    with cls.api_lock:
-      for command, value in cls.api_calls_outstanding:
-        match command:
-          case "delete":
-            FileManager.remove_style(maybe_prefixed_style=value)
-          case "move":
-            FileManager.move_to_additional(maybe_prefixed_style=value[0], new_prefix=value[1])
-          case "duplicate":
-            FileManager.duplicate_style(maybe_prefixed_style=value)
-      cls.api_calls_outstanding = []
-    return FileManager.get_current_styles()
+  def handle_refresh(cls, view_id):
+    return cls._page(view_id)
 
   @classmethod
   def on_ui_tabs(cls):
+    FileManager.init()
     with gr.Blocks(analytics_enabled=False) as style_editor:
       dummy_component = gr.Label(visible=False)
+      cls.view_id = gr.Textbox(visible=False, elem_id="style_editor_view_id")
+      cls.tab_selected = gr.State(False)
       with gr.Row():
         cls.do_api = gr.Button(visible=False, elem_id="style_editor_handle_api")
         with gr.Column(scale=1, min_width=400):
@@ -197,19 +304,31 @@ class StyleEditor:
               cls.backup_selection = gr.Dropdown(choices=FileManager.list_backups()+["---","Refresh list"],value="---", label="Backups")
               cls.backup_restore_button = gr.Button(value="Restore")
             cls.restore_backup_file_upload = gr.File(file_types=[".csv", ".aes"], label="Upload / Download")
+            gr.Markdown(value="Or restore the styles as they were at any time covered by the journal (YYYY-MM-DD HH:MM:SS):")
+            with gr.Row():
+              cls.restore_time_textbox = gr.Textbox(max_lines=1, placeholder="YYYY-MM-DD HH:MM:SS", show_label=False)
+              cls.restore_time_button = gr.Button(value="Restore to time")
             cls.restore_result = gr.Text(visible=False, label="Result:")
         with gr.Column(scale=1, min_width=400):
           with gr.Accordion(label="Filter view", open=False, elem_id="style_editor_filter_accordian"):
             cls.filter_textbox = gr.Textbox(max_lines=1, interactive=True, placeholder="filter", elem_id="style_editor_filter", show_label=False)
-            cls.filter_select = gr.Dropdown(choices=["Exact match", "Case insensitive", "regex"], value="Exact match", show_label=False)
+            cls.filter_select = gr.Dropdown(choices=StyleView.filter_types, value=StyleView.filter_type, show_label=False)
+            cls.order_select = gr.Dropdown(choices=StyleView.orders, value=StyleView.order, label="Order")
+            cls.match_counts = gr.Markdown(value="")
         with gr.Column(scale=1, min_width=400):
           with gr.Accordion(label="Search and replace", open=False):
             cls.search_box = gr.Textbox(max_lines=1, interactive=True, placeholder="search for", show_label=False)
             cls.replace_box= gr.Textbox(max_lines=1, interactive=True, placeholder="replace with", show_label=False)
-            cls.search_and_replace_button = gr.Button(value="Search and Replace")
+            cls.search_regex_checkbox = gr.Checkbox(value=False, label="Regex")
+            cls.search_columns = gr.CheckboxGroup(choices=user_columns, value=['prompt','negative_prompt'], label="Columns")
+            cls.search_files = gr.Dropdown(choices=["Current file", "Master"]+Additionals.prefixes(), value=["Current file"], multiselect=True, label="Style files")
+            with gr.Row():
+              cls.search_dry_run_button = gr.Button(value="Count matches")
+              cls.search_and_replace_button = gr.Button(value="Search and Replace")
+            cls.search_result = gr.Markdown(value="")
         with gr.Column(scale=1, min_width=400):
           with gr.Accordion(label="Advanced options", open=False):
-            cls.use_additional_styles_checkbox = gr.Checkbox(value=FileManager.using_additional(), label="Edit additional style files")
+            cls.use_additional_styles_checkbox = gr.Checkbox(value=False, label="Edit additional style files")
             cls.autosort_checkbox = gr.Checkbox(value=False, label="Autosort")
             with gr.Group(visible=False) as cls.additional_file_display:
               cls.style_file_selection = gr.Dropdown(choices=Additionals.additional_style_files(display_names=True, include_new=True), 
@@ -218,58 +337,119 @@ class StyleEditor:
       with gr.Row():
         gr.Markdown(cls.brief_guide)
       with gr.Row():
-        cls.dataeditor = gr.Dataframe(value=FileManager.get_current_styles(), col_count=(len(display_columns),'fixed'), 
-                                          wrap=True, max_rows=1000, show_label=False, interactive=True, elem_id="style_editor_grid")
+        cls.dataeditor = gr.Dataframe(value=StyleView.get('').current_page(), col_count=(len(display_columns),'fixed'), 
+                                          wrap=True, max_rows=max(StyleView.page_sizes), show_label=False, interactive=True, elem_id="style_editor_grid")
+      with gr.Row():
+        cls.previous_page_button = gr.Button(value="<", scale=0, min_width=50)
+        cls.page_number = gr.Number(value=StyleView.page, precision=0, show_label=False, scale=0, min_width=80)
+        cls.next_page_button = gr.Button(value=">", scale=0, min_width=50)
+        cls.page_size_select = gr.Dropdown(choices=StyleView.page_sizes, value=StyleView.page_size, show_label=False, scale=0, min_width=100)
+        cls.page_info = gr.Markdown(value=StyleView.get('').description())
+        cls.undo_button = gr.Button(value="Undo", scale=0, min_width=80)
+        cls.redo_button = gr.Button(value="Redo", scale=0, min_width=80)
+      grid = [cls.dataeditor, cls.page_info, cls.page_number]
       
-      cls.search_and_replace_button.click(fn=cls.handle_search_and_replace_click, inputs=[cls.search_box, cls.replace_box, cls.dataeditor], outputs=cls.dataeditor)
+      search_inputs = [cls.search_box, cls.replace_box, cls.search_regex_checkbox, cls.search_columns, cls.search_files, cls.view_id]
+      cls.search_and_replace_button.click(fn=executor.writes(cls.handle_search_and_replace_click), inputs=search_inputs, outputs=grid+[cls.search_result, cls.search_files])
+      cls.search_dry_run_button.click(fn=executor.reads(cls.handle_search_and_replace_dry_run_click), inputs=search_inputs, outputs=[cls.search_result, cls.search_files])
 
-      cls.filter_textbox.change(fn=None, inputs=[cls.filter_textbox, cls.filter_select], _js="filter_style_list")
-      cls.filter_select.change(fn=None, inputs=[cls.filter_textbox, cls.filter_select], _js="filter_style_list")
+      view_inputs = [cls.filter_textbox, cls.filter_select, cls.order_select, cls.page_size_select]
+      for component in view_inputs:
+        component.change(fn=executor.reads(cls.handle_view_change), inputs=view_inputs+[cls.view_id], outputs=grid+[cls.match_counts], _js="filter_style_list")
+      cls.page_number.submit(fn=executor.reads(lambda page, view_id: cls.handle_page_change(page, 0, view_id)), inputs=[cls.page_number, cls.view_id], outputs=grid, _js="change_page")
+      cls.previous_page_button.click(fn=executor.reads(lambda page, view_id: cls.handle_page_change(page, -1, view_id)), inputs=[cls.page_number, cls.view_id], outputs=grid, _js="change_page")
+      cls.next_page_button.click(fn=executor.reads(lambda page, view_id: cls.handle_page_change(page, 1, view_id)), inputs=[cls.page_number, cls.view_id], outputs=grid, _js="change_page")
 
       cls.use_encryption_checkbox.change(fn=cls.handle_use_encryption_checkbox_changed, inputs=[cls.use_encryption_checkbox], outputs=[dummy_component], _js="encryption_change")
       cls.encryption_key_textbox.change(fn=cls.handle_encryption_key_change, inputs=[cls.encryption_key_textbox], outputs=[])
-      cls.restore_backup_file_upload.upload(fn=cls.handle_restore_backup_file_upload, inputs=[cls.restore_backup_file_upload], outputs=[cls.restore_result, cls.use_additional_styles_checkbox, cls.dataeditor])
+      cls.restore_backup_file_upload.upload(fn=executor.writes(cls.handle_restore_backup_file_upload), inputs=[cls.restore_backup_file_upload, cls.view_id], outputs=[cls.restore_result, cls.use_additional_styles_checkbox]+grid)
       cls.restore_backup_file_upload.clear(fn=cls.handle_restore_backup_file_clear, inputs=[], outputs=[cls.restore_result])
-      cls.backup_selection.change(fn=cls.handle_backup_selection_change, inputs=[cls.backup_selection], outputs=[cls.backup_selection, cls.restore_backup_file_upload])
-      cls.backup_restore_button.click(fn=cls.handle_backup_restore_button_click, inputs=[cls.backup_selection], outputs=[cls.restore_result, cls.use_additional_styles_checkbox, cls.dataeditor])
-      cls.dataeditor.change(fn=None, inputs=[cls.filter_textbox, cls.filter_select], _js="filter_style_list")
+      cls.backup_selection.change(fn=executor.reads(cls.handle_backup_selection_change), inputs=[cls.backup_selection], outputs=[cls.backup_selection, cls.restore_backup_file_upload])
+      cls.backup_restore_button.click(fn=executor.writes(cls.handle_backup_restore_button_click), inputs=[cls.backup_selection, cls.view_id], outputs=[cls.restore_result, cls.use_additional_styles_checkbox]+grid)
+      cls.restore_time_button.click(fn=executor.writes(cls.handle_restore_to_time_click), inputs=[cls.restore_time_textbox, cls.view_id], outputs=[cls.restore_result, cls.use_additional_styles_checkbox]+grid)
+      cls.undo_button.click(fn=executor.writes(cls.handle_undo_click), inputs=[cls.view_id], outputs=grid)
+      cls.redo_button.click(fn=executor.writes(cls.handle_redo_click), inputs=[cls.view_id], outputs=grid)
 
-      cls.dataeditor.input(fn=cls.handle_dataeditor_input, inputs=[cls.dataeditor, cls.autosort_checkbox], outputs=cls.dataeditor)
-      cls.autosort_checkbox.change(fn=cls.handle_autosort_checkbox_change, inputs=[cls.dataeditor, cls.autosort_checkbox], outputs=cls.dataeditor)
+      cls.dataeditor.input(fn=executor.writes(cls.handle_dataeditor_input), inputs=[cls.dataeditor, cls.autosort_checkbox, cls.view_id], outputs=grid, _js="style_editor_grid_input")
+      cls.autosort_checkbox.change(fn=executor.writes(cls.handle_autosort_checkbox_change), inputs=[cls.autosort_checkbox, cls.view_id], outputs=grid)
 
       style_editor.load(fn=None, _js="when_loaded")
-      style_editor.load(fn=cls.backup.start, inputs=[], outputs=[])
+      style_editor.load(fn=cls.handle_load, inputs=[], outputs=[cls.view_id])
 
-      cls.use_additional_styles_checkbox.change(fn=cls.handle_use_additional_styles_box_change, inputs=[cls.use_additional_styles_checkbox, cls.style_file_selection], 
-                                                outputs=[cls.additional_file_display, cls.dataeditor, cls.style_file_selection])
-      cls.style_file_selection.change(fn=cls.handle_style_file_selection_change, inputs=[cls.style_file_selection, dummy_component], 
-                                      outputs=[cls.dataeditor,cls.style_file_selection], _js="style_file_selection_change")
+      cls.use_additional_styles_checkbox.change(fn=executor.writes(cls.handle_use_additional_styles_box_change), inputs=[cls.use_additional_styles_checkbox, cls.style_file_selection, cls.view_id], 
+                                                outputs=[cls.additional_file_display]+grid+[cls.style_file_selection])
+      cls.style_file_selection.change(fn=executor.writes(cls.handle_style_file_selection_change), inputs=[cls.style_file_selection, dummy_component, cls.view_id], 
+                                      outputs=grid+[cls.style_file_selection], _js="style_file_selection_change")
 
-      cls.do_api.click(fn=cls.handle_outstanding_api_calls,outputs=cls.dataeditor)
+      cls.do_api.click(fn=executor.reads(cls.handle_refresh), inputs=[cls.view_id], outputs=grid)
 
     return [(style_editor, "Style Editor", "style_editor")]
 
+  @classmethod
+  def on_ui_settings(cls):
+    section = ("style_editor", "Style Editor")
+    shared.opts.add_option("style_editor_storage", 
+                           shared.OptionInfo("CSV files", "Where to keep styles (restart needed; the first start with SQLite imports the csv files)", gr.Radio, {"choices":["CSV files", "SQLite database"]}, section=section))
+    for bucket, default in BackupStore.default_retention.items():
+      shared.opts.add_option(f"style_editor_backups_{bucket}", 
+                             shared.OptionInfo(default, f"Number of {bucket} backups to keep", gr.Slider, {"minimum":0, "maximum":100, "step":1}, section=section))
+    shared.opts.add_option("style_editor_metrics", 
+                           shared.OptionInfo(True, "Collect performance metrics (shown at /style-editor/metrics)", gr.Checkbox, section=section,
+                                             onchange=lambda: setattr(metrics, 'enabled', bool(shared.opts.style_editor_metrics))))
+
   @classmethod
   def on_app_started(cls, block:gr.Blocks, api:FastAPI):
+    metrics.enabled = bool(webui.option("style_editor_metrics", True))
+    metrics.gauge("operations_pending", lambda: executor.pending)
+    metrics.gauge("background_jobs_pending", lambda: sum(job.first_pending is not None for job in scheduler.jobs.values()))
+
+    async def run_operations(operations, prefix='') -> List[BulkResult]:
+      scheduler.set_pending("backup")
+      errors = await executor.run(FileManager.bulk_operations, operations, prefix, wait=False)
+      return [BulkResult(style=style, ok=error is None, error=error or '') for (_, style, _), error in zip(operations, errors)]
 
     @api.post("/style-editor/delete-style/")
-    def delete_style(stylename:ParameterString):
-      with cls.api_lock:
-        cls.api_calls_outstanding.append(("delete",stylename.value))
+    async def delete_style(stylename:ParameterString) -> BulkResult:
+      return (await run_operations([("delete", stylename.value, None)]))[0]
 
     @api.post("/style-editor/duplicate-style/")
-    def duplicate_style(stylename:ParameterString):
-      with cls.api_lock:
-        cls.api_calls_outstanding.append(("duplicate",stylename.value))
+    async def duplicate_style(stylename:ParameterString) -> BulkResult:
+      return (await run_operations([("duplicate", stylename.value, None)]))[0]
 
     @api.post("/style-editor/move-style/")
-    def move_style(style:ParameterString, new_prefix:ParameterString):
-      with cls.api_lock:
-        cls.api_calls_outstanding.append(("move",(style.value, new_prefix.value)))
+    async def move_style(style:ParameterString, new_prefix:ParameterString) -> BulkResult:
+      return (await run_operations([("move", style.value, new_prefix.value)]))[0]
+
+    @api.post("/style-editor/bulk/")
+    async def bulk(bulk_operations:BulkOperations) -> BulkResults:
+      operations = [(o.operation, o.style, o.new_prefix) for o in bulk_operations.operations]
+      return BulkResults(results=await run_operations(operations, StyleView.get(bulk_operations.view_id).prefix))
+
+    @api.post("/style-editor/edit-cells/")
+    async def edit_cells(cell_edits:CellEdits) -> CellEditResult:
+      scheduler.set_pending("backup")
+      view = StyleView.get(cell_edits.view_id)
+      rows, reordered, conflicts = await executor.run(view.edit, [(e.row, e.column, e.value) for e in cell_edits.edits], cell_edits.autosort, wait=False)
+      changed = [ChangedRow(row=row, values=values) for row, values in rows]
+      sent = {(e.row, e.column):e.value for e in cell_edits.edits if not e.row in conflicts}
+      returned = {(c.row, column):value for c in changed for column, value in zip(display_columns, c.values)}
+      modified = any(returned.get(key)!=value for key, value in sent.items())
+      return CellEditResult(rows=changed, refresh=reordered or modified or len(conflicts)>0, conflicts=conflicts)
+
+    @api.post("/style-editor/match-counts/")
+    async def match_counts(filter:ParameterString, filter_type:ParameterString) -> Dict[str,int]:
+      return await executor.run(FileManager.match_counts, filter.value, filter_type.value, ['']+Additionals.prefixes(), write=False, wait=False)
 
     @api.post("/style-editor/check-api/")
-    def check() -> ParameterBool:
+    async def check() -> ParameterBool:
       return ParameterBool(value=True)
+
+    @api.get("/style-editor/metrics")
+    def get_metrics(format:str="json", reset:bool=False):
+      result = PlainTextResponse(metrics.prometheus()) if format=="prometheus" else metrics.snapshot()
+      if reset:
+        metrics.reset()
+      return result
     
     @api.exception_handler(RequestValidationError)
     async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -277,17 +457,27 @@ class StyleEditor:
       content = {'status_code': 422, 'message': exc_str, 'data': None}
       return JSONResponse(content=content, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
+    @api.exception_handler(Busy)
+    async def busy_exception_handler(request: Request, exc: Busy):
+      content = {'status_code': 503, 'message': f'{exc}', 'data': None}
+      return JSONResponse(content=content, status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
     with block:
       for tabs in block.children:
         if isinstance(tabs, gr.layouts.Tabs):
           for tab in tabs.children:
             if isinstance(tab, gr.layouts.Tab):
               if tab.id=="style_editor":
-                tab.select(fn=cls.handle_this_tab_selected, outputs=cls.dataeditor)
+                tab.select(fn=executor.writes(cls.handle_this_tab_selected), inputs=[cls.view_id], outputs=[cls.dataeditor, cls.page_info, cls.page_number, cls.tab_selected])
               else:
-                tab.select(fn=cls.handle_another_tab_selected)
+                tab.select(fn=executor.writes(cls.handle_another_tab_selected), inputs=[cls.tab_selected], outputs=[cls.tab_selected])
               if tab.id=="txt2img" or tab.id=="img2img":
                 tab.select(fn=None, inputs=tab, _js="press_refresh_button")
 
+metrics.instrument(StyleEditor, prefix="handle_")
+
 script_callbacks.on_ui_tabs(StyleEditor.on_ui_tabs)
-script_callbacks.on_app_started(StyleEditor.on_app_started)
\ No newline at end of file
+script_callbacks.on_ui_settings(StyleEditor.on_ui_settings)
+script_callbacks.on_app_started(StyleEditor.on_app_started)
+script_callbacks.on_script_unloaded(executor.shutdown)
+script_callbacks.on_script_unloaded(scheduler.flush)
\ No newline at end of file
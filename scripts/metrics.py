@@ -0,0 +1,121 @@
+import time, inspect, threading, functools
+from typing import Callable, Dict, List, Tuple
+
+class Metrics:
+  """
+  In-process performance counters: timing spans (count, total and longest time of each instrumented method),
+  counters (bytes read and written, cache hits and misses...) and gauges (functions read when a snapshot is taken).
+  Counters and spans can have labels, given as keyword arguments. Set enabled to False to stop collecting;
+  instrumented methods then only pay for one attribute lookup.
+  """
+  def __init__(self) -> None:
+    self.enabled = True
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.spans:Dict[str,List[float]] = {}
+    self.counters:Dict[Tuple[str,Tuple],float] = {}
+    self.gauges:Dict[str,Callable[[],float]] = {}
+
+  def record(self, span:str, seconds:float):
+    with self.lock:
+      stats = self.spans.get(span)
+      if stats is None:
+        self.spans[span] = [1, seconds, seconds]
+      else:
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+  def count(self, name:str, n:float=1, **labels):
+    if self.enabled:
+      key = (name, tuple(sorted(labels.items())))
+      with self.lock:
+        self.counters[key] = self.counters.get(key, 0) + n
+
+  def gauge(self, name:str, read:Callable[[],float]):
+    """
+    Report the value of read() as name
+    """
+    self.gauges[name] = read
+
+  def timed(self, span:str):
+    """
+    Decorator to record the time taken by each call of a function as span
+    """
+    def decorator(method):
+      @functools.wraps(method)
+      def wrapper(*args, **kwargs):
+        if not self.enabled:
+          return method(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+          return method(*args, **kwargs)
+        finally:
+          self.record(span, time.perf_counter()-start)
+      return wrapper
+    return decorator
+
+  def instrument(self, cls, names:List[str]=None, prefix:str=None):
+    """
+    Time the named methods of a class (by default all of its methods, except dunder methods), as spans called Class.method.
+    Works for classmethods, staticmethods and plain methods.
+    """
+    for name, attribute in list(vars(cls).items()):
+      if (names is None and name.startswith("__")) or (names is not None and not name in names):
+        continue
+      if names is None and prefix is not None and not name.startswith(prefix):
+        continue
+      span = f"{cls.__name__}.{name}"
+      if isinstance(attribute, classmethod):
+        setattr(cls, name, classmethod(self.timed(span)(attribute.__func__)))
+      elif isinstance(attribute, staticmethod):
+        setattr(cls, name, staticmethod(self.timed(span)(attribute.__func__)))
+      elif inspect.isfunction(attribute):
+        setattr(cls, name, self.timed(span)(attribute))
+
+  def reset(self):
+    with self.lock:
+      self.started = time.time()
+      self.spans = {}
+      self.counters = {}
+
+  def snapshot(self) -> Dict:
+    """
+    Everything collected so far, as a JSON-friendly dictionary
+    """
+    with self.lock:
+      spans = { span:{"count":count, "total_seconds":total, "max_seconds":longest, "mean_seconds":total/count}
+                for span, (count, total, longest) in sorted(self.spans.items()) }
+      counters = [ {"name":name, "labels":dict(labels), "value":value} for (name, labels), value in sorted(self.counters.items()) ]
+    gauges = {}
+    for name, read in self.gauges.items():
+      try:
+        gauges[name] = read()
+      except Exception:
+        gauges[name] = None
+    return {"enabled":self.enabled, "since":self.started, "spans":spans, "counters":counters, "gauges":gauges}
+
+  def prometheus(self) -> str:
+    """
+    The snapshot in the Prometheus text exposition format
+    """
+    def labels(values:Dict) -> str:
+      return "{" + ",".join(f'{key}="{str(value).replace(chr(92), chr(92)*2).replace(chr(34), chr(92)+chr(34))}"' for key, value in values.items()) + "}" if values else ""
+    snapshot = self.snapshot()
+    lines = ["# TYPE style_editor_span_seconds summary"]
+    for span, stats in snapshot['spans'].items():
+      lines.append(f"style_editor_span_seconds_count{labels({'span':span})} {stats['count']}")
+      lines.append(f"style_editor_span_seconds_sum{labels({'span':span})} {stats['total_seconds']:.6f}")
+    lines.append("# TYPE style_editor_span_seconds_max gauge")
+    for span, stats in snapshot['spans'].items():
+      lines.append(f"style_editor_span_seconds_max{labels({'span':span})} {stats['max_seconds']:.6f}")
+    for name in dict.fromkeys(counter['name'] for counter in snapshot['counters']):
+      lines.append(f"# TYPE style_editor_{name}_total counter")
+      lines.extend(f"style_editor_{name}_total{labels(counter['labels'])} {counter['value']}" for counter in snapshot['counters'] if counter['name']==name)
+    for name, value in snapshot['gauges'].items():
+      if value is not None:
+        lines.append(f"# TYPE style_editor_{name} gauge")
+        lines.append(f"style_editor_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+metrics = Metrics()
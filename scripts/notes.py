@@ -0,0 +1,184 @@
+from __future__ import annotations
+import os, json, threading, contextlib
+from typing import Dict, Iterable, List, Tuple
+from scripts.locks import file_lock
+from scripts.metrics import metrics
+from scripts.shared import lazy_import
+pd = lazy_import("pandas")
+
+class NotesStore:
+  """
+  Notes for styles, keyed by full style name (prefix::name for additional style files).
+
+  notes.json holds all the notes as of the last compaction, and changes since then are appended to notes.log,
+  one {"key":..., "note":...} line each (a null note is a deletion), so an edit only writes the entries that changed.
+  The log is folded back into notes.json once it has more lines than there are notes (and at least compact_after).
+
+  Writes are done holding a file lock, after reading anything another process has appended to the log,
+  so several webui instances can share the notes without losing each other's changes.
+  """
+  compact_after = 1000
+
+  def __init__(self, directory:str):
+    self.path = os.path.join(directory, "notes.json")
+    self.log_path = os.path.join(directory, "notes.log")
+    self.lock = threading.Lock()
+    self._reload()
+
+  def _state(self):
+    try:
+      stat = os.stat(self.path)
+      return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+      return None
+
+  def _reload(self):
+    self.state = self._state()
+    try:
+      with open(self.path, encoding="utf-8") as f:
+        self.notes:Dict[str,str] = json.load(f)
+    except:
+      self.notes = {}
+    self.logged = 0
+    self.log_offset = 0
+    self._catch_up()
+
+  def _catch_up(self):
+    """
+    Apply the complete lines added to the log since we last read it (if it has been compacted by someone else, start again)
+    """
+    if self._state()!=self.state:
+      return self._reload()
+    try:
+      with open(self.log_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size<self.log_offset:
+          return self._reload()
+        f.seek(self.log_offset)
+        start = self.log_offset
+        for line in f:
+          if not line.endswith(b"\n"):
+            break # a partly written last line
+          self.log_offset += len(line)
+          try:
+            entry = json.loads(line)
+          except json.JSONDecodeError:
+            continue
+          self._set(entry['key'], entry['note'])
+          self.logged += 1
+        metrics.count("bytes_read", self.log_offset-start, file="notes")
+    except FileNotFoundError:
+      pass
+
+  def _exclusive(self):
+    return file_lock(self.path)
+
+  @staticmethod
+  def key(name, prefix:str):
+    """
+    The key for a style name (or a Series of them) in the file with this prefix
+    """
+    return prefix+"::"+name if prefix!='' else name
+
+  def _set(self, key:str, note:str):
+    if note:
+      self.notes[key] = note
+    else:
+      self.notes.pop(key, None)
+
+  def lookup(self, names:pd.Series, prefix:str) -> pd.Series:
+    """
+    The notes for a column of style names (from the file with this prefix), '' where there are none
+    """
+    return NotesStore.key(names, prefix).map(self.notes).fillna('').astype(object)
+
+  def update(self, names:pd.Series, notes:pd.Series, prefix:str):
+    """
+    Set the notes for the styles with these names, writing only the ones that changed
+    """
+    self._write(zip(NotesStore.key(names, prefix), notes))
+
+  def rename(self, old:str, new:str):
+    """
+    Move the note for a style which has been renamed (unless the new name already has one)
+    """
+    if old in self.notes:
+      self._write([(new, self.notes.get(new) or self.notes[old]), (old, None)])
+
+  def replace_all(self, notes:Dict[str,str]):
+    """
+    Make the notes the same as the given dictionary (used when migrating)
+    """
+    self._write(list(notes.items()) + [(key, None) for key in self.notes if not key in notes])
+
+  def _write(self, entries:Iterable[Tuple[str,str]]):
+    entries = list(entries)
+    with self.lock, self._exclusive():
+      self._catch_up()
+      changed = [(key, note or None) for key, note in entries if (note or None)!=self.notes.get(key)]
+      if len(changed)==0:
+        return
+      self._persist(changed)
+      for key, note in changed:
+        self._set(key, note)
+
+  def _persist(self, changed:List[Tuple[str,str]]):
+    raw = "".join(json.dumps({"key":key, "note":note})+"\n" for key, note in changed).encode("utf-8")
+    with open(self.log_path, 'ab') as f:
+      f.write(raw)
+      self.log_offset = f.tell()
+    metrics.count("bytes_written", len(raw), file="notes")
+    self.logged += len(changed)
+    if self.logged > max(self.compact_after, len(self.notes)+len(changed)):
+      self._compact(changed)
+
+  def _compact(self, changed:List[Tuple[str,str]]):
+    notes = dict(self.notes)
+    for key, note in changed:
+      if note:
+        notes[key] = note
+      else:
+        notes.pop(key, None)
+    raw = json.dumps(notes).encode("utf-8")
+    with open(self.path+".tmp", 'wb') as f:
+      f.write(raw)
+    os.replace(self.path+".tmp", self.path)
+    metrics.count("bytes_written", len(raw), file="notes")
+    self.state = self._state()
+    open(self.log_path, 'w').close()
+    self.logged = 0
+    self.log_offset = 0
+
+class SqliteNotesStore(NotesStore):
+  """
+  The notes kept in the notes table of the SQLite storage's database
+  """
+  def __init__(self, storage):
+    self.storage = storage
+    self.lock = threading.Lock()
+    with storage.lock:
+      self.notes:Dict[str,str] = dict(storage.db.execute("SELECT key, note FROM notes").fetchall())
+
+  def _catch_up(self):
+    pass
+
+  def _exclusive(self):
+    return contextlib.nullcontext()
+
+  def _persist(self, changed:List[Tuple[str,str]]):
+    def statements(db):
+      db.executemany("DELETE FROM notes WHERE key=?", [(key,) for key, note in changed if note is None])
+      db.executemany("INSERT OR REPLACE INTO notes (key, note) VALUES (?,?)", [(key, note) for key, note in changed if note is not None])
+    self.storage.transaction(statements)
+
+metrics.instrument(NotesStore, ["_write", "_compact"])
+
+def make_notes_store(storage, directory:str) -> NotesStore:
+  """
+  The notes store to go with the storage. Notes are copied into a new SQLite database from notes.json.
+  """
+  if not storage.exports_master:
+    return NotesStore(directory)
+  notes = SqliteNotesStore(storage)
+  if len(notes.notes)==0:
+    notes.replace_all(NotesStore(directory).notes)
+  return notes
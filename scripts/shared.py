@@ -1,5 +1,21 @@
+import sys, importlib.util
+
 name_column = 'name'
 columns = [name_column,'prompt','negative_prompt']
 user_columns = ['prompt','negative_prompt','notes']
 display_columns = ['sort', name_column,'prompt','negative_prompt','notes']
-d_types = {name_column:str,'prompt':str,'negative_prompt':str}
\ No newline at end of file
+d_types = {name_column:str,'prompt':str,'negative_prompt':str}
+
+def lazy_import(name:str):
+  """
+  The named module, which is only actually imported when one of its attributes is first used
+  (modules using this for annotations need `from __future__ import annotations`)
+  """
+  if name in sys.modules:
+    return sys.modules[name]
+  spec = importlib.util.find_spec(name)
+  spec.loader = importlib.util.LazyLoader(spec.loader)
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[name] = module
+  spec.loader.exec_module(module)
+  return module
@@ -0,0 +1,369 @@
+from __future__ import annotations
+import os, io, time, hashlib, sqlite3, threading, argparse, contextlib
+from typing import Dict, List, Tuple
+from scripts.shared import columns, d_types, name_column, lazy_import
+from scripts.locks import file_lock
+from scripts.metrics import metrics
+pd = lazy_import("pandas")
+
+def parse_csv(raw:bytes) -> pd.DataFrame:
+  """
+  The saved columns of a style file's contents
+  """
+  return pd.read_csv(io.BytesIO(raw), header=None, names=columns,
+                      encoding="utf-8-sig", dtype=d_types,
+                      skiprows=[0], usecols=[0,1,2]).fillna('')
+
+def to_csv(data:pd.DataFrame) -> bytes:
+  """
+  A style file's contents. Written as bytes directly, rather than built as a string and then encoded, to use less memory.
+  """
+  buffer = io.BytesIO()
+  data.to_csv(buffer, columns=columns, index=False, encoding="utf-8-sig")
+  return buffer.getvalue()
+
+def unique_names(data:pd.DataFrame) -> pd.DataFrame:
+  """
+  Append 'x' to names which are already used by an earlier row (as StyleFile.fix_duplicates does)
+  """
+  if not data[name_column].duplicated().any():
+    return data
+  used, names = set(), []
+  for name in data[name_column]:
+    while name in used:
+      name = name + "x"
+    used.add(name)
+    names.append(name)
+  return data.assign(**{name_column:names})
+
+class CsvStorage:
+  """
+  Each style file is a csv file: the master style file, and additional style files in their own directory.
+  A version is the (mtime, size, sha1) of the file as we last read or wrote it.
+  """
+  exports_master = False
+  uses_cache = True
+  listing_grace = 2
+
+  def __init__(self, default_style_file_path:str, additional_style_files_directory:str):
+    self.default_style_file_path = default_style_file_path
+    self.additional_style_files_directory = additional_style_files_directory
+    self.listing:Tuple[object,List[str]] = (None, [])
+
+  def path(self, prefix:str) -> str:
+    return self.default_style_file_path if prefix=='' else os.path.join(self.additional_style_files_directory, prefix+".csv")
+
+  def write_lock(self, prefix:str):
+    """
+    An advisory lock to hold while checking and then writing a style file
+    """
+    return file_lock(self.path(prefix))
+
+  @staticmethod
+  def _stat(path):
+    try:
+      stat = os.stat(path)
+      return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+      return None
+
+  def state(self, prefix:str):
+    """
+    The (mtime, size) of a style file, or None if it doesn't exist
+    """
+    return CsvStorage._stat(self.path(prefix))
+
+  def prefixes(self) -> List[str]:
+    """
+    The additional style files. The directory is only listed again when its (mtime, size) changes, or while its mtime
+    is within listing_grace seconds of now (so a file added in the same clock tick as the last listing isn't missed).
+    """
+    state = CsvStorage._stat(self.additional_style_files_directory)
+    if state is None or state!=self.listing[0] or time.time_ns()-state[0]<self.listing_grace*1e9:
+      self.listing = (state, [os.path.splitext(f)[0] for f in os.listdir(self.additional_style_files_directory) if f.endswith(".csv")])
+    return list(self.listing[1])
+
+  def exists(self, prefix:str) -> bool:
+    return os.path.exists(self.path(prefix))
+
+  def create(self, prefix:str):
+    if not self.exists(prefix):
+      print("", file=open(self.path(prefix),"w"))
+      self.listing = (None, [])
+
+  def delete(self, prefix:str):
+    os.remove(self.path(prefix))
+    self.listing = (None, [])
+
+  def read_bytes(self, prefix:str) -> bytes:
+    with open(self.path(prefix), 'rb') as f:
+      raw = f.read()
+    metrics.count("bytes_read", len(raw), file="styles")
+    return raw
+
+  def write_bytes(self, prefix:str, raw:bytes):
+    """
+    Write to a temporary file and then replace the real file with it, so a crash part way through can't leave a truncated style file
+    """
+    path = self.path(prefix)
+    with open(path+".tmp", 'wb') as f:
+      f.write(raw)
+    os.replace(path+".tmp", path)
+    metrics.count("bytes_written", len(raw), file="styles")
+
+  def load(self, prefix:str) -> Tuple[pd.DataFrame,object]:
+    """
+    The saved columns of a style file, and its version. Raises an exception if the file can't be read.
+    """
+    path = self.path(prefix)
+    state = CsvStorage._stat(path)
+    raw = self.read_bytes(prefix)
+    return parse_csv(raw), (*state, hashlib.sha1(raw).hexdigest())
+
+  def save(self, prefix:str, data:pd.DataFrame, changes:Dict=None, reordered=True):
+    """
+    Save a style file (the changes and reordered flag are ignored, the whole file is written). Returns the new version.
+    """
+    raw = to_csv(data)
+    self.write_bytes(prefix, raw)
+    return (*CsvStorage._stat(self.path(prefix)), hashlib.sha1(raw).hexdigest())
+
+  def check(self, prefix:str, version) -> Tuple[bool,object]:
+    """
+    Whether the style file has been changed by something else since version, and the current version.
+    If only the mtime has changed, the contents are hashed to check.
+    """
+    state = CsvStorage._stat(self.path(prefix))
+    if state is None and version is None:
+      return False, None
+    if version is not None and state==version[:2]:
+      return False, version
+    if state is not None and version is not None and state[1]==version[1]:
+      if hashlib.sha1(self.read_bytes(prefix)).hexdigest()==version[2]:
+        return False, (*state, version[2])
+    return True, version
+
+class SqliteStorage:
+  """
+  All the style files in one SQLite database (in WAL mode), with the prefix as an indexed column ('' for the master file).
+  Saves apply the changes by name (from journal.diff) as single row statements in one transaction.
+  Each file has a version number, incremented on every save, so changes by another process are noticed.
+
+  The webui reads the master style file as csv, so that is exported (by export_master) after the master has
+  changed, and changes made to the csv by the webui are imported the next time the master is read.
+  A pending export is recorded in the database, so it isn't lost if the webui stops first.
+  """
+  exports_master = True
+  uses_cache = False
+
+  def __init__(self, path:str, default_style_file_path:str):
+    self.path = path
+    self.default_style_file_path = default_style_file_path
+    self.lock = threading.RLock()
+    self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS files (prefix TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0, csv_state TEXT,
+                                        export_pending INTEGER NOT NULL DEFAULT 0);
+      CREATE TABLE IF NOT EXISTS styles (prefix TEXT NOT NULL, name TEXT NOT NULL, position INTEGER NOT NULL,
+                                         prompt TEXT NOT NULL, negative_prompt TEXT NOT NULL, PRIMARY KEY (prefix, name));
+      CREATE INDEX IF NOT EXISTS styles_position ON styles (prefix, position);
+      CREATE TABLE IF NOT EXISTS notes (key TEXT PRIMARY KEY, note TEXT NOT NULL);
+    """)
+    try:
+      self.db.execute("ALTER TABLE files ADD COLUMN export_pending INTEGER NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+      pass # it was made with the column
+    row = self.db.execute("SELECT export_pending FROM files WHERE prefix=''").fetchone()
+    self.export_pending = row is not None and row[0]==1
+
+  def transaction(self, statements):
+    """
+    Run a function taking the connection inside a transaction, and return its result
+    """
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        result = statements(self.db)
+        self.db.execute("COMMIT")
+        return result
+      except:
+        self.db.execute("ROLLBACK")
+        raise
+
+  def write_lock(self, prefix:str):
+    """
+    Transactions already keep writers apart
+    """
+    return contextlib.nullcontext()
+
+  def empty(self) -> bool:
+    with self.lock:
+      return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]==0
+
+  def prefixes(self) -> List[str]:
+    with self.lock:
+      return [row[0] for row in self.db.execute("SELECT prefix FROM files WHERE prefix!='' ORDER BY prefix")]
+
+  def exists(self, prefix:str) -> bool:
+    with self.lock:
+      return self.db.execute("SELECT 1 FROM files WHERE prefix=?", (prefix,)).fetchone() is not None
+
+  def create(self, prefix:str):
+    self.transaction(lambda db: db.execute("INSERT OR IGNORE INTO files (prefix) VALUES (?)", (prefix,)))
+
+  def delete(self, prefix:str):
+    def statements(db):
+      db.execute("DELETE FROM styles WHERE prefix=?", (prefix,))
+      db.execute("DELETE FROM files WHERE prefix=?", (prefix,))
+    self.transaction(statements)
+
+  def _version(self, prefix:str):
+    row = self.db.execute("SELECT version FROM files WHERE prefix=?", (prefix,)).fetchone()
+    return None if row is None else row[0]
+
+  def _replace(self, prefix:str, data:pd.DataFrame):
+    """
+    Replace the whole of a style file. Returns the new version.
+    """
+    data = unique_names(data[columns].fillna(''))
+    def statements(db):
+      db.execute("INSERT OR IGNORE INTO files (prefix) VALUES (?)", (prefix,))
+      db.execute("DELETE FROM styles WHERE prefix=?", (prefix,))
+      db.executemany("INSERT INTO styles (prefix, name, position, prompt, negative_prompt) VALUES (?,?,?,?,?)",
+                     ((prefix, name, i, prompt, negative_prompt) for i, (name, prompt, negative_prompt) in enumerate(data.itertuples(index=False))))
+      db.execute("UPDATE files SET version=version+1 WHERE prefix=?", (prefix,))
+      return self._version(prefix)
+    return self.transaction(statements)
+
+  def _sync_master(self):
+    """
+    Import the master csv if something other than export_master has changed it
+    """
+    state = CsvStorage._stat(self.default_style_file_path)
+    with self.lock:
+      row = self.db.execute("SELECT csv_state FROM files WHERE prefix=''").fetchone()
+      if state is None or (row is not None and row[0]==repr(state)):
+        return
+      if self.export_pending:
+        print("Style Editor: the styles file was changed by something else while changes were waiting to be exported; they will be overwritten")
+        return
+      with open(self.default_style_file_path, 'rb') as f:
+        raw = f.read()
+      metrics.count("bytes_read", len(raw), file="styles")
+      self._replace('', parse_csv(raw))
+      self.db.execute("UPDATE files SET csv_state=? WHERE prefix=''", (repr(state),))
+
+  def load(self, prefix:str) -> Tuple[pd.DataFrame,object]:
+    if prefix=='':
+      self._sync_master()
+    return self._load(prefix)
+
+  def _load(self, prefix:str) -> Tuple[pd.DataFrame,object]:
+    with self.lock:
+      version = self._version(prefix)
+      if version is None:
+        raise FileNotFoundError(prefix)
+      rows = self.db.execute("SELECT name, prompt, negative_prompt FROM styles WHERE prefix=? ORDER BY position", (prefix,)).fetchall()
+    return pd.DataFrame(rows, columns=columns, dtype=object), version
+
+  def save(self, prefix:str, data:pd.DataFrame, changes:Dict=None, reordered=True):
+    """
+    Save a style file. If changes (from journal.diff) are given, only the rows that changed are written,
+    and the positions are only rewritten if rows were added or reordered. Returns the new version.
+    """
+    if changes is None:
+      version = self._replace(prefix, data)
+    else:
+      def statements(db):
+        db.execute("INSERT OR IGNORE INTO files (prefix) VALUES (?)", (prefix,))
+        db.executemany("DELETE FROM styles WHERE prefix=? AND name=?", ((prefix, name) for name in changes.get('removed', {})))
+        db.executemany("INSERT OR REPLACE INTO styles (prefix, name, position, prompt, negative_prompt) VALUES (?,?,-1,?,?)",
+                       ((prefix, name, *values) for name, values in changes.get('added', {}).items()))
+        db.executemany("UPDATE styles SET prompt=?, negative_prompt=? WHERE prefix=? AND name=?",
+                       ((*after, prefix, name) for name, (_, after) in changes.get('changed', {}).items()))
+        if reordered or changes.get('added'):
+          db.executemany("UPDATE styles SET position=? WHERE prefix=? AND name=?", ((i, prefix, name) for i, name in enumerate(data[name_column])))
+        db.execute("UPDATE files SET version=version+1 WHERE prefix=?", (prefix,))
+        return self._version(prefix)
+      version = self.transaction(statements)
+    if prefix=='':
+      self._export_later()
+    return version
+
+  def check(self, prefix:str, version) -> Tuple[bool,object]:
+    if prefix=='':
+      self._sync_master()
+    with self.lock:
+      current = self._version(prefix)
+    return current!=version, version
+
+  def read_bytes(self, prefix:str) -> bytes:
+    return to_csv(self.load(prefix)[0])
+
+  def write_bytes(self, prefix:str, raw:bytes):
+    self._replace(prefix, parse_csv(raw) if raw.strip() else pd.DataFrame(columns=columns))
+    if prefix=='':
+      self._export_later()
+
+  def _export_later(self):
+    with self.lock:
+      self.export_pending = True
+      self.db.execute("UPDATE files SET export_pending=1 WHERE prefix=''")
+
+  def export_master(self):
+    """
+    Write the master style file out as csv for the webui, if it has changed
+    """
+    with self.lock:
+      if not self.export_pending:
+        return
+      self.export_pending = False
+      raw = to_csv(self._load('')[0])
+      CsvStorage(self.default_style_file_path, None).write_bytes('', raw)
+      self.db.execute("UPDATE files SET csv_state=?, export_pending=0 WHERE prefix=''", (repr(CsvStorage._stat(self.default_style_file_path)),))
+
+for storage_class in [CsvStorage, SqliteStorage]:
+  metrics.instrument(storage_class, ["load", "save", "check", "export_master"])
+
+def make_storage(backend:str, basedir:str, default_style_file_path:str, additional_style_files_directory:str):
+  """
+  The storage for the backend chosen in settings ("CSV files" or "SQLite database")
+  """
+  if backend=="SQLite database":
+    storage = SqliteStorage(os.path.join(basedir, "styles.db"), default_style_file_path)
+    if storage.empty():
+      migrate(CsvStorage(default_style_file_path, additional_style_files_directory), storage)
+    return storage
+  return CsvStorage(default_style_file_path, additional_style_files_directory)
+
+def migrate(source, target):
+  """
+  Copy the master and additional style files from one storage to another
+  """
+  for prefix in ['']+source.prefixes():
+    try:
+      raw = source.read_bytes(prefix)
+    except OSError:
+      continue
+    target.write_bytes(prefix, raw)
+  if target.exports_master:
+    target.export_master()
+
+if __name__=="__main__":
+  # run from the extension directory: python -m scripts.storage --to sqlite --styles-file ../../styles.csv
+  from scripts.notes import NotesStore, SqliteNotesStore
+  parser = argparse.ArgumentParser(description="Move the Style Editor's style files (and notes) between csv files and an SQLite database")
+  parser.add_argument("--to", choices=["sqlite", "csv"], required=True)
+  parser.add_argument("--styles-file", required=True, help="the webui styles.csv")
+  parser.add_argument("--extension-directory", default=".")
+  args = parser.parse_args()
+  os.makedirs(os.path.join(args.extension_directory, "additonal_style_files"), exist_ok=True)
+  csv = CsvStorage(args.styles_file, os.path.join(args.extension_directory, "additonal_style_files"))
+  sqlite = SqliteStorage(os.path.join(args.extension_directory, "styles.db"), args.styles_file)
+  source, target = (csv, sqlite) if args.to=="sqlite" else (sqlite, csv)
+  migrate(source, target)
+  notes = [NotesStore(args.extension_directory), SqliteNotesStore(sqlite)]
+  source_notes, target_notes = notes if args.to=="sqlite" else reversed(notes)
+  target_notes.replace_all(source_notes.notes)
+  print(f"Copied {len(source.prefixes())+1} style files and {len(source_notes.notes)} notes to {args.to}")
@@ -0,0 +1,213 @@
+from __future__ import annotations
+import re, warnings
+from array import array
+from typing import Dict, List
+try:
+  import re._parser as sre_parse
+except ImportError:
+  import sre_parse
+from scripts.shared import display_columns, lazy_import
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+filter_types = ["Exact match", "Case insensitive", "regex", "Words"]
+
+def words_in(text:str) -> List[str]:
+  return re.findall(r'\w+', text.lower())
+
+def matches(data:pd.DataFrame, text:str, filter_type:str) -> pd.Series:
+  """
+  A boolean mask of the rows which match the filter text in any of the columns.
+  For "Words", every word must appear as a whole word somewhere in the row.
+  An invalid regex matches everything.
+  """
+  mask = pd.Series(text=='', index=data.index)
+  if text=='':
+    return mask
+  match filter_type:
+    case "regex":
+      try:
+        re.compile(text)
+      except re.error:
+        return ~mask
+      with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)  # pandas warns about match groups, which don't matter here
+        for column in display_columns:
+          mask |= data[column].astype(str).str.contains(text, regex=True)
+    case "Words":
+      mask = ~mask
+      for word in words_in(text):
+        has_word = pd.Series(False, index=data.index)
+        for column in display_columns:
+          has_word |= data[column].astype(str).str.contains(r'\b'+re.escape(word)+r'\b', case=False, regex=True)
+        mask &= has_word
+    case _:
+      for column in display_columns:
+        mask |= data[column].astype(str).str.contains(text, case=(filter_type!="Case insensitive"), regex=False)
+  return mask
+
+def required_literals(pattern:str) -> List[str]:
+  """
+  Literal strings that any match of the regex must contain. Only the top level of the pattern
+  is looked at, so this may miss some, but never returns a string that isn't required.
+  """
+  try:
+    parsed = sre_parse.parse(pattern)
+  except Exception:
+    return []
+  runs, current = [], ''
+  for op, value in parsed:
+    if op is sre_parse.LITERAL:
+      current += chr(value)
+    else:
+      runs.append(current)
+      current = ''
+  runs.append(current)
+  return [run for run in runs if len(run)>=3]
+
+class TextIndex:
+  """
+  An inverted index from lowercase trigrams to the rows of a StyleFile that contain them.
+  Each version of a row gets a new slot, so the posting lists are append-only sorted arrays that
+  can be intersected with numpy. Replaced and removed slots are marked dead, and the index asks
+  to be rebuilt once most of its slots are dead.
+  """
+  def __init__(self, data:pd.DataFrame):
+    self.postings:Dict[str,array] = {}
+    self.slot_labels:List = []
+    self.alive = bytearray()
+    self.slots:Dict[object,int] = {}
+    self.dead = 0
+    self.update_rows(data)
+
+  chunk_size = 2000
+
+  def update_rows(self, data:pd.DataFrame):
+    """
+    Index (or reindex) the rows of data in bulk
+    """
+    for label in data.index:
+      self.remove(label)
+    texts = ["\n".join(values).lower() for values in zip(*[data[column].astype(str).tolist() for column in display_columns])]
+    for start in range(0, len(texts), self.chunk_size):
+      self._add_rows(list(data.index[start:start+self.chunk_size]), texts[start:start+self.chunk_size])
+
+  def _add_rows(self, labels:List, texts:List[str]):
+    """
+    Index new rows (texts already lowercased) in bulk: the trigrams of all of them are found, and grouped
+    into the posting lists, with numpy. Characters are numbered by their rank in the chunk's alphabet,
+    so each (trigram, row) pair fits in one integer and a single sort groups them.
+    """
+    codes = np.frombuffer("\0".join(texts).encode('utf-32-le'), dtype=np.uint32)
+    present = np.zeros(0x110000, dtype=bool)
+    present[codes] = True
+    alphabet = np.flatnonzero(present)
+    size = len(alphabet)
+    if size**3 * len(texts) >= 2**62:
+      for label, text in zip(labels, texts):
+        self.update(label, [text])
+      return
+    first = len(self.slot_labels)
+    self.slot_labels.extend(labels)
+    self.alive.extend(b'\x01'*len(labels))
+    self.slots.update(zip(labels, range(first, first+len(labels))))
+    if len(codes)<3:
+      return
+    chars = (np.cumsum(present, dtype=np.int64) - 1)[codes]
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    rows = np.repeat(np.arange(2*len(texts)-1) // 2, np.stack([lengths, np.ones_like(lengths)], axis=1).ravel()[:-1])
+    rows[np.cumsum(lengths+1)[:-1]-1] = -1 # the separators
+    within = (rows[:-2]==rows[2:]) & (rows[:-2]>=0)
+    trigrams = ((chars[:-2]*size + chars[1:-1])*size + chars[2:])[within]
+    pairs = TextIndex._distinct(trigrams*len(texts) + rows[:-2][within])
+    trigrams, slots = pairs // len(texts), (pairs % len(texts) + first).astype(np.uint32)
+    starts = np.flatnonzero(np.concatenate(([True], trigrams[1:]!=trigrams[:-1])))
+    heads = trigrams[starts]
+    keys = zip(alphabet[heads // (size*size)].tolist(), alphabet[heads // size % size].tolist(), alphabet[heads % size].tolist())
+    for (c0, c1, c2), posting in zip(keys, np.split(slots, starts[1:])):
+      trigram = chr(c0) + chr(c1) + chr(c2)
+      existing = self.postings.get(trigram)
+      if existing is None:
+        existing = self.postings[trigram] = array('I')
+      existing.frombytes(posting.tobytes())
+
+  @staticmethod
+  def _distinct(values:np.ndarray) -> np.ndarray:
+    """
+    The distinct values, sorted (np.unique, but much faster for large integer arrays)
+    """
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:]!=values[:-1]))]
+
+  @staticmethod
+  def trigrams(text:str):
+    text = text.lower()
+    return { text[i:i+3] for i in range(len(text)-2) }
+
+  def update(self, label, values):
+    """
+    Index (or reindex) the row with this label
+    """
+    self.remove(label)
+    slot = len(self.slot_labels)
+    self.slot_labels.append(label)
+    self.alive.append(1)
+    self.slots[label] = slot
+    for trigram in TextIndex.trigrams("\n".join(str(value) for value in values)):
+      posting = self.postings.get(trigram)
+      if posting is None:
+        posting = self.postings[trigram] = array('I')
+      posting.append(slot)
+
+  def remove(self, label):
+    slot = self.slots.pop(label, None)
+    if slot is not None:
+      self.alive[slot] = 0
+      self.dead += 1
+
+  def needs_rebuild(self) -> bool:
+    return self.dead > 1000 and self.dead > len(self.slots)
+
+  def _candidates(self, substrings:List[str]):
+    """
+    Labels of the rows which contain all of the trigrams of all of the substrings,
+    or None if the substrings are too short to narrow anything down.
+    """
+    trigrams = set()
+    for substring in substrings:
+      trigrams |= TextIndex.trigrams(substring)
+    if len(trigrams)==0:
+      return None
+    postings = []
+    for trigram in trigrams:
+      posting = self.postings.get(trigram)
+      if posting is None:
+        return []
+      postings.append(posting)
+    postings.sort(key=len)
+    slots = np.frombuffer(postings[0], dtype=np.uint32)
+    for posting in postings[1:]:
+      if len(slots)==0:
+        break
+      slots = np.intersect1d(slots, np.frombuffer(posting, dtype=np.uint32), assume_unique=True)
+    return [self.slot_labels[slot] for slot in slots.tolist() if self.alive[slot]]
+
+  def candidates(self, text:str, filter_type:str):
+    match filter_type:
+      case "regex":
+        return self._candidates(required_literals(text))
+      case "Words":
+        return self._candidates(words_in(text))
+      case _:
+        return self._candidates([text])
+
+  def narrow(self, data:pd.DataFrame, text:str, filter_type:str, also=()) -> pd.DataFrame:
+    """
+    The rows of data (which this indexes) that might match the filter, in data order: all of them
+    if the index can't narrow it down, and those labelled in also (rows not in the index) whatever they contain.
+    They still need checking with matches.
+    """
+    candidates = self.candidates(text, filter_type)
+    if candidates is None:
+      return data
+    return data.iloc[np.sort(data.index.get_indexer(set(candidates).union(also)))]
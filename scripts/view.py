@@ -0,0 +1,146 @@
+from __future__ import annotations
+import math, threading
+from typing import Dict, List, Tuple
+from scripts.filemanager import FileManager, StyleFile
+from scripts.additionals import Additionals
+from scripts.shared import name_column, lazy_import
+from scripts import textindex
+from scripts.metrics import metrics
+pd = lazy_import("pandas")
+
+class StyleView:
+  """
+  The part of a style file that one browser session shows in the grid: the rows which match the filter,
+  in the chosen order, one page at a time.
+  The row labels of the page are kept so that edits to the grid can be mapped back to the underlying rows,
+  along with the revision of the style file when the page was shown, so edits to rows that someone else
+  has changed since then can be detected.
+
+  Each session has its own view (see get); the class attributes are the defaults for a new view.
+  """
+  filter_types = textindex.filter_types
+  orders = ["File order", "Sort column", "Name"]
+  page_sizes = [50, 100, 250, 1000]
+
+  filter_text = ''
+  filter_type = "Exact match"
+  order = "File order"
+  page = 1
+  page_size = 100
+
+  views:Dict[str,'StyleView'] = {}
+  max_views = 100
+  views_lock = threading.Lock()
+
+  def __init__(self):
+    self.prefix = ''
+    self.labels:List = []
+    self.matches = 0
+    self.total = 0
+    self.revision = 0
+    self.own:Dict[object,int] = {}
+
+  @classmethod
+  def get(cls, view_id:str) -> 'StyleView':
+    """
+    The view for a session (view_id is set by the page when it loads), made if needed.
+    Only the max_views most recently used views are kept.
+    """
+    with cls.views_lock:
+      view = cls.views.pop(view_id or '', None) or StyleView()
+      cls.views[view_id or ''] = view
+      while len(cls.views)>cls.max_views:
+        del cls.views[next(iter(cls.views))]
+      return view
+
+  def ordered(self, data:pd.DataFrame) -> pd.DataFrame:
+    match self.order:
+      case "Sort column":
+        return StyleFile.sort_dataset(data)
+      case "Name":
+        return data.sort_values(by=name_column, key=lambda names: names.str.lower(), kind='stable')
+      case _:
+        return data
+
+  def pages(self) -> int:
+    return max(1, math.ceil(self.matches/self.page_size))
+
+  def style_file(self) -> StyleFile:
+    return FileManager.style_file(self.prefix)
+
+  def current_page(self) -> pd.DataFrame:
+    """
+    The rows of the view's style file to show in the grid
+    """
+    with FileManager.save_lock:
+      style_file = self.style_file()
+      data = style_file.data
+      rows = self.ordered(data.loc[style_file.find(self.filter_text, self.filter_type)])
+      self.total = len(data)
+      self.matches = len(rows)
+      self.page = min(max(1, self.page), self.pages())
+      start = (self.page-1)*self.page_size
+      page = rows.iloc[start:start+self.page_size]
+      self.labels = list(page.index)
+      self.revision = style_file.revision
+      self.own = {}
+      metrics.count("grid_rows_sent", len(page))
+      return page.reset_index(drop=True)
+
+  def label(self, row:int):
+    """
+    The label of the underlying row for a row of the grid, or None for a row that isn't in the page (a new row)
+    """
+    return self.labels[row] if 0<=row<len(self.labels) else None
+
+  def row(self, label):
+    """
+    The position in the grid of the row with this label, or None
+    """
+    return self.labels.index(label) if label in self.labels else None
+
+  def seen(self, labels) -> Dict[object,int]:
+    """
+    The revision of each row as this view last saw it
+    """
+    return { label:max(self.revision, self.own.get(label, 0)) for label in labels }
+
+  def edit(self, edits:List[Tuple[int,str,str]], autosort=False) -> Tuple[List, bool, List]:
+    """
+    Apply (grid row, column, value) edits, rejecting those to rows that someone else has changed since the
+    view last saw them. Returns (grid row, values) for the rows changed, a flag which is True if the rows
+    were reordered, and the grid rows of the rejected edits.
+    """
+    with FileManager.save_lock:
+      edits = [(self.label(row), column, value) for row, column, value in edits if self.label(row) is not None]
+      rows, reordered, conflicts = FileManager.edit_styles(self.prefix, edits, autosort, self.seen(label for label, _, _ in edits))
+      style_file = self.style_file()
+      for label, _ in rows:
+        self.own[label] = style_file.row_revision(label)
+    return [(self.row(label), values) for label, values in rows if self.row(label) is not None], reordered, [self.row(label) for label in dict.fromkeys(conflicts)]
+
+  def save_page(self, page:pd.DataFrame, autosort=False) -> List:
+    """
+    Save the whole grid back into the style file. Returns the labels of rows that weren't saved because
+    someone else has changed them since the page was shown.
+    """
+    with FileManager.save_lock:
+      return FileManager.save_page(self.prefix, page, self.labels, autosort, self.seen(self.labels))
+
+  def description(self) -> str:
+    filtered = f" ({self.matches} of {self.total} styles match the filter)" if self.filter_text else f" ({self.total} styles)"
+    return f"Page {self.page} of {self.pages()}{filtered}"
+
+  def match_counts(self) -> Dict[str,int]:
+    """
+    The number of rows matching the filter in each additional style file
+    """
+    if self.filter_text=='':
+      return {}
+    return FileManager.match_counts(self.filter_text, self.filter_type, Additionals.prefixes())
+
+  def match_counts_description(self) -> str:
+    counts = [f"{prefix} ({count})" for prefix, count in self.match_counts().items() if count>0]
+    return "Matches in additional style files: " + (", ".join(counts) if counts else "none") if self.filter_text else ""
+
+metrics.instrument(StyleView, ["current_page", "edit", "save_page", "match_counts"])
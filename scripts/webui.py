@@ -0,0 +1,31 @@
+# Everything the Style Editor needs from the webui, so the rest of it can be used without one
+import os
+try:
+  from modules import shared
+except ImportError:
+  shared = None
+
+extension_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def styles_file_path() -> str:
+  """
+  The webui's styles file, or None if there is no webui
+  """
+  if shared is None:
+    return None
+  try:
+    return shared.cmd_opts.styles_file 
+  except:
+    return getattr(shared.opts, 'styles_dir', None)
+
+def option(name:str, default):
+  """
+  The value of a webui setting, or default
+  """
+  return getattr(shared.opts, name, default) if shared is not None else default
+
+def prompt_styles():
+  """
+  The webui's style database, or None
+  """
+  return getattr(shared, 'prompt_styles', None) if shared is not None else None
@@ -0,0 +1,67 @@
+# The backup store: snapshots stored by content, their names, and the retention policy.
+#
+#   python -m pytest tests
+import os, sys, datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.backups import BackupStore
+
+none = {"recent":0, "hourly":0, "daily":0, "weekly":0}
+
+def objects(store):
+  return sorted(os.listdir(store.objects_directory))
+
+def test_unchanged_files_are_stored_once(tmp_path):
+  store = BackupStore(str(tmp_path))
+  first = store.snapshot({'':b"master", 'extra':b"extra"})
+  assert store.snapshot({'':b"master", 'extra':b"extra"}) is None
+  second = store.snapshot({'':b"changed", 'extra':b"extra"})
+  assert len(objects(store)) == 3
+  assert store.read(first, None) == {'':b"master", 'extra':b"extra"}
+  assert store.read(second, None) == {'':b"changed", 'extra':b"extra"}
+  assert BackupStore(str(tmp_path)).names() == [second, first]
+
+def test_names_are_unique(tmp_path):
+  store = BackupStore(str(tmp_path))
+  names = [store.snapshot({'':str(i).encode()}) for i in range(3)] # all within a second or two
+  assert len(set(names)) == 3
+  store.remove(names[1])
+  assert store.names() == [names[2], names[0]]
+  assert store.read(names[0], None) == {'':b"0"}
+  assert store.read(names[2], None) == {'':b"2"}
+
+def test_retention(tmp_path):
+  store = BackupStore(str(tmp_path))
+  for i in range(6):
+    store.snapshot({'':str(i).encode()}, retention={**none, "recent":100})
+  hours = [50, 49, 26, 25, 1, 0] # how long ago each was made
+  now = datetime.datetime.now().replace(minute=30)
+  for snapshot, hours_ago in zip(store.snapshots, hours):
+    snapshot['time'] = (now - datetime.timedelta(hours=hours_ago)).timestamp()
+  kept = lambda: [store.read(name, None)[''] for name in reversed(store.names())]
+  store.apply_retention({**none, "recent":1, "hourly":2})
+  assert kept() == [b"4", b"5"]
+  for i in range(6, 10):
+    store.snapshot({'':str(i).encode()}, retention={**none, "recent":2})
+  assert kept() == [b"8", b"9"]
+  assert len(objects(store)) == 2 # and the objects only the dropped snapshots used are gone
+
+def test_daily_retention(tmp_path):
+  store = BackupStore(str(tmp_path))
+  for i in range(4):
+    store.snapshot({'':str(i).encode()}, retention={**none, "recent":100})
+  now = datetime.datetime.now().replace(hour=12)
+  for snapshot, days_ago in zip(store.snapshots, [3, 2, 2, 0]):
+    snapshot['time'] = (now - datetime.timedelta(days=days_ago)).timestamp()
+  store.apply_retention({**none, "daily":3})
+  assert [store.read(name, None)[''] for name in store.names()] == [b"3", b"2", b"0"]
+
+def test_checkpoints(tmp_path):
+  store = BackupStore(str(tmp_path))
+  checkpoint = store.snapshot({'':b"checkpoint"}, checkpoint=True)
+  for i in range(3):
+    store.snapshot({'':str(i).encode()}, retention={**none, "recent":1})
+  assert not checkpoint in store.names()
+  assert store.read(checkpoint, None) == {'':b"checkpoint"} # kept by the retention policy
+  store.remove(checkpoint)
+  assert len(objects(store)) == 1
@@ -0,0 +1,102 @@
+# The journal: diffs between versions of a style file, undo and redo, checkpoints, and restoring to a time.
+#
+#   python -m pytest tests
+import os, sys, time
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.journal import Journal, diff, apply_changes
+from scripts.filemanager import FileManager
+
+def saved(rows):
+  return pd.DataFrame([[name, *values] for name, values in rows.items()], columns=['name', 'prompt', 'negative_prompt'])
+
+def test_diff_and_apply():
+  old = { "A":["a", ""], "B":["b", "not b"], "C":["c", ""] }
+  new = { "A":["a", ""], "B":["b2", "not b"], "D":["d", ""] }
+  changes = diff(saved(old), saved(new))
+  assert changes == { "removed":{ "C":["c", ""] }, "added":{ "D":["d", ""] }, "changed":{ "B":(["b", "not b"], ["b2", "not b"]) } }
+  rows = dict(old)
+  apply_changes(rows, changes)
+  assert rows == new
+  apply_changes(rows, changes, inverse=True)
+  assert rows == old
+  assert diff(saved(old), saved(dict(reversed(old.items())))) == {} # order isn't recorded
+
+def test_undo_redo(tmp_path):
+  journal = Journal(str(tmp_path / "journal.jsonl"))
+  for i in range(3):
+    journal.record("edit", { '':{ "changed":{ "A":[[str(i)], [str(i+1)]] } } })
+  journal.record("external", { '':{ "added":{ "B":["b", ""] } } })
+  assert journal.pop_undo() == { '':{ "changed":{ "A":[["2"], ["3"]] } } } # not the external change
+  assert journal.pop_undo() == { '':{ "changed":{ "A":[["1"], ["2"]] } } }
+  assert journal.pop_redo() == { '':{ "changed":{ "A":[["1"], ["2"]] } } }
+  journal.record("edit", { '':{ "removed":{ "A":["2", ""] } } })
+  assert journal.pop_redo() is None # a new change clears the redo stack
+  assert journal.pop_undo() == { '':{ "removed":{ "A":["2", ""] } } }
+
+def test_undo_depth(tmp_path, monkeypatch):
+  monkeypatch.setattr(Journal, "undo_depth", 2)
+  journal = Journal(str(tmp_path / "journal.jsonl"))
+  for i in range(4):
+    journal.record("edit", { '':{ "added":{ str(i):["", ""] } } })
+  assert [journal.pop_undo(), journal.pop_undo(), journal.pop_undo()] == [{ '':{ "added":{ "3":["", ""] } } }, { '':{ "added":{ "2":["", ""] } } }, None]
+
+def test_checkpoints_and_replay_plan(tmp_path, monkeypatch):
+  monkeypatch.setattr(Journal, "max_checkpoints", 2)
+  path = str(tmp_path / "journal.jsonl")
+  journal = Journal(path)
+  assert journal.needs_checkpoint()
+  times = []
+  for checkpoint in ["one", "two", "three"]:
+    dropped = journal.add_checkpoint(checkpoint)
+    journal.record("edit", { '':{ "added":{ checkpoint:["", ""] } } })
+    time.sleep(0.01)
+    times.append(time.time())
+    time.sleep(0.01)
+  assert dropped == ["one"]
+  assert not journal.needs_checkpoint()
+  checkpoint, changes = journal.replay_plan(times[1])
+  assert checkpoint == "two" and [record['files'] for record in changes] == [{ '':{ "added":{ "two":["", ""] } } }]
+  assert journal.replay_plan(times[0]) == (None, []) # its checkpoint has been dropped
+  journal.set_persist(False)
+  journal.record("edit", { '':{ "added":{ "hidden":["", ""] } } })
+  journal.set_persist(True)
+  assert journal.needs_checkpoint()
+  assert journal.replay_plan(time.time()) == (None, []) # changes were made while it was paused
+  reopened = Journal(path)
+  assert reopened.checkpoints == [(journal.checkpoints[0][0], "two"), (journal.checkpoints[1][0], "three")]
+  assert reopened.needs_checkpoint()
+
+@pytest.fixture
+def fm(tmp_path):
+  styles_file = tmp_path / "styles.csv"
+  styles_file.write_text("name,prompt,negative_prompt\nA,a,\nB,b,\n", encoding="utf-8")
+  FileManager.init(styles_file=str(styles_file), basedir=str(tmp_path / "extension"))
+  yield FileManager
+  FileManager.flush()
+
+def prompts(fm):
+  data = fm.get_styles()
+  return dict(zip(data['name'], data['prompt']))
+
+def edit(fm, name, prompt):
+  data = fm.get_styles()
+  fm.edit_styles('', [(data.index[data['name']==name][0], 'prompt', prompt)])
+  fm.flush()
+
+def test_restore_to_time_across_a_checkpoint(fm, monkeypatch):
+  monkeypatch.setattr(Journal, "checkpoint_interval", 2)
+  stamps = {}
+  for prompt in ["a1", "a2", "a3", "a4", "a5"]:
+    edit(fm, "A", prompt)
+    time.sleep(0.01)
+    stamps[prompt] = time.time()
+    time.sleep(0.01)
+  assert len(fm.journal.checkpoints) >= 2
+  for prompt in ["a4", "a2", "a5"]:
+    assert fm.restore_to_time(stamps[prompt]) is None
+    assert prompts(fm) == { "A":prompt, "B":"b" }
+  assert fm.undo() # a restore can be undone
+  assert prompts(fm) == { "A":"a2", "B":"b" }
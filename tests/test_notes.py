@@ -0,0 +1,60 @@
+# The notes store: the append-only log, its compaction, and sharing the notes between processes.
+#
+#   python -m pytest tests
+import os, sys, json
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.notes import NotesStore
+
+@pytest.fixture
+def compact_after(monkeypatch):
+  monkeypatch.setattr(NotesStore, "compact_after", 3)
+
+def set_notes(store, notes, prefix=''):
+  store.update(pd.Series(list(notes)), pd.Series(list(notes.values())), prefix)
+
+def log_lines(tmp_path):
+  with open(tmp_path / "notes.log", encoding="utf-8") as f:
+    return f.readlines()
+
+def test_changes_are_logged(tmp_path):
+  store = NotesStore(str(tmp_path))
+  set_notes(store, {"A":"a note", "B":"b note"})
+  set_notes(store, {"A":"a note", "B":""})
+  assert [json.loads(line) for line in log_lines(tmp_path)] == [{"key":"A", "note":"a note"}, {"key":"B", "note":"b note"}, {"key":"B", "note":None}]
+  assert store.lookup(pd.Series(["A", "B"]), '').tolist() == ["a note", ""]
+  set_notes(store, {"C":"c note"}, prefix="extra")
+  assert NotesStore(str(tmp_path)).notes == { "A":"a note", "extra::C":"c note" }
+
+def test_compaction(tmp_path, compact_after):
+  store = NotesStore(str(tmp_path))
+  set_notes(store, {"A":"1", "B":"1"})
+  set_notes(store, {"A":"2"})
+  assert len(log_lines(tmp_path)) == 3
+  set_notes(store, {"B":""})
+  assert log_lines(tmp_path) == []
+  with open(tmp_path / "notes.json", encoding="utf-8") as f:
+    assert json.load(f) == { "A":"2" }
+  set_notes(store, {"C":"3"})
+  assert len(log_lines(tmp_path)) == 1
+  assert NotesStore(str(tmp_path)).notes == { "A":"2", "C":"3" }
+
+def test_shared_between_stores(tmp_path, compact_after):
+  first, second = NotesStore(str(tmp_path)), NotesStore(str(tmp_path))
+  set_notes(first, {"A":"from first"})
+  set_notes(second, {"B":"from second"})
+  assert second.notes == { "A":"from first", "B":"from second" }
+  set_notes(first, {"A":"again", "C":"c"})
+  assert len(log_lines(tmp_path)) == 4
+  set_notes(first, {"C":"c2"}) # the log now has more lines than there are notes
+  assert log_lines(tmp_path) == []
+  set_notes(second, {"D":"d"})
+  assert second.notes == first.notes | { "D":"d" } == { "A":"again", "B":"from second", "C":"c2", "D":"d" }
+
+def test_rename(tmp_path):
+  store = NotesStore(str(tmp_path))
+  set_notes(store, {"A":"a note"})
+  store.rename("A", "A2")
+  assert NotesStore(str(tmp_path)).notes == { "A2":"a note" }
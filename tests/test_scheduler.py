@@ -0,0 +1,82 @@
+# The background scheduler: debouncing jobs, the maximum delay, and flushing.
+#
+#   python -m pytest tests
+import os, sys, time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts import background
+from scripts.background import Scheduler
+
+@pytest.fixture
+def clock(monkeypatch):
+  """
+  A list holding the time the scheduler sees; its thread isn't started, so jobs only run when flushed
+  """
+  now = [100.0]
+  monkeypatch.setattr(background.time, "monotonic", lambda: now[0])
+  return now
+
+@pytest.fixture
+def scheduler():
+  scheduler = Scheduler()
+  scheduler._started = True
+  return scheduler
+
+def test_debounce(scheduler, clock):
+  scheduler.add_job("save", lambda: None, debounce=5)
+  job = scheduler.jobs["save"]
+  assert job.due() is None
+  scheduler.set_pending("save")
+  assert job.due() == 105
+  clock[0] = 103
+  scheduler.set_pending("save")
+  assert job.due() == 105 # max_delay defaults to debounce, counted from the first time it was marked pending
+  scheduler.add_job("save", lambda: None, debounce=5, max_delay=30)
+  job = scheduler.jobs["save"]
+  for t in range(100, 140, 4):
+    clock[0] = t
+    scheduler.set_pending("save")
+  assert job.due() == 130 # a job that keeps being marked pending still runs max_delay after the first time
+
+def test_not_pending(scheduler, clock):
+  scheduler.add_job("save", lambda: None, debounce=5)
+  scheduler.set_pending("save")
+  scheduler.set_pending("save", pending=False)
+  assert scheduler.jobs["save"].due() is None
+
+def test_flush(scheduler, clock):
+  runs = []
+  for name in ["save", "index", "cache"]:
+    scheduler.add_job(name, lambda name=name: runs.append(name), debounce=5)
+  scheduler.set_pending("cache")
+  scheduler.set_pending("save")
+  scheduler.flush(["index", "cache"])
+  assert runs == ["cache"] # only pending jobs run
+  scheduler.set_pending("index")
+  scheduler.flush()
+  assert runs == ["cache", "save", "index"] # in the order they were added
+  scheduler.flush()
+  assert runs == ["cache", "save", "index"]
+
+def test_failing_job(scheduler, clock):
+  def fail():
+    raise ValueError("broken")
+  scheduler.add_job("save", fail, debounce=5)
+  scheduler.set_pending("save")
+  scheduler.flush()
+  assert scheduler.jobs["save"].due() is None
+
+def test_burst_runs_once():
+  scheduler = Scheduler()
+  runs = []
+  scheduler.add_job("save", lambda: runs.append(time.monotonic()), debounce=0.2, max_delay=5)
+  for _ in range(5):
+    scheduler.set_pending("save")
+    time.sleep(0.02)
+  last = time.monotonic()
+  deadline = last + 5
+  while not runs and time.monotonic()<deadline:
+    time.sleep(0.02)
+  time.sleep(0.3)
+  assert len(runs) == 1 and runs[0] - last >= 0.15
@@ -0,0 +1,62 @@
+# Search and replace across the master and additional style files.
+#
+#   python -m pytest tests
+import os, re, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.filemanager import FileManager
+from scripts.background import scheduler
+
+original = "name,prompt,negative_prompt\nA,red cat,red\nB,blue cat,\nextra::C,red dog,cat\n"
+
+@pytest.fixture(params=[False, True], ids=["scan", "text index"])
+def fm(request, tmp_path):
+  """
+  The FileManager with the styles above, with or without the text index built
+  """
+  styles_file = tmp_path / "styles.csv"
+  styles_file.write_text(original, encoding="utf-8")
+  FileManager.init(styles_file=str(styles_file), basedir=str(tmp_path / "extension"))
+  FileManager.update_additional_style_files()
+  FileManager.flush()
+  if request.param:
+    for prefix in ['', 'extra']:
+      FileManager.style_file(prefix).text_index()
+    scheduler.flush(["index"])
+  yield FileManager
+  FileManager.flush()
+
+def prompts(fm, prefix=''):
+  data = fm.get_styles(prefix)
+  return dict(zip(data['name'], data['prompt']))
+
+def test_replace(fm):
+  assert fm.search_and_replace("red", "green", False, ['prompt', 'negative_prompt'], ['']) == { '':{'prompt':2, 'negative_prompt':1} }
+  assert prompts(fm) == { "A":"green cat", "B":"blue cat", "extra::C":"green dog" }
+  assert fm.get_styles()['negative_prompt'].tolist() == ["green", "", "cat"]
+  assert prompts(fm, "extra") == { "C":"green dog" } # copied to the additional style file
+
+def test_dry_run_only_counts(fm):
+  assert fm.search_and_replace("cat", "dog", False, ['prompt'], ['']) == { '':{'prompt':2} }
+  assert fm.search_and_replace("dog", "x", False, ['prompt'], [''], dry_run=True) == { '':{'prompt':3} }
+  assert prompts(fm) == { "A":"red dog", "B":"blue dog", "extra::C":"red dog" }
+
+def test_replace_in_additional_file(fm):
+  assert fm.search_and_replace("dog", "fox", False, ['prompt'], ['extra', '']) == { 'extra':{'prompt':1} } # not counted twice
+  assert prompts(fm, "extra") == { "C":"red fox" }
+  assert prompts(fm)["extra::C"] == "red fox"
+
+def test_regex_and_literal_replacements(fm):
+  fm.search_and_replace(r"(\w+) cat", r"cat \1", True, ['prompt'], [''])
+  assert prompts(fm)["A"] == "cat red"
+  fm.search_and_replace("cat", r"\1", False, ['prompt'], [''])
+  assert prompts(fm)["A"] == r"\1 red"
+  with pytest.raises(re.error):
+    fm.search_and_replace("(", "", True, ['prompt'], [''])
+
+def test_filter_after_replace(fm):
+  fm.search_and_replace("cat", "owl", False, ['prompt'], [''])
+  style_file = fm.style_file('')
+  assert list(style_file.data.loc[style_file.find("owl", "Exact match"), 'name']) == ["A", "B"]
+  assert len(style_file.find("cat", "Exact match")) == 1 # extra::C's negative prompt
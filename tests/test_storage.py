@@ -0,0 +1,189 @@
+# The style file scenarios, run against each storage backend (CSV files and SQLite database), without the webui.
+#
+#   python -m pytest tests
+import os, sys, time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.filemanager import FileManager
+from scripts.storage import CsvStorage, SqliteStorage, parse_csv, migrate
+
+backends = { "CSV files":CsvStorage, "SQLite database":SqliteStorage }
+
+original = "name,prompt,negative_prompt\nA,a prompt,a negative\nB,\"b, prompt\",\nextra::C,c prompt,c negative\n"
+
+@pytest.fixture(params=list(backends))
+def open_styles(request, tmp_path):
+  """
+  A function which (re)opens the styles as the webui would when it starts, and returns the FileManager
+  """
+  styles_file = tmp_path / "styles.csv"
+  styles_file.write_text(original, encoding="utf-8")
+  def open_styles():
+    if FileManager.initialized:
+      FileManager.flush()
+    FileManager.init(styles_file=str(styles_file), basedir=str(tmp_path / "extension"), storage=request.param)
+    assert isinstance(FileManager.storage, backends[request.param])
+    return FileManager
+  yield open_styles
+  FileManager.flush()
+
+def styles(fm, prefix=''):
+  """
+  {name : [prompt, negative_prompt]}
+  """
+  data = fm.get_styles(prefix)
+  return { name:[prompt, negative_prompt] for name, prompt, negative_prompt in zip(data['name'], data['prompt'], data['negative_prompt']) }
+
+def label(fm, name, prefix=''):
+  data = fm.get_styles(prefix)
+  return data.index[data['name']==name][0]
+
+def edit(fm, name, column, value, prefix=''):
+  fm.edit_styles(prefix, [(label(fm, name, prefix), column, value)])
+  fm.flush()
+
+initial = { "A":["a prompt", "a negative"], "B":["b, prompt", ""], "extra::C":["c prompt", "c negative"] }
+
+def test_load(open_styles):
+  fm = open_styles()
+  assert styles(fm) == initial
+  fm.update_additional_style_files()
+  fm.flush()
+  assert styles(open_styles(), "extra") == { "C":["c prompt", "c negative"] }
+
+def test_save(open_styles):
+  fm = open_styles()
+  data = fm.get_styles().copy()
+  data.loc[label(fm, "A"), 'prompt'] = "changed"
+  data.loc[len(data)+100] = [4, "D", "d prompt", "", ""]
+  fm.save_styles(data)
+  fm.flush()
+  expected = { **initial, "A":["changed", "a negative"], "D":["d prompt", ""] }
+  fm = open_styles()
+  assert styles(fm) == expected
+  if fm.storage.exports_master:
+    fm.storage.export_master()
+  with open(fm.default_style_file_path, 'rb') as f:
+    webui_csv = parse_csv(f.read())
+  assert dict(zip(webui_csv['name'], webui_csv[['prompt','negative_prompt']].values.tolist())) == expected
+
+def test_save_unchanged(open_styles):
+  fm = open_styles()
+  fm.save_styles(fm.get_styles().copy())
+  assert not fm.style_file('').dirty
+
+def test_edit(open_styles):
+  fm = open_styles()
+  edit(fm, "B", "negative_prompt", "b negative")
+  edit(fm, "A", "name", "A2")
+  fm = open_styles()
+  assert styles(fm) == { "A2":["a prompt", "a negative"], "B":["b, prompt", "b negative"], "extra::C":["c prompt", "c negative"] }
+  assert list(fm.get_styles()['name']) == ["A2", "B", "extra::C"]
+
+def test_edit_conflict(open_styles):
+  fm = open_styles()
+  a = label(fm, "A")
+  seen = { a:fm.style_file('').row_revision(a) }
+  fm.edit_styles('', [(a, "prompt", "first")], seen=seen)
+  _, _, rejected = fm.edit_styles('', [(a, "prompt", "second")], seen=seen)
+  assert rejected == [a]
+  fm.flush()
+  assert styles(open_styles())["A"] == ["first", "a negative"]
+
+def test_delete_and_move(open_styles):
+  fm = open_styles()
+  assert fm.bulk_operations([("delete", "B", None), ("move", "A", "extra"), ("delete", "Z", None)]) == [None, None, "No style called Z"]
+  fm.flush()
+  fm = open_styles()
+  assert styles(fm) == { "extra::A":["a prompt", "a negative"], "extra::C":["c prompt", "c negative"] }
+  assert styles(fm, "extra") == { "A":["a prompt", "a negative"], "C":["c prompt", "c negative"] }
+
+def test_merge(open_styles):
+  fm = open_styles()
+  fm.update_additional_style_files()
+  fm.flush()
+  edit(fm, "C", "prompt", "edited in extra", prefix="extra")
+  fm.merge_additional_style_files()
+  fm.flush()
+  assert styles(open_styles())["extra::C"] == ["edited in extra", "c negative"]
+
+def test_split_into_loaded_file(open_styles):
+  fm = open_styles()
+  fm.update_additional_style_files()
+  fm.flush()
+  assert styles(fm, "extra") == { "C":["c prompt", "c negative"] }
+  edit(fm, "extra::C", "prompt", "edited in master")
+  fm.update_additional_style_files()
+  fm.flush()
+  assert styles(open_styles(), "extra") == { "C":["edited in master", "c negative"] }
+
+def test_merge_reorders(open_styles):
+  fm = open_styles()
+  fm.update_additional_style_files()
+  fm.flush()
+  data = fm.get_styles()
+  fm.save_styles(data.iloc[[2, 0, 1]].assign(sort=[1, 2, 3]))
+  fm.flush()
+  fm.merge_additional_style_files()
+  fm.flush()
+  assert list(open_styles().get_styles()['name']) == ["A", "B", "extra::C"]
+
+def test_undo_redo(open_styles):
+  fm = open_styles()
+  edit(fm, "A", "prompt", "edited")
+  fm.remove_style("B")
+  fm.flush()
+  assert fm.undo()
+  assert styles(fm) == { **initial, "A":["edited", "a negative"] }
+  assert fm.undo()
+  assert styles(fm) == initial
+  assert not fm.undo()
+  assert fm.redo()
+  assert styles(open_styles()) == { **initial, "A":["edited", "a negative"] }
+
+def test_restore_to_time(open_styles):
+  fm = open_styles()
+  edit(fm, "A", "prompt", "first")
+  time.sleep(0.01)
+  first = time.time()
+  time.sleep(0.01)
+  edit(fm, "A", "prompt", "second")
+  fm.remove_style("extra::C")
+  fm.flush()
+  assert fm.restore_to_time(first) is None
+  assert styles(open_styles()) == { **initial, "A":["first", "a negative"] }
+  assert fm.restore_to_time(first - 3600) is not None
+
+def test_restore_from_backup(open_styles):
+  fm = open_styles()
+  fm.do_backup()
+  edit(fm, "A", "prompt", "edited")
+  fm.remove_style("B")
+  fm.flush()
+  assert fm.restore_from_backup(fm.list_backups()[0]) is None
+  assert styles(fm) == initial
+  assert fm.undo()
+  assert styles(open_styles()) == { "A":["edited", "a negative"], "extra::C":["c prompt", "c negative"] }
+
+def test_notes(open_styles):
+  fm = open_styles()
+  data = fm.get_styles().copy()
+  data.loc[label(fm, "A"), 'notes'] = "a note"
+  fm.save_styles(data)
+  fm.flush()
+  edit(open_styles(), "A", "name", "A2")
+  fm = open_styles()
+  notes = dict(zip(fm.get_styles()['name'], fm.get_styles()['notes']))
+  assert notes == { "A2":"a note", "B":"", "extra::C":"" }
+
+def test_migrate(tmp_path):
+  (tmp_path / "styles.csv").write_text(original, encoding="utf-8")
+  (tmp_path / "additional").mkdir()
+  (tmp_path / "additional" / "extra.csv").write_text("name,prompt,negative_prompt\nC,c prompt,c negative\n", encoding="utf-8")
+  source = CsvStorage(str(tmp_path / "styles.csv"), str(tmp_path / "additional"))
+  target = SqliteStorage(str(tmp_path / "styles.db"), str(tmp_path / "styles.csv"))
+  migrate(source, target)
+  assert sorted(target.prefixes()) == sorted(source.prefixes())
+  for prefix in source.prefixes():
+    assert target.load(prefix)[0].values.tolist() == source.load(prefix)[0].values.tolist()
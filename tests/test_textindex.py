@@ -0,0 +1,100 @@
+# The text index (narrowing down the rows a filter has to check) and the filter itself.
+#
+#   python -m pytest tests
+import os, sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scripts.filemanager import FileManager, StyleFile
+from scripts.background import scheduler
+from scripts.shared import display_columns
+from scripts.textindex import TextIndex, matches, required_literals, filter_types
+
+def frame(rows, labels=None):
+  """
+  A style file's data from [name, prompt, negative_prompt] rows
+  """
+  data = pd.DataFrame([[i, *row, ''] for i, row in enumerate(rows)], columns=display_columns, index=labels)
+  data['sort'] = data['sort'].astype(str)
+  return data
+
+rows = [["Portrait", "a portrait, soft light", "blurry"],
+        ["Landscape", "wide landscape\nmountains", ""],
+        ["Night", "city at night, neon light", "daylight"],
+        ["Café", "a café in Paris", "crowds"]]
+
+searches = [("light", f) for f in filter_types] + [("LIGHT", "Case insensitive"), ("LIGHT", "Exact match"), ("café", "Exact match"),
+            ("neon light", "Words"), ("light neon", "Words"), (r"land\w+\nmount", "regex"), ("portrait|night", "regex"), ("[", "regex"),
+            ("mountains", "Words"), ("ab", "Exact match"), ("zzz", "Exact match")]
+
+@pytest.mark.parametrize("text,filter_type", searches)
+def test_narrow_keeps_every_match(text, filter_type):
+  data = frame(rows)
+  narrowed = TextIndex(data).narrow(data, text, filter_type)
+  expected = data.index[matches(data, text, filter_type)]
+  assert list(narrowed.index[matches(narrowed, text, filter_type)]) == list(expected)
+
+def test_narrow_leaves_out_rows_without_the_trigrams():
+  data = frame(rows)
+  assert list(TextIndex(data).narrow(data, "light", "Exact match")['name']) == ["Portrait", "Night"]
+  assert len(TextIndex(data).narrow(data, "zzz", "Exact match")) == 0
+  assert len(TextIndex(data).narrow(data, "ab", "Exact match")) == len(data) # too short to narrow anything down
+
+def test_words_and_regex_filters():
+  data = frame(rows)
+  assert list(data['name'][matches(data, "light neon", "Words")]) == ["Night"]
+  assert list(data['name'][matches(data, "ligh", "Words")]) == []
+  assert matches(data, "[", "regex").all() # an invalid regex matches everything
+  assert required_literals(r"city\s+at night") == ["city", "at night"]
+  assert required_literals("a|b") == []
+
+def test_updates_match_a_fresh_index():
+  data = frame(rows, labels=[10, 11, 12, 13])
+  index = TextIndex(data)
+  data.loc[11, 'prompt'] = "city lights"
+  index.update(11, data.loc[11, display_columns])
+  data.loc[[12, 13], 'prompt'] = ["river", "light rain"]
+  index.update_rows(data.loc[[12, 13]])
+  index.remove(10)
+  data = data.drop(10)
+  fresh = TextIndex(data)
+  for text in ["light", "city", "river", "portrait", "rain"]:
+    assert sorted(index.candidates(text, "Exact match")) == sorted(fresh.candidates(text, "Exact match"))
+  assert index.dead == 4
+
+def test_rebuild_after_many_removals():
+  data = frame([[f"style {i}", "prompt", ""] for i in range(2100)])
+  index = TextIndex(data)
+  for label in data.index[:1100]:
+    index.remove(label)
+  assert index.needs_rebuild()
+
+@pytest.fixture
+def fm(tmp_path):
+  styles_file = tmp_path / "styles.csv"
+  styles_file.write_text("name,prompt,negative_prompt\n" + "".join(f"{name},\"{prompt}\",{negative}\n" for name, prompt, negative in rows), encoding="utf-8")
+  FileManager.init(styles_file=str(styles_file), basedir=str(tmp_path / "extension"))
+  yield FileManager
+  FileManager.flush()
+
+def test_find_before_and_after_the_index_is_built(fm):
+  style_file = fm.style_file('')
+  assert style_file.text_index() is None # built by the background job
+  assert list(style_file.data.loc[style_file.find("light", "Exact match"), 'name']) == ["Portrait", "Night"]
+  scheduler.flush(["index"])
+  assert style_file.text_index() is not None
+  assert list(style_file.data.loc[style_file.find("light", "Exact match"), 'name']) == ["Portrait", "Night"]
+
+def test_large_changes_are_scanned_until_reindexed(fm, monkeypatch):
+  style_file = fm.style_file('')
+  style_file.text_index()
+  scheduler.flush(["index"])
+  monkeypatch.setattr(StyleFile, "reindex_limit", 1)
+  data = fm.get_styles()
+  fm.edit_styles('', [(label, 'prompt', "fog") for label in data.index[:2]])
+  assert style_file.text_index() is not None and style_file.needs_text_index()
+  assert list(style_file.data.loc[style_file.find("fog", "Exact match"), 'name']) == ["Portrait", "Landscape"]
+  scheduler.flush(["index"])
+  assert not style_file.needs_text_index()
+  assert list(style_file.data.loc[style_file.find("fog", "Exact match"), 'name']) == ["Portrait", "Landscape"]